@@ -0,0 +1,149 @@
+"""Бенчмарк запросов системы вопросов на большой истории.
+
+База заполняется ступенями (по умолчанию до 1 000 000 вопросов). На каждой ступени
+запросы из handle_question_input, end_dialog и show_questions замеряются без индексов
+и после применения миграций. Время запроса с индексами должно оставаться
+практически постоянным при росте истории.
+
+Запуск:
+    python benchmarks/bench_questions.py
+    python benchmarks/bench_questions.py --steps 10000 100000 1000000 --users 200000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+INDEX_MIGRATION = 4
+
+QUERIES = {
+    'последний вопрос пользователя': (
+        "SELECT id, admin_id, status FROM questions WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
+        lambda rnd, users, questions: (rnd.randrange(users),)
+    ),
+    'активный диалог пользователя': (
+        "SELECT id, admin_id FROM questions WHERE user_id = ? AND status = 'in_progress'",
+        lambda rnd, users, questions: (rnd.randrange(users),)
+    ),
+    'незакрытые вопросы': (
+        "SELECT id, user_id, question_text FROM questions WHERE status IN ('open', 'in_progress')",
+        lambda rnd, users, questions: ()
+    ),
+    'переписка по вопросу': (
+        "SELECT sender_id, message_text FROM question_messages WHERE question_id = ? ORDER BY sent_at",
+        lambda rnd, users, questions: (rnd.randrange(1, questions + 1),)
+    ),
+}
+
+
+def seed(conn, rnd, start, stop, users, messages_per_question, active):
+    """Добавление вопросов с номерами [start, stop).
+
+    Как и в реальной истории, незакрытыми могут быть только последние active вопросов,
+    всё более старое закрыто.
+    """
+    def questions():
+        for question_id in range(start + 1, stop + 1):
+            if question_id > stop - active:
+                status = rnd.choice(('closed', 'in_progress', 'open'))
+            else:
+                status = 'closed'
+            yield (question_id, rnd.randrange(users), f"Вопрос {question_id}", status, 1,
+                   f"2024-01-01 00:00:{question_id % 60:02d}")
+
+    def messages():
+        for question_id in range(start + 1, stop + 1):
+            for _ in range(messages_per_question):
+                yield question_id, rnd.randrange(users), "Сообщение"
+
+    conn.execute("BEGIN")
+    conn.execute("UPDATE questions SET status = 'closed' WHERE status != 'closed'")
+    conn.executemany(
+        "INSERT INTO questions (id, user_id, question_text, status, admin_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        questions()
+    )
+    conn.executemany(
+        "INSERT INTO question_messages (question_id, sender_id, message_text) VALUES (?, ?, ?)",
+        messages()
+    )
+    conn.execute("COMMIT")
+
+
+def drop_indexes(conn):
+    for name in ('idx_questions_user_created', 'idx_questions_status', 'idx_question_messages_question_sent'):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.execute(f"PRAGMA user_version = {INDEX_MIGRATION - 1}")
+
+
+def measure(conn, rnd, users, questions, iterations):
+    results = {}
+    for name, (sql, make_params) in QUERIES.items():
+        timings = []
+        for _ in range(iterations):
+            params = make_params(rnd, users, questions)
+            started = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            timings.append((time.perf_counter() - started) * 1_000_000)
+        timings.sort()
+        results[name] = (statistics.median(timings), timings[int(len(timings) * 0.99) - 1])
+    return results
+
+
+def query_plans(conn):
+    plans = {}
+    for name, (sql, _) in QUERIES.items():
+        params = tuple(1 for _ in range(sql.count('?')))
+        plans[name] = '; '.join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+    return plans
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--messages-per-question', type=int, default=2)
+    parser.add_argument('--active', type=int, default=300, help='последних вопросов, которые могут быть не закрыты')
+    parser.add_argument('--iterations', type=int, default=2000, help='замеров на запрос с индексами')
+    parser.add_argument('--unindexed-iterations', type=int, default=20, help='замеров на запрос без индексов')
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        main.apply_migrations(conn, target=INDEX_MIGRATION - 1)
+
+        seeded = 0
+        print(f"{'вопросов':>10} | {'запрос':<30} | {'без индексов, мкс (p50/p99)':>28} | {'с индексами, мкс (p50/p99)':>27}")
+        for step in sorted(args.steps):
+            started = time.perf_counter()
+            seed(conn, rnd, seeded, step, args.users, args.messages_per_question, args.active)
+            seeded = step
+            print(f"# заполнено до {step} вопросов за {time.perf_counter() - started:.1f} с")
+
+            without = measure(conn, rnd, args.users, seeded, args.unindexed_iterations)
+            main.apply_migrations(conn, target=INDEX_MIGRATION)
+            with_indexes = measure(conn, rnd, args.users, seeded, args.iterations)
+            for name in QUERIES:
+                before, after = without[name], with_indexes[name]
+                print(f"{step:>10} | {name:<30} | {before[0]:>13.1f} / {before[1]:>12.1f} | {after[0]:>12.1f} / {after[1]:>12.1f}")
+            if step == max(args.steps):
+                print("# планы запросов с индексами:")
+                for name, plan in query_plans(conn).items():
+                    print(f"#   {name}: {plan}")
+            else:
+                drop_indexes(conn)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,344 @@
+"""Нагрузочный тест бота без сети: настоящие обработчики, поддельный Bot API.
+
+Приложение из main.py запускается целиком (OrderedApplication, persistence, фоновые задачи),
+но запросы к api.telegram.org подменяются локальной заглушкой с настраиваемой задержкой.
+Синтетические пользователи ходят по меню, задают вопросы и переписываются с админом;
+по желанию в конце запускается рассылка по всей базе.
+
+Для каждой фазы выводятся пропускная способность и задержка обработки обновлений
+(от постановки в очередь до конца обработки), затем метрики обработчиков, БД и Bot API.
+По умолчанию все обновления фазы ставятся в очередь сразу (пик после анонса); с --rate
+они поступают с заданной частотой, и задержка показывает запас по мощности.
+
+Запуск:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --users 5000 --dialogs 500 --api-latency 30 --broadcast
+    python benchmarks/load_test.py --users 2000 --rate 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = 1
+BOT_USER = {'id': 100, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+# Маршрут пользователя по меню перед тем, как задать вопрос
+NAVIGATION = [
+    '/start', 'ETS 2', 'Гайды', 'Консольные команды', 'Назад', 'Назад',
+    'Моды', 'Таблица модов', 'Иммерсивные моды', 'Назад', 'Назад',
+    'ATS', 'Обзор актуального патча', 'Назад', 'Социальные сети', 'Назад', 'Назад',
+]
+
+
+def prepare_environment(workdir):
+    """Рабочий каталог теста: временная БД рядом с ссылкой на контент из репозитория."""
+    os.symlink(os.path.join(REPO_DIR, 'data'), os.path.join(workdir, 'data'))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+
+def make_config(main, args, workdir):
+    """Настройки теста: временная БД, логи только в консоль, без порта метрик."""
+    return main.Config(
+        token='123456:BENCHMARK',
+        admin_ids=[ADMIN_ID],
+        db_path=os.path.join(workdir, 'bench.db'),
+        log_dir='',
+        log_level=args.log_level,
+        metrics_port=0,
+        concurrent_updates=args.concurrency,
+        broadcast_rate=args.broadcast_rate,
+        outbox_rate=args.outbox_rate,
+    )
+
+
+def make_fake_request(main, latency, jitter):
+    """Заглушка Bot API на уровне HTTP-транспорта: весь путь PTB и метрики запросов сохраняются."""
+
+    class FakeBotAPIRequest(main.InstrumentedRequest):
+        calls = 0
+
+        def __init__(self):
+            super().__init__(connection_pool_size=256)
+            self._message_id = 0
+
+        async def do_request(self, url, method, request_data=None, *args, **kwargs):
+            FakeBotAPIRequest.calls += 1
+            if latency:
+                await asyncio.sleep(max(0.0, random.gauss(latency, jitter)))
+            endpoint = url.rsplit('/', 1)[-1]
+            params = request_data.parameters if request_data else {}
+            return 200, json.dumps({'ok': True, 'result': self._result(endpoint, params)}).encode()
+
+        def _message(self, params):
+            self._message_id += 1
+            file = {'file_id': f'file{self._message_id}', 'file_unique_id': f'u{self._message_id}'}
+            return {
+                'message_id': self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0) or 0), 'type': 'private'},
+                'from': BOT_USER,
+                'text': str(params.get('text', '')),
+                'photo': [{**file, 'width': 1, 'height': 1}],
+                'document': file,
+            }
+
+        def _result(self, endpoint, params):
+            if endpoint == 'getMe':
+                return {**BOT_USER, 'can_join_groups': False, 'can_read_all_group_messages': False,
+                        'supports_inline_queries': True}
+            if endpoint == 'sendMediaGroup':
+                return [self._message(params) for _ in params.get('media', [])]
+            if endpoint.startswith(('send', 'edit')):
+                return self._message(params)
+            if endpoint == 'getFile':
+                return {'file_id': params.get('file_id'), 'file_unique_id': 'u', 'file_path': 'photo.jpg'}
+            return True
+
+    return FakeBotAPIRequest
+
+
+class UpdateFactory:
+    def __init__(self, bot, update_class):
+        self.bot = bot
+        self.update_class = update_class
+        self.next_id = 0
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, user_id, text):
+        self.next_id += 1
+        message = {
+            'message_id': self.next_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.update_class.de_json({'update_id': self.next_id, 'message': message}, self.bot)
+
+    def callback(self, user_id, data):
+        self.next_id += 1
+        return self.update_class.de_json({'update_id': self.next_id, 'callback_query': {
+            'id': str(self.next_id),
+            'from': self._user(user_id),
+            'chat_instance': 'bench',
+            'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'from': BOT_USER, 'text': '...'},
+        }}, self.bot)
+
+
+class Recorder:
+    """Время от постановки обновления в очередь до окончания его обработки."""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.enqueued = {}
+        self.latencies = []
+        self.done = asyncio.Event()
+
+    def finished(self, update):
+        started = self.enqueued.pop(getattr(update, 'update_id', None), None)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+            if not self.enqueued:
+                self.done.set()
+
+    async def run_phase(self, name, application, updates, timeout):
+        self.latencies = []
+        self.done.clear()
+        started = time.perf_counter()
+        for index, update in enumerate(updates):
+            if self.rate:
+                # Открытая модель нагрузки: обновления приходят с заданной частотой
+                delay = started + index / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.enqueued[update.update_id] = time.perf_counter()
+            await application.update_queue.put(update)
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"# {name}: не дождались {len(self.enqueued)} обновлений за {timeout} с")
+            self.enqueued.clear()
+        elapsed = time.perf_counter() - started
+        report_phase(name, len(updates), elapsed, self.latencies)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def report_phase(name, count, elapsed, latencies):
+    if not latencies:
+        print(f"{name:<28} | {count:>7} | нет данных")
+        return
+    ms = [value * 1000 for value in latencies]
+    print(f"{name:<28} | {count:>7} | {count / elapsed:>9.0f} | {statistics.median(ms):>8.1f} | "
+          f"{percentile(ms, 0.99):>8.1f} | {max(ms):>8.1f}")
+
+
+def interleave(per_user):
+    """Обновления разных пользователей вперемешку, порядок внутри пользователя сохраняется."""
+    queues = [list(updates) for updates in per_user if updates]
+    result = []
+    while queues:
+        random.shuffle(queues)
+        for updates in queues:
+            result.append(updates.pop(0))
+        queues = [updates for updates in queues if updates]
+    return result
+
+
+async def wait_for_broadcast(main, timeout):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        row = await main.db.fetchone("SELECT status, sent, failed, blocked FROM broadcasts ORDER BY id DESC LIMIT 1")
+        if row and row[0] != 'running':
+            return row, time.perf_counter() - started
+        await asyncio.sleep(0.2)
+    return None, timeout
+
+
+async def wait_for_outbox(main, timeout):
+    """Ожидание доставки сообщений пересылки: обработчики только ставят их в очередь."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        row = await main.db.fetchone("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        if not row[0]:
+            return time.perf_counter() - started
+        await asyncio.sleep(0.2)
+    return None
+
+
+async def run(args, main, workdir):
+    from telegram import Update
+
+    fake_request = make_fake_request(main, args.api_latency / 1000, args.api_jitter / 1000)
+    application = main.create_app(make_config(main, args, workdir), request=fake_request())
+
+    recorder = Recorder(args.rate)
+    process_update = main.OrderedApplication.process_update
+
+    async def recorded_process_update(self, update):
+        try:
+            await process_update(self, update)
+        finally:
+            recorder.finished(update)
+
+    main.OrderedApplication.process_update = recorded_process_update
+
+    await application.initialize()
+    await main.on_startup(application)
+    await application.start()
+
+    factory = UpdateFactory(application.bot, Update)
+    users = list(range(1_000, 1_000 + args.users))
+    print(f"{'фаза':<28} | {'обновл.':>7} | {'обновл./с':>9} | {'p50, мс':>8} | {'p99, мс':>8} | {'max, мс':>8}")
+
+    await recorder.run_phase("меню и вопросы", application, interleave(
+        [factory.message(user_id, text) for text in NAVIGATION + ['Задать вопрос', f'Вопрос от {user_id}',
+                                                                  'Когда ответят?']]
+        for user_id in users
+    ), args.timeout)
+
+    questions = await main.db.fetchall("SELECT id, user_id FROM questions ORDER BY id LIMIT ?", (args.dialogs,))
+    admin_updates = []
+    for question_id, _ in questions:
+        admin_updates.append(factory.callback(ADMIN_ID, f'answer_{question_id}'))
+        admin_updates.append(factory.message(ADMIN_ID, f'Ответ на вопрос {question_id}'))
+    await recorder.run_phase("админ берёт вопросы", application, admin_updates, args.timeout)
+
+    await recorder.run_phase("диалоги пользователей", application, interleave(
+        [factory.message(user_id, 'Спасибо!'), factory.message(user_id, '/end_dialog')]
+        for _, user_id in questions
+    ), args.timeout)
+
+    await recorder.run_phase("входящие админа", application, [
+        factory.message(ADMIN_ID, 'Админ'), factory.message(ADMIN_ID, 'Вопросы'),
+        *[factory.callback(ADMIN_ID, f'inbox:all:0:n:{question_id}') for question_id, _ in questions[:50]],
+    ], args.timeout)
+
+    if args.broadcast:
+        await main.user_registry.flush()
+        await recorder.run_phase("запуск рассылки", application, [
+            factory.message(ADMIN_ID, 'Админ'), factory.message(ADMIN_ID, 'Рассылка'),
+            factory.message(ADMIN_ID, '*Анонс* стрима сегодня в 20:00'),
+            factory.callback(ADMIN_ID, 'send_broadcast'),
+        ], args.timeout)
+        row, elapsed = await wait_for_broadcast(main, args.timeout)
+        if row:
+            status, sent, failed, blocked = row
+            print(f"# рассылка: {status}, отправлено {sent}, ошибок {failed}, заблокировали {blocked} "
+                  f"за {elapsed:.1f} с ({sent / elapsed:.0f} сообщ./с при BROADCAST_RATE={args.broadcast_rate})")
+        else:
+            print(f"# рассылка не завершилась за {args.timeout} с")
+
+    elapsed = await wait_for_outbox(main, args.timeout)
+    delays = main.metrics.histograms('bot_outbox_delay_seconds').get((), ([0], 0, 0))
+    if elapsed is None:
+        print(f"# outbox: сообщения не доставлены за {args.timeout} с")
+    elif delays[2]:
+        print(f"# outbox: доставлено {delays[2]}, очередь опустела через {elapsed:.1f} с после последней фазы; "
+              f"задержка доставки p50 ≤{main.metrics.quantile(delays[0], 0.5) * 1000:g} мс, "
+              f"p99 ≤{main.metrics.quantile(delays[0], 0.99) * 1000:g} мс")
+
+    # Порядок как в run_polling: user_data сохраняются в shutdown(), база закрывается в post_shutdown
+    await application.stop()
+    await application.shutdown()
+    await main.on_shutdown(application)
+
+    stats = application.queue_stats()
+    print(f"\n# запросов к Bot API: {fake_request.calls}, максимум ожидающих обновлений: {stats['max_waiting']}")
+    for title, name, label in (
+        ("обработчики", 'bot_handler_seconds', 'handler'),
+        ("операции БД", 'bot_db_query_seconds', 'operation'),
+        ("ожидание потока БД (конкуренция)", 'bot_db_wait_seconds', 'mode'),
+        ("Bot API", 'bot_api_request_seconds', 'method'),
+    ):
+        print(f"# {title}:")
+        for line in main._format_latency(main.metrics.histograms(name), label)[:args.top]:
+            print(f"#   {line}")
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--dialogs', type=int, default=200, help='сколько вопросов админ берёт в работу')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='частота поступления обновлений в секунду (0 - все сразу, пиковая нагрузка)')
+    parser.add_argument('--concurrency', type=int, default=16, help='CONCURRENT_UPDATES')
+    parser.add_argument('--api-latency', type=float, default=20, help='средняя задержка Bot API, мс')
+    parser.add_argument('--api-jitter', type=float, default=5, help='разброс задержки Bot API, мс')
+    parser.add_argument('--broadcast', action='store_true', help='в конце запустить рассылку по всей базе')
+    parser.add_argument('--broadcast-rate', type=float, default=1000, help='BROADCAST_RATE для теста')
+    parser.add_argument('--outbox-rate', type=float, default=30, help='OUTBOX_RATE для теста')
+    parser.add_argument('--timeout', type=float, default=600, help='максимальная длительность фазы, с')
+    parser.add_argument('--top', type=int, default=10, help='строк в каждой таблице метрик')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare_environment(workdir)
+        import main
+        asyncio.run(run(args, main, workdir))
+        os.chdir(REPO_DIR)
+
+
+if __name__ == '__main__':
+    main_benchmark()
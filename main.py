@@ -1,232 +1,1594 @@
 import os
+import asyncio
 import sqlite3
 import logging
 import json
-from logging.handlers import RotatingFileHandler
+import html
+import hashlib
+import hmac
+import re
+import csv
+import gzip
+import tempfile
+from datetime import date, datetime
+import time
+import signal
+import queue
+import threading
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import multiprocessing
+from dataclasses import dataclass, field, replace
+from logging.handlers import QueueHandler, QueueListener
 from logging.handlers import TimedRotatingFileHandler
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from telegram import Bot, Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InputMediaPhoto, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, Updater, BasePersistence, PersistenceInput, CommandHandler, InlineQueryHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from telegram.request import HTTPXRequest
+import tornado.httpserver
+import tornado.web
 from dotenv import load_dotenv
 
-# Загрузка переменных окружения из файла .env
-load_dotenv()
+@dataclass
+class Config:
+    """Настройки бота. Значения по умолчанию совпадают с умолчаниями переменных окружения."""
+    token: str = ''
+    admin_ids: list = field(default_factory=list)
+    # Режим получения обновлений: polling (по умолчанию) или webhook
+    bot_mode: str = 'polling'
+    webhook_listen: str = '0.0.0.0'
+    webhook_port: int = 8443
+    webhook_path: str = 'telegram'
+    webhook_url: str = ''  # Публичный адрес; если пуст, setWebhook не вызывается
+    webhook_secret: str = ''
+    webhook_max_connections: int = 40
+    # Количество одновременно обрабатываемых обновлений (0 - последовательно)
+    # и максимальное число принятых в обработку обновлений, включая ожидающие своей очереди
+    concurrent_updates: int = 16
+    update_queue_depth: int = 512
+    # Процессы-обработчики: 0 - всё в одном процессе, N - диспетчер и N обработчиков,
+    # между которыми пользователи распределяются по user_id
+    workers: int = 0
+    # Логи: пустой log_dir - только консоль (тесты, бенчмарки)
+    log_level: str = 'INFO'
+    log_dir: str = 'Log'
+    # Метрики в формате Prometheus на локальном порту (0 - не запускать)
+    metrics_listen: str = '127.0.0.1'
+    metrics_port: int = 9090
+    db_path: str = 'bot.db'
+    db_pool_size: int = 4
+    db_statement_cache: int = 128
+    # PRAGMA для каждого соединения: WAL позволяет читать во время записи,
+    # synchronous=NORMAL в режиме WAL не делает fsync на каждый commit
+    # auto_vacuum=INCREMENTAL действует только для новой базы и должен идти первым, до создания файла;
+    # существующая база переводится в этот режим однократно командой /vacuum
+    db_pragmas: dict = field(default_factory=lambda: {
+        'auto_vacuum': 'INCREMENTAL',
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': '5000',
+        'cache_size': '-8000',
+        'temp_store': 'MEMORY',
+    })
+    # Каталог с контентом и период проверки изменений файлов (в секундах)
+    content_dir: str = 'data'
+    content_refresh_interval: int = 30
+    # Отложенная запись новых пользователей: период (в секундах) и размер пачки
+    user_flush_interval: float = 2
+    user_flush_batch: int = 500
+    # Период сброса изменённых user_data в базу (в секундах)
+    persistence_flush_interval: float = 5
+    # Рассылка: сообщений в секунду (Telegram допускает около 30 сообщений в секунду суммарно),
+    # одновременных отправок, пользователей в пачке, период обновления прогресса у админа (в секундах)
+    broadcast_rate: float = 25
+    broadcast_concurrency: int = 10
+    broadcast_batch_size: int = 200
+    broadcast_progress_interval: float = 5
+    # Очередь сообщений пересылки между пользователями и админами: сообщений в секунду
+    # и одновременных отправок (сообщения одного чата всё равно уходят по порядку)
+    outbox_rate: float = 20
+    outbox_concurrency: int = 8
+    # Аналитика: размер кольцевого буфера событий в памяти, период записи буфера в events
+    # и период пересчёта агрегатов (в секундах), сколько дней хранить сырые события
+    analytics_buffer_size: int = 10000
+    analytics_flush_interval: float = 5
+    analytics_rollup_interval: float = 60
+    analytics_keep_days: int = 30
+    # Хранение вопросов: через сколько дней без сообщений закрытый диалог переносится в архив
+    # (0 - не переносить), каталог архивов, период проверки (в секундах), вопросов в пачке
+    # и страниц, освобождаемых за один шаг incremental_vacuum
+    retention_days: int = 180
+    archive_dir: str = 'archive'
+    retention_interval: float = 3600
+    retention_batch_size: int = 200
+    vacuum_step_pages: int = 256
+    # Размер пачки строк при выгрузке пользователей
+    export_chunk_size: int = 5000
+    # Вопросов на странице входящих
+    inbox_page_size: int = 5
 
-TOKEN = os.getenv('TOKEN')
-ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
-
-# Создание структуры папок
-log_dir = "Log"
-archive_bot_dir = os.path.join(log_dir, "archive_bot_log")
-archive_critical_dir = os.path.join(log_dir, "archive_critical_errors")
+    @classmethod
+    def from_env(cls, load_env=True):
+        """Настройки из переменных окружения; при load_env=True сначала читается файл .env."""
+        if load_env:
+            load_dotenv()
+        defaults = cls()
+        env = os.getenv
+        return cls(
+            token=env('TOKEN', ''),
+            admin_ids=[int(id) for id in env('ADMIN_IDS', '').split(',') if id.strip()],
+            bot_mode=env('BOT_MODE', defaults.bot_mode).lower(),
+            webhook_listen=env('WEBHOOK_LISTEN', defaults.webhook_listen),
+            webhook_port=int(env('WEBHOOK_PORT', defaults.webhook_port)),
+            webhook_path=env('WEBHOOK_PATH', defaults.webhook_path),
+            webhook_url=env('WEBHOOK_URL', defaults.webhook_url),
+            webhook_secret=env('WEBHOOK_SECRET', defaults.webhook_secret),
+            webhook_max_connections=int(env('WEBHOOK_MAX_CONNECTIONS', defaults.webhook_max_connections)),
+            concurrent_updates=int(env('CONCURRENT_UPDATES', defaults.concurrent_updates)),
+            update_queue_depth=int(env('UPDATE_QUEUE_DEPTH', defaults.update_queue_depth)),
+            workers=int(env('WORKERS', defaults.workers)),
+            log_level=env('LOG_LEVEL', defaults.log_level).upper(),
+            log_dir=env('LOG_DIR', defaults.log_dir),
+            metrics_listen=env('METRICS_LISTEN', defaults.metrics_listen),
+            metrics_port=int(env('METRICS_PORT', defaults.metrics_port)),
+            db_path=env('DB_PATH', defaults.db_path),
+            db_pool_size=int(env('DB_POOL_SIZE', defaults.db_pool_size)),
+            db_statement_cache=int(env('DB_STATEMENT_CACHE', defaults.db_statement_cache)),
+            db_pragmas={
+                name: env(f'DB_{name.upper()}', value) for name, value in defaults.db_pragmas.items()
+            },
+            content_dir=env('CONTENT_DIR', defaults.content_dir),
+            content_refresh_interval=int(env('CONTENT_REFRESH_INTERVAL', defaults.content_refresh_interval)),
+            user_flush_interval=float(env('USER_FLUSH_INTERVAL', defaults.user_flush_interval)),
+            user_flush_batch=int(env('USER_FLUSH_BATCH', defaults.user_flush_batch)),
+            persistence_flush_interval=float(env('PERSISTENCE_FLUSH_INTERVAL', defaults.persistence_flush_interval)),
+            broadcast_rate=float(env('BROADCAST_RATE', defaults.broadcast_rate)),
+            broadcast_concurrency=int(env('BROADCAST_CONCURRENCY', defaults.broadcast_concurrency)),
+            broadcast_batch_size=int(env('BROADCAST_BATCH_SIZE', defaults.broadcast_batch_size)),
+            broadcast_progress_interval=float(env('BROADCAST_PROGRESS_INTERVAL', defaults.broadcast_progress_interval)),
+            outbox_rate=float(env('OUTBOX_RATE', defaults.outbox_rate)),
+            outbox_concurrency=int(env('OUTBOX_CONCURRENCY', defaults.outbox_concurrency)),
+            analytics_buffer_size=int(env('ANALYTICS_BUFFER_SIZE', defaults.analytics_buffer_size)),
+            analytics_flush_interval=float(env('ANALYTICS_FLUSH_INTERVAL', defaults.analytics_flush_interval)),
+            analytics_rollup_interval=float(env('ANALYTICS_ROLLUP_INTERVAL', defaults.analytics_rollup_interval)),
+            analytics_keep_days=int(env('ANALYTICS_KEEP_DAYS', defaults.analytics_keep_days)),
+            retention_days=int(env('RETENTION_DAYS', defaults.retention_days)),
+            archive_dir=env('ARCHIVE_DIR', defaults.archive_dir),
+            retention_interval=float(env('RETENTION_INTERVAL', defaults.retention_interval)),
+            retention_batch_size=int(env('RETENTION_BATCH_SIZE', defaults.retention_batch_size)),
+            vacuum_step_pages=int(env('VACUUM_STEP_PAGES', defaults.vacuum_step_pages)),
+            export_chunk_size=int(env('EXPORT_CHUNK_SIZE', defaults.export_chunk_size)),
+            inbox_page_size=int(env('INBOX_PAGE_SIZE', defaults.inbox_page_size)),
+        )
 
-os.makedirs(log_dir, exist_ok=True)
-os.makedirs(archive_bot_dir, exist_ok=True)
-os.makedirs(archive_critical_dir, exist_ok=True)
-os.makedirs('data/guides', exist_ok=True)  # Гарантируем наличие директории для файлов
+# Текущие настройки; заменяются в create_app()
+config = Config()
 
-# Настройка основного логгера
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+critical_logger = logging.getLogger('critical_logger')
+log_listeners = []
+# Ещё не остановленные потоки логирования: stop_logging() останавливает каждый ровно один раз
+running_log_listeners = []
 
-# Формат логов
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+def archive_namer(destination):
+    """namer для TimedRotatingFileHandler: архивные логи перемещаются в папку destination."""
+    def namer(default_name):
+        archive_logs(default_name, destination)
+        return default_name
+    return namer
 
-# Обработчик для консоли
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+def setup_logging(app_config):
+    """Настройка логирования при запуске (повторный вызов ничего не делает).
 
-# Обработчик для bot.log с ротацией по дням
-bot_log_file = os.path.join(log_dir, "bot.log")
-bot_handler = TimedRotatingFileHandler(
-    bot_log_file, when='midnight', interval=1, backupCount=30, encoding='utf-8'
-)
-bot_handler.setFormatter(formatter)
-logger.addHandler(bot_handler)
+    Запись в консоль и файлы (включая ротацию) идёт в фоновых потоках QueueListener,
+    обработчики бота только ставят запись в очередь.
+    """
+    if log_listeners:
+        return
+    logger.setLevel(app_config.log_level)
+    critical_logger.setLevel(logging.CRITICAL)
 
-# Обработчик для critical_errors.log с ротацией по дням
-critical_log_file = os.path.join(log_dir, "critical_errors.log")
-critical_handler = TimedRotatingFileHandler(
-    critical_log_file, when='midnight', interval=1, backupCount=30, encoding='utf-8'
-)
-critical_handler.setFormatter(formatter)
+    # Формат логов
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# Настройка логгера для критических ошибок
-critical_logger = logging.getLogger('critical_logger')
-critical_logger.setLevel(logging.CRITICAL)
-critical_logger.addHandler(critical_handler)
+    # Обработчик для консоли
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    handlers, critical_handlers = [console_handler], []
 
-# Создание экземпляра приложения
-application = Application.builder().token(TOKEN).build()
+    if app_config.log_dir:
+        # Создание структуры папок
+        archive_bot_dir = os.path.join(app_config.log_dir, "archive_bot_log")
+        archive_critical_dir = os.path.join(app_config.log_dir, "archive_critical_errors")
+        os.makedirs(archive_bot_dir, exist_ok=True)
+        os.makedirs(archive_critical_dir, exist_ok=True)
 
-def get_db_connection():
-    """Создание соединения с базой данных."""
-    try:
-        conn = sqlite3.connect('bot.db')
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           user_id INTEGER UNIQUE)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS guides
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           title TEXT UNIQUE,
-                           content TEXT)''')
-        # Добавляем таблицы для системы вопросов
-        cursor.execute('''CREATE TABLE IF NOT EXISTS questions
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           user_id INTEGER NOT NULL,
-                           question_text TEXT NOT NULL,
-                           status TEXT DEFAULT 'open',
-                           admin_id INTEGER,
-                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS question_messages
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           question_id INTEGER NOT NULL,
-                           sender_id INTEGER NOT NULL,
-                           message_text TEXT NOT NULL,
-                           sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        conn.commit()
-        logger.info("Соединение с базой данных успешно установлено.")
-        return conn, cursor
-    except Exception as e:
-        logger.error(f"Ошибка при подключении к базе данных: {e}")
-        critical_logger.critical(f"Критическая ошибка при подключении к базе данных: {e}", exc_info=True)
-        raise
+        # Обработчик для bot.log с ротацией по дням
+        bot_handler = TimedRotatingFileHandler(
+            os.path.join(app_config.log_dir, "bot.log"), when='midnight', interval=1, backupCount=30, encoding='utf-8'
+        )
+        bot_handler.setFormatter(formatter)
+        bot_handler.namer = archive_namer(archive_bot_dir)
+        handlers.append(bot_handler)
 
-def load_text(file_path):
-    """Загрузка текста из файла с обработкой ошибок."""
-    try:
-        absolute_path = os.path.abspath(file_path)  # Используем абсолютный путь
-        logger.info(f"Попытка загрузить файл: {absolute_path}")
-        if os.path.exists(absolute_path):
-            with open(absolute_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                logger.info(f"Файл {absolute_path} успешно загружен. Содержимое: {content[:50]}...")
-                return content
-        logger.warning(f"Файл {absolute_path} не найден.")
-        return "Файл не найден."
-    except Exception as e:
-        logger.error(f"Ошибка при чтении файла {absolute_path}: {e}")
-        critical_logger.critical(f"Критическая ошибка при чтении файла {absolute_path}: {e}", exc_info=True)
-        return "Произошла ошибка при чтении файла."
+        # Обработчик для critical_errors.log с ротацией по дням
+        critical_handler = TimedRotatingFileHandler(
+            os.path.join(app_config.log_dir, "critical_errors.log"), when='midnight', interval=1, backupCount=30,
+            encoding='utf-8'
+        )
+        critical_handler.setFormatter(formatter)
+        critical_handler.namer = archive_namer(archive_critical_dir)
+        critical_handlers.append(critical_handler)
 
-def save_user_id(user_id, cursor, conn):
-    """Сохранение ID пользователя в базу данных."""
-    try:
-        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
-        logger.info(f"ID пользователя {user_id} сохранен.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении ID пользователя {user_id}: {e}")
+    for target, target_handlers in ((logger, handlers), (critical_logger, critical_handlers)):
+        log_queue = queue.Queue(-1)
+        target.addHandler(QueueHandler(log_queue))
+        listener = QueueListener(log_queue, *target_handlers, respect_handler_level=True)
+        listener.start()
+        log_listeners.append(listener)
+        running_log_listeners.append(listener)
+    atexit.register(stop_logging)
 
-def create_reply_markup(keyboard):
-    """Создание клавиатуры."""
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False, selective=False)
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает потоки логирования."""
+    while running_log_listeners:
+        running_log_listeners.pop(0).stop()
 
-# Оптимизация клавиатур для постоянного отображения
-main_keyboard = [["ATS", "ETS 2"], ["Задать вопрос"]]
-game_keyboard = [["Гайды", "Моды"], ["Обзор актуального патча", "Социальные сети"], ["Назад"]]
-ets_game_keyboard = [["Гайды", "Моды"], ["Обзор актуального патча", "Социальные сети"], ["Сборки карт"], ["Назад"]]
-map_packs_keyboard = [["Золотая сборка Русских карт"], ["Назад"]]
-admin_keyboard = [
-    ["Статистика", "Выгрузить ID пользователей"],
-    ["Рассылка", "Вопросы"],
-    ["Главное меню"]
-]
-guides_keyboard = [
-    ["Гайд для новичка"],
-    ["Включить консоль и свободную камеру"],
-    ["Консольные команды"],
-    ["Конвой на 8+ человек"],
-    ["Своё радио для ETS2 и ATS"],
-    ["Настройка OCULUS QUEST 2/3 для ATS и ETS2"],
-    ["Назад"]
+# Границы корзин гистограмм задержек, в секундах
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """Счётчики, gauge и гистограммы с метками; потокобезопасны (пишутся и из потоков БД)."""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def collector(self, name, callback):
+        """callback() вызывается перед каждой выдачей метрик и обновляет gauge (повторная регистрация заменяет)."""
+        self._collectors[name] = callback
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Счётчики по корзинам (последняя - +Inf), сумма и количество
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = 0
+            while index < len(self.buckets) and seconds > self.buckets[index]:
+                index += 1
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def histograms(self, name):
+        """Снимок гистограмм метрики: {метки: (корзины, сумма, количество)}."""
+        with self._lock:
+            return {
+                labels: (list(buckets), total, count)
+                for (metric, labels), (buckets, total, count) in self._histograms.items() if metric == name
+            }
+
+    def counters(self, name):
+        with self._lock:
+            return {labels: value for (metric, labels), value in self._counters.items() if metric == name}
+
+    def quantile(self, buckets, q):
+        """Оценка квантиля по корзинам гистограммы (верхняя граница корзины)."""
+        count = sum(buckets)
+        if not count:
+            return 0.0
+        running = 0
+        for index, bucket in enumerate(buckets):
+            running += bucket
+            if running >= q * count:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ''
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus."""
+        for callback in list(self._collectors.values()):
+            callback()
+        # Серии группируются по имени метрики: {имя: [(метки, строки)]}
+        series = {}
+        with self._lock:
+            for (name, labels), value in [*self._counters.items(), *self._gauges.items()]:
+                series.setdefault(name, []).append((labels, [f"{name}{self._labels(labels)} {value}"]))
+            for (name, labels), (buckets, total, count) in self._histograms.items():
+                lines = []
+                running = 0
+                for bound, bucket in zip((*self.buckets, '+Inf'), buckets):
+                    running += bucket
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {running}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+                series.setdefault(name, []).append((labels, lines))
+        output = []
+        for name in sorted(series):
+            if name in self._help:
+                kind, text = self._help[name]
+                output.append(f"# HELP {name} {text}")
+                output.append(f"# TYPE {name} {kind}")
+            for _, lines in sorted(series[name], key=lambda item: item[0]):
+                output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Время обработки обновления обработчиком')
+metrics.describe('bot_handler_errors_total', 'counter', 'Исключения, вышедшие из обработчика')
+metrics.describe('bot_handler_in_flight', 'gauge', 'Обработчики, выполняющиеся сейчас')
+metrics.describe('bot_update_queue_depth', 'gauge',
+                 'Принятые обновления: ждут приёма (pending), очереди пользователя (waiting), в обработке (running)')
+metrics.describe('bot_update_ordered_keys', 'gauge', 'Пользователи и чаты с обновлениями в обработке')
+metrics.describe('bot_db_query_seconds', 'histogram', 'Время выполнения операции с БД в потоке')
+metrics.describe('bot_db_wait_seconds', 'histogram', 'Ожидание свободного потока БД')
+metrics.describe('bot_db_errors_total', 'counter', 'Ошибки операций с БД')
+metrics.describe('bot_api_request_seconds', 'histogram', 'Время запроса к Telegram Bot API')
+metrics.describe('bot_api_errors_total', 'counter', 'Ошибки запросов к Telegram Bot API')
+metrics.describe('bot_api_retry_after_total', 'counter', 'Ответы RetryAfter (превышение лимитов Telegram)')
+metrics.describe('bot_api_retry_after_seconds_total', 'counter', 'Суммарная пауза, запрошенная RetryAfter')
+
+def instrument_handler(callback):
+    """Обёртка обработчика: время, ошибки и число одновременно выполняющихся вызовов."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        metrics.add('bot_handler_in_flight', 1, handler=name)
+        try:
+            with metrics.timer('bot_handler_seconds', handler=name):
+                return await callback(update, context)
+        except Exception as e:
+            metrics.inc('bot_handler_errors_total', handler=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.add('bot_handler_in_flight', -1, handler=name)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером времени запросов к Bot API и учётом RetryAfter."""
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        try:
+            with metrics.timer('bot_api_request_seconds', method=method):
+                return await super().post(url, *args, **kwargs)
+        except RetryAfter as e:
+            metrics.inc('bot_api_retry_after_total', method=method)
+            metrics.inc('bot_api_retry_after_seconds_total', e.retry_after, method=method)
+            raise
+        except Exception as e:
+            metrics.inc('bot_api_errors_total', method=method, error=type(e).__name__)
+            raise
+
+# Миграции схемы: (версия, описание, запросы). Текущая версия хранится в PRAGMA user_version,
+# при запуске применяются только миграции с большей версией. Новые миграции добавляются в конец.
+DB_MIGRATIONS = [
+    (1, "базовые таблицы", [
+        '''CREATE TABLE IF NOT EXISTS users
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE)''',
+        '''CREATE TABLE IF NOT EXISTS guides
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT UNIQUE,
+            content TEXT)''',
+        # Таблицы для системы вопросов
+        '''CREATE TABLE IF NOT EXISTS questions
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            question_text TEXT NOT NULL,
+            status TEXT DEFAULT 'open',
+            admin_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS question_messages
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    # Рассылки и их прогресс (курсор по users.id) для продолжения после перезапуска
+    (2, "рассылки", [
+        '''CREATE TABLE IF NOT EXISTS broadcasts
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            message_text TEXT,
+            photo TEXT,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            last_user_row INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    # Состояние меню и диалогов пользователей (context.user_data) между перезапусками
+    (3, "состояние пользователей", [
+        '''CREATE TABLE IF NOT EXISTS user_state
+           (user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    # Индексы под запросы системы вопросов: последний вопрос пользователя, активный диалог,
+    # список незакрытых вопросов и переписка по вопросу
+    (4, "индексы системы вопросов", [
+        "CREATE INDEX IF NOT EXISTS idx_questions_user_created ON questions (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_questions_status ON questions (status)",
+        "CREATE INDEX IF NOT EXISTS idx_question_messages_question_sent ON question_messages (question_id, sent_at)",
+    ]),
+    # Дата регистрации пользователя для выгрузки с фильтром по датам. У существующих записей
+    # остаётся NULL: SQLite не позволяет добавить столбец со значением по умолчанию CURRENT_TIMESTAMP
+    (5, "дата регистрации пользователей", [
+        "ALTER TABLE users ADD COLUMN created_at TIMESTAMP",
+    ]),
+    # file_id загруженных в Telegram медиафайлов по хэшу содержимого
+    (6, "кэш медиафайлов", [
+        '''CREATE TABLE IF NOT EXISTS media_files
+           (content_hash TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_name TEXT,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (content_hash, kind))''',
+    ]),
+    # Полнотекстовый поиск по страницам меню. Таблица guides не использовалась с первой версии
+    (7, "поиск по контенту", [
+        "DROP TABLE IF EXISTS guides",
+        '''CREATE TABLE IF NOT EXISTS content_documents
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            section TEXT,
+            content_hash TEXT NOT NULL,
+            indexed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        # rowid совпадает с content_documents.id; префиксные индексы ускоряют поиск по началу слова
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS content_fts USING fts5
+           (title, section, body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+    ]),
+    # Исходящие сообщения пересылки: пишутся в одной транзакции с изменением, которое их вызвало,
+    # и доставляются фоновыми отправителями. Время - в секундах Unix
+    (8, "очередь исходящих сообщений", [
+        '''CREATE TABLE IF NOT EXISTS outbox
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            enqueued_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            sent_at REAL)''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (id) WHERE status = 'pending'",
+    ]),
+    # Аналитика: журнал событий только на добавление и агрегаты по дням (местное время).
+    # name и game - пустая строка, если не заданы: NULL в первичном ключе не считается совпадением
+    (9, "аналитика", [
+        '''CREATE TABLE IF NOT EXISTS events
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at REAL NOT NULL,
+            user_id INTEGER,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL DEFAULT '',
+            game TEXT NOT NULL DEFAULT '',
+            value REAL)''',
+        "CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at)",
+        '''CREATE TABLE IF NOT EXISTS stats_daily
+           (day TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            game TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            value_sum REAL NOT NULL,
+            PRIMARY KEY (day, kind, name, game)) WITHOUT ROWID''',
+        # Уникальные пользователи дня для DAU (сумма по часам для уникальных не подходит)
+        '''CREATE TABLE IF NOT EXISTS stats_daily_users
+           (day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS stats_days
+           (day TEXT PRIMARY KEY,
+            active_users INTEGER NOT NULL)''',
+        # Последнее учтённое в агрегатах событие
+        '''CREATE TABLE IF NOT EXISTS stats_state
+           (name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL)''',
+    ]),
+    # Файл архива (archive_dir) для каждого перенесённого из questions/question_messages диалога
+    (10, "архив вопросов", [
+        '''CREATE TABLE IF NOT EXISTS question_archive
+           (question_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            archive TEXT NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    # Первое недоставленное сообщение каждого чата (MIN(id) ... GROUP BY chat_id) берётся из индекса
+    (11, "индекс outbox по чатам", [
+        "DROP INDEX IF EXISTS idx_outbox_pending",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox (status, chat_id, id)",
+    ]),
+    # Число пользователей поддерживается при добавлении и удалении, чтобы не считать COUNT(*) по users.
+    # stats_hourly из ранних версий миграции 9 никто не читал
+    (12, "счётчик пользователей", [
+        '''CREATE TABLE IF NOT EXISTS counters
+           (name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL)''',
+        "INSERT OR REPLACE INTO counters (name, value) SELECT 'users', COUNT(*) FROM users",
+        "DROP TABLE IF EXISTS stats_hourly",
+    ]),
 ]
-mods_keyboard = [["Таблица модов", "Талисман 'Шмилфа' в кабину"], ["Иммерсивные моды"], ["Назад"]]
-back_keyboard = [["Назад"]]
 
-async def main_menu(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        conn, cursor = get_db_connection()
-        save_user_id(user.id, cursor, conn)
-        conn.close()
-        logger.info(f"Отображение главного меню для пользователя {user.id}")
-        keyboard = main_keyboard.copy()
-        if user.id in ADMIN_IDS:
-            keyboard.append(["Админ"])
-        reply_markup = create_reply_markup(keyboard)
-        await update.message.reply_text("Выберите игру :", reply_markup=reply_markup)
-        context.user_data['previous_menu'] = 'start_menu'
-        context.user_data['current_menu'] = 'main_menu'
-    else:
-        logger.info(f"Бот {user.id} пытается получить доступ к главному меню.")
-        await update.message.reply_text("Извините, боты не могут использовать этот бот.")
+def apply_migrations(conn, target=None):
+    """Применение миграций до версии target (по умолчанию до последней). Каждая миграция - отдельная транзакция."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for migration_version, description, statements in DB_MIGRATIONS:
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {migration_version}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        version = migration_version
+        logger.info("Применена миграция %s: %s", migration_version, description)
+    return version
 
-async def admin_menu(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if user.id in ADMIN_IDS:
-        reply_markup = create_reply_markup(admin_keyboard)
-        await update.message.reply_text("Административное меню:", reply_markup=reply_markup)
-        context.user_data['previous_menu'] = 'main_menu'
-        context.user_data['current_menu'] = 'admin_menu'
-    else:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
-        await go_back(update, context)
+class Database:
+    """Долгоживущий пул соединений SQLite: одно соединение-писатель и несколько читателей.
 
-async def show_mods(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        reply_markup = create_reply_markup(mods_keyboard)
-        await update.message.reply_text("Выберите опцию:", reply_markup=reply_markup)
-        context.user_data['previous_menu'] = context.user_data.get('current_menu', 'game_menu')
-        context.user_data['current_menu'] = 'mods'
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+    Асинхронные методы (read/write/fetchone/...) выполняют запросы в отдельных потоках,
+    чтобы fsync и блокировки SQLite не останавливали цикл событий бота.
+    """
 
-async def show_mods_table(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        mods_table_text = load_text('data/mods/mods_table.md')
-        await update.message.reply_text(mods_table_text, parse_mode='Markdown')
-        context.user_data['previous_menu'] = 'mods'
-        context.user_data['current_menu'] = 'mods_table'
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+    def __init__(self, path, pool_size=4, pragmas=None, cached_statements=128):
+        self.path = path
+        self.pool_size = max(1, pool_size)
+        self.pragmas = pragmas or {}
+        self.cached_statements = cached_statements
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = queue.Queue()
+        self._write_executor = None
+        self._read_executor = None
 
-async def show_schmilfa_in_cabin(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        selected_game = context.user_data.get('selected_game', 'ATS')  # По умолчанию ATS
-        schmilfa_file = f'data/mods/schmilfa_in_cabin_{selected_game.lower()}.md'  # Изменяем расширение на .md
-        schmilfa_text = load_text(schmilfa_file)
-        reply_markup = create_reply_markup(back_keyboard)
-        await update.message.reply_text(schmilfa_text, reply_markup=reply_markup, parse_mode='Markdown')  # Указываем parse_mode
-        context.user_data['previous_menu'] = 'mods'
-        context.user_data['current_menu'] = 'schmilfa_in_cabin'
+    def _connect(self):
+        """Открытие соединения с применением PRAGMA и кэшем подготовленных выражений."""
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        for name, value in self.pragmas.items():
+            if value:
+                conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def open(self):
+        """Открытие пула и однократное применение миграций схемы."""
+        try:
+            self._writer = self._connect()
+            apply_migrations(self._writer)
+            for _ in range(self.pool_size):
+                self._readers.put(self._connect())
+            # Один поток-писатель сериализует транзакции, читатели работают параллельно
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+            self._read_executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='db-reader')
+            logger.info("База данных %s открыта, читателей в пуле: %s.", self.path, self.pool_size)
+        except Exception as e:
+            logger.error("Ошибка при подключении к базе данных: %s", e)
+            critical_logger.critical("Критическая ошибка при подключении к базе данных: %s", e, exc_info=True)
+            raise
+
+    @contextmanager
+    def writer(self):
+        """Соединение для записи; транзакция фиксируется при выходе из блока.
+
+        BEGIN IMMEDIATE берёт блокировку записи сразу, поэтому чтения внутри транзакции видят
+        согласованное состояние и при нескольких процессах (WORKERS) - иначе sqlite3 начинает
+        транзакцию только с первого изменения, а предшествующие SELECT выполняются вне её.
+        """
+        with self._writer_lock:
+            try:
+                self._writer.execute("BEGIN IMMEDIATE")
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """Соединение только для чтения из пула."""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @staticmethod
+    def _measured(mode, connection, func, args, submitted):
+        """Выполнение func с записью метрик: ожидание потока/соединения и время самой операции."""
+        operation = getattr(func, 'func', func).__name__
+        acquired = None
+        try:
+            with connection() as conn:
+                acquired = time.perf_counter()
+                metrics.observe('bot_db_wait_seconds', acquired - submitted, mode=mode)
+                return func(conn, *args)
+        except Exception as e:
+            metrics.inc('bot_db_errors_total', mode=mode, operation=operation, error=type(e).__name__)
+            raise
+        finally:
+            # Для записи время включает commit
+            if acquired is not None:
+                metrics.observe('bot_db_query_seconds', time.perf_counter() - acquired, mode=mode, operation=operation)
+
+    def _run_write(self, func, args, submitted):
+        return self._measured('write', self.writer, func, args, submitted)
+
+    def _run_read(self, func, args, submitted):
+        return self._measured('read', self.reader, func, args, submitted)
+
+    async def write(self, func, *args):
+        """Выполнение func(conn, *args) в одной транзакции в потоке-писателе."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor, self._run_write, func, args, time.perf_counter())
+
+    async def read(self, func, *args):
+        """Выполнение func(conn, *args) на соединении-читателе в пуле потоков."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._run_read, func, args, time.perf_counter())
+
+    def _enable_incremental_vacuum(self):
+        with self._writer_lock:
+            self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._writer.execute("VACUUM")
+
+    async def enable_incremental_vacuum(self):
+        """Перевод существующей базы в режим auto_vacuum=INCREMENTAL.
+
+        Режим меняется только полной перестройкой файла (VACUUM вне транзакции), которая
+        на всё время блокирует запись, поэтому запускается только явно (Retention.enable_incremental).
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._write_executor, self._enable_incremental_vacuum)
+
+    async def execute(self, sql, params=()):
+        """Выполнение одного изменяющего запроса, возвращает lastrowid."""
+        return await self.write(_execute, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(_fetchall, sql, params)
+
+    @property
+    def is_open(self):
+        return self._writer is not None
+
+    def close(self):
+        """Закрытие всех соединений пула."""
+        for executor in (self._write_executor, self._read_executor):
+            if executor:
+                executor.shutdown(wait=True)
+        self._write_executor = self._read_executor = None
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        logger.info("Соединение с базой данных закрыто.")
+
+# Запросы общего назначения; отдельные функции, чтобы в метриках операция имела имя
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+# Подсистемы создаются в create_app() по настройкам, соединения открываются при прогреве
+db = None
+
+# Запросы системы вопросов; выполняются через db.write() в потоке-писателе
+
+def _insert_question(conn, user_id, question_text):
+    cursor = conn.execute(
+        "INSERT INTO questions (user_id, question_text, status) VALUES (?, ?, 'open')",
+        (user_id, question_text)
+    )
+    return cursor.lastrowid
+
+def _insert_question_message(conn, question_id, sender_id, message_text):
+    conn.execute(
+        "INSERT INTO question_messages (question_id, sender_id, message_text) VALUES (?, ?, ?)",
+        (question_id, sender_id, message_text)
+    )
+
+def _take_question(conn, question_id, admin_id):
+    """Переводит вопрос в работу. Возвращает (user_id, question_text, секунд с момента вопроса) или None."""
+    question = conn.execute(
+        "SELECT user_id, question_text, (julianday('now') - julianday(created_at)) * 86400 "
+        "FROM questions WHERE id = ?",
+        (question_id,)
+    ).fetchone()
+    if question:
+        conn.execute(
+            "UPDATE questions SET status = 'in_progress', admin_id = ? WHERE id = ?",
+            (admin_id, question_id)
+        )
+    return question
+
+def _close_question(conn, question_id):
+    """Закрывает вопрос. Возвращает user_id автора или None."""
+    conn.execute("UPDATE questions SET status = 'closed' WHERE id = ?", (question_id,))
+    result = conn.execute("SELECT user_id FROM questions WHERE id = ?", (question_id,)).fetchone()
+    return result[0] if result else None
+
+# Изменения вопросов вместе с уведомлениями для outbox: (результат, [(chat_id, текст, reply_markup)])
+def _insert_question_for_admins(conn, user_id, author, question_text, admin_ids):
+    question_id = _insert_question(conn, user_id, question_text)
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Ответить", callback_data=f"answer_{question_id}")],
+        [InlineKeyboardButton("Закрыть", callback_data=f"close_{question_id}")]
+    ])
+    text = f"📩 Новый вопрос #{question_id} от @{author}:\n\n{question_text}"
+    return question_id, [(admin_id, text, reply_markup) for admin_id in admin_ids]
+
+def _relay_question_message(conn, question_id, sender_id, message_text, chat_id, relay_text):
+    _insert_question_message(conn, question_id, sender_id, message_text)
+    return None, [(chat_id, relay_text, None)]
+
+def _take_question_for_user(conn, question_id, admin_id):
+    question = _take_question(conn, question_id, admin_id)
+    if not question:
+        return None, []
+    user_id, question_text, _ = question
+    text = (
+        "🛎 Администратор начал работу по вашему вопросу!\n\n"
+        f"Ваш вопрос: {question_text}\n\n"
+        "Теперь вы можете общаться напрямую. Чтобы завершить диалог, отправьте /end_dialog"
+    )
+    return question, [(user_id, text, None)]
+
+def _close_question_with_notice(conn, question_id, text, reply_markup=None, chat_id=None):
+    """Закрытие вопроса с уведомлением chat_id (по умолчанию - автора вопроса)."""
+    user_id = _close_question(conn, question_id)
+    if not user_id:
+        return None, []
+    return user_id, [(chat_id or user_id, text, reply_markup)]
+
+def _load_active_dialogs(conn):
+    """Все незакрытые вопросы: (id, user_id, admin_id, status)."""
+    return conn.execute(
+        "SELECT id, user_id, admin_id, status FROM questions WHERE status IN ('open', 'in_progress')"
+    ).fetchall()
+
+class DialogIndex:
+    """Индекс незакрытых вопросов в памяти: question_id -> [user_id, admin_id].
+
+    admin_id равен None, пока вопрос не взят в работу. В индексе каждый незакрытый вопрос,
+    а не только последний вопрос пользователя: новый вопрос не прерывает идущий диалог,
+    и админ может взять в работу более ранний вопрос - как и в БД. Индекс обновляется только
+    после успешной записи в БД, поэтому решение о пересылке сообщения не требует запросов
+    к SQLite. Изменения относятся к отдельным question_id, так что порядок завершения
+    параллельных записей по разным вопросам не важен.
+    """
+
+    def __init__(self):
+        self._questions = {}
+        self._by_user = {}
+
+    async def load(self, database):
+        rows = await database.read(_load_active_dialogs)
+        self._questions.clear()
+        self._by_user.clear()
+        for question_id, user_id, admin_id, status in rows:
+            self._open(user_id, question_id)
+            if status == 'in_progress':
+                self._take(user_id, question_id, admin_id)
+        logger.info("Загружено незакрытых вопросов: %s", len(self._questions))
+
+    def open(self, user_id, question_id):
+        """Новый вопрос пользователя."""
+        self._open(user_id, question_id)
+        share('dialog', 'open', user_id, question_id)
+
+    def take(self, user_id, question_id, admin_id):
+        """Вопрос взят в работу администратором."""
+        self._take(user_id, question_id, admin_id)
+        share('dialog', 'take', user_id, question_id, admin_id)
+
+    def close(self, question_id):
+        self._close(question_id)
+        share('dialog', 'close', question_id)
+
+    def apply(self, operation, *args):
+        """Изменение, сделанное другим процессом-обработчиком (режим WORKERS)."""
+        getattr(self, '_' + operation)(*args)
+
+    def _open(self, user_id, question_id):
+        # Взятие в работу могло быть применено раньше (события от другого обработчика)
+        self._questions.setdefault(question_id, [user_id, None])
+        self._by_user.setdefault(user_id, set()).add(question_id)
+
+    def _take(self, user_id, question_id, admin_id):
+        self._questions[question_id] = [user_id, admin_id]
+        self._by_user.setdefault(user_id, set()).add(question_id)
+
+    def _close(self, question_id):
+        entry = self._questions.pop(question_id, None)
+        if entry is None:
+            return
+        questions = self._by_user.get(entry[0])
+        if questions is not None:
+            questions.discard(question_id)
+            if not questions:
+                del self._by_user[entry[0]]
+
+    def for_user(self, user_id):
+        """(question_id, admin_id) последнего взятого в работу вопроса пользователя,
+        а если таких нет - последнего открытого; None, если незакрытых вопросов нет."""
+        questions = [(question_id, self._questions[question_id][1]) for question_id in self._by_user.get(user_id, ())]
+        taken = [question for question in questions if question[1] is not None]
+        return max(taken or questions, default=None)
+
+    def user_for(self, question_id):
+        """user_id автора вопроса, если диалог по нему сейчас идёт, иначе None."""
+        entry = self._questions.get(question_id)
+        if entry is not None and entry[1] is not None:
+            return entry[0]
+        return None
+
+    def __len__(self):
+        return len(self._questions)
+
+dialogs = DialogIndex()
+
+# Ограничение Telegram на длину сообщения (в единицах UTF-16 после разбора разметки)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+class MarkdownError(ValueError):
+    pass
+
+# Сущности Markdown (legacy) Telegram: маркер -> HTML-тег
+MARKDOWN_ENTITIES = {'*': 'b', '_': 'i', '`': 'code'}
+
+def _match_link(text, start):
+    """Ссылка [текст](url) с позиции start: (текст, url, конец) или None.
+
+    Скобки в адресе учитываются парами (https://ru.wikipedia.org/wiki/Лада_(автомобиль));
+    если пары не сходятся, адрес заканчивается на первой закрывающей скобке.
+    """
+    label_end = text.find(']', start + 1)
+    if label_end == -1 or not text.startswith('(', label_end + 1):
+        return None
+    url_start = label_end + 2
+    depth = 1
+    first_close = None
+    position = url_start
+    while position < len(text) and not text[position].isspace():
+        char = text[position]
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if first_close is None:
+                first_close = position
+            if not depth:
+                break
+        position += 1
     else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+        position = first_close
+    if position is None or position == url_start:
+        return None
+    return text[start + 1:label_end], text[url_start:position], position + 1
 
-async def show_immersive_mods(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        selected_game = context.user_data.get('selected_game', 'ATS')  # По умолчанию ATS
-        immersive_file = f'data/mods/immersive_mods_{selected_game.lower()}.md'
-        immersive_text = load_text(immersive_file)
-        reply_markup = create_reply_markup(back_keyboard)
-        await update.message.reply_text(immersive_text, reply_markup=reply_markup, parse_mode='Markdown')
-        context.user_data['previous_menu'] = 'mods'
-        context.user_data['current_menu'] = 'immersive_mods'
-
-async def show_guides(update: Update, context: CallbackContext) -> None:
+def parse_markdown(text):
+    """Разбор Markdown в формате Telegram (parse_mode='Markdown') на сущности.
+
+    Возвращает список (тег, url, текст); для обычного текста тег равен None.
+    Как и в Telegram, сущности не вкладываются друг в друга. Бросает MarkdownError
+    там, где Telegram отклонил бы сообщение.
+    """
+    pieces = []
+    plain = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == '\\' and i + 1 < len(text) and text[i + 1] in '*_`[':
+            plain.append(text[i + 1])
+            i += 2
+            continue
+        if char not in '*_`[':
+            plain.append(char)
+            i += 1
+            continue
+        if plain:
+            pieces.append((None, None, ''.join(plain)))
+            plain = []
+        if text.startswith('```', i):
+            end = text.find('```', i + 3)
+            if end == -1:
+                raise MarkdownError(f"не закрыт блок кода (позиция {i})")
+            body = text[i + 3:end]
+            # Первая строка блока - язык, как в Telegram
+            first_line, newline, rest = body.partition('\n')
+            if newline and first_line and ' ' not in first_line:
+                body = rest
+            pieces.append(('pre', None, body))
+            i = end + 3
+        elif char == '[':
+            link = _match_link(text, i)
+            if not link:
+                raise MarkdownError(f"некорректная ссылка (позиция {i})")
+            label, url, i = link
+            pieces.append(('a', url, label))
+        else:
+            end = text.find(char, i + 1)
+            if end == -1:
+                raise MarkdownError(f"не закрыт символ {char} (позиция {i})")
+            pieces.append((MARKDOWN_ENTITIES[char], None, text[i + 1:end]))
+            i = end + 1
+    if plain:
+        pieces.append((None, None, ''.join(plain)))
+    return [piece for piece in pieces if piece[2]]
+
+def _utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def _split_long_line(text, limit):
+    """Разбиение строки длиннее limit по пробелам, в крайнем случае - жёстко."""
+    parts = []
+    while _utf16_length(text) > limit:
+        cut = limit
+        while _utf16_length(text[:cut]) > limit:
+            cut -= 1
+        space = text.rfind(' ', 0, cut)
+        if space > cut // 2:
+            cut = space + 1
+        parts.append(text[:cut])
+        text = text[cut:]
+    parts.append(text)
+    return parts
+
+def _render_html(units):
+    """Сборка HTML из кусков (номер сущности, тег, url, текст); соседние куски одной сущности объединяются."""
+    output = []
+    index = 0
+    while index < len(units):
+        entity, tag, url, _ = units[index]
+        text = []
+        while index < len(units) and units[index][0] == entity:
+            text.append(units[index][3])
+            index += 1
+        body = html.escape(''.join(text), quote=False)
+        if tag is None:
+            output.append(body)
+        elif tag == 'a':
+            output.append(f'<a href="{html.escape(url)}">{body}</a>')
+        else:
+            output.append(f'<{tag}>{body}</{tag}>')
+    return ''.join(output)
+
+def _cut_position(units, limit):
+    """Где резать накопленные куски: по пустой строке во второй половине сообщения, иначе по последней строке."""
+    lengths = [_utf16_length(unit[3]) for unit in units]
+    line_cut = None
+    for position in range(len(units) - 1, 0, -1):
+        if not units[position - 1][3].endswith('\n'):
+            continue
+        if line_cut is None:
+            line_cut = position
+        if units[position - 1][3] == '\n' and sum(lengths[:position]) > limit // 2:
+            return position
+    return line_cut or len(units)
+
+def split_message(pieces, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Разбиение сущностей на сообщения с текстом не длиннее limit.
+
+    Сообщения режутся по границам абзацев, затем строк, затем слов; каждая часть
+    сущности оборачивается в свой тег, поэтому разметка в каждом сообщении корректна.
+    """
+    units = []
+    for entity, (tag, url, text) in enumerate(pieces):
+        for line in re.split(r'(?<=\n)', text):
+            for part in _split_long_line(line, limit):
+                if part:
+                    units.append((entity, tag, url, part))
+
+    chunks = []
+    current = []
+    length = 0
+    for unit in units:
+        unit_length = _utf16_length(unit[3])
+        while current and length + unit_length > limit:
+            cut = _cut_position(current, limit)
+            chunks.append(current[:cut])
+            current = current[cut:]
+            length = sum(_utf16_length(u[3]) for u in current)
+        current.append(unit)
+        length += unit_length
+    if current:
+        chunks.append(current)
+    return [_render_html(chunk).strip() for chunk in chunks if ''.join(u[3] for u in chunk).strip()]
+
+def compile_markdown(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Markdown -> список HTML-сообщений для отправки с parse_mode='HTML'."""
+    return split_message(parse_markdown(text), limit)
+
+def markdown_to_text(text):
+    """Markdown -> текст без разметки (для поискового индекса)."""
+    try:
+        return ''.join(piece for _, _, piece in parse_markdown(text))
+    except MarkdownError:
+        return text
+
+class ContentStore:
+    """Кэш всех файлов из каталога root в памяти; файл перечитывается только при изменении mtime/inode/размера.
+
+    Страницы адресуются путём относительно root (guides/radio.md), поэтому меню не зависит
+    от настройки content_dir. При загрузке файл сразу компилируется в готовые HTML-сообщения
+    (compile_markdown), обработчики отправляют их без какой-либо обработки. Медиафайлы страницы
+    лежат в каталоге с тем же именем (mods/x/ для mods/x.md); для них считается хэш содержимого.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._texts = {}
+        self._messages = {}
+        self._signatures = {}
+        self._media = {}
+        self._media_hashes = {}
+        self.errors = {}
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _compile(self, path, text):
+        try:
+            self._messages[path] = compile_markdown(text)
+            self.errors.pop(path, None)
+        except MarkdownError as e:
+            # Отправляем как обычный текст, чтобы страница работала до исправления файла
+            logger.warning("Ошибка разметки в файле %s: %s", path, e)
+            self._messages[path] = split_message([(None, None, text)])
+            self.errors[path] = str(e)
+
+    @staticmethod
+    def _signature(stat):
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """Проход по каталогу с контентом: загрузка новых и изменённых файлов, удаление пропавших."""
+        seen = set()
+        media = {}
+        media_hashes = {}
+        changed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if not filename.endswith('.md'):
+                    try:
+                        signature = self._signature(os.stat(path))
+                        cached = self._media_hashes.get(path)
+                        if cached is None or cached[0] != signature:
+                            cached = (signature, self._hash_file(path))
+                            changed += 1
+                        media_hashes[path] = cached
+                        media.setdefault(os.path.relpath(dirpath, self.root) + '.md', []).append((path, cached[1]))
+                    except Exception as e:
+                        logger.error("Ошибка при чтении медиафайла %s: %s", path, e)
+                    continue
+                key = os.path.relpath(path, self.root)
+                seen.add(key)
+                try:
+                    signature = self._signature(os.stat(path))
+                    if self._signatures.get(key) == signature:
+                        continue
+                    with open(path, 'r', encoding='utf-8') as f:
+                        self._texts[key] = f.read().strip()
+                    self._compile(key, self._texts[key])
+                    self._signatures[key] = signature
+                    changed += 1
+                except Exception as e:
+                    logger.error("Ошибка при чтении файла %s: %s", path, e)
+                    critical_logger.critical("Критическая ошибка при чтении файла %s: %s", path, e, exc_info=True)
+        for path in set(self._texts) - seen:
+            self._texts.pop(path, None)
+            self._messages.pop(path, None)
+            self._signatures.pop(path, None)
+            self.errors.pop(path, None)
+            changed += 1
+        changed += len(set(self._media_hashes) - set(media_hashes))
+        self._media = media
+        self._media_hashes = media_hashes
+        if changed:
+            logger.info("Контент обновлен: изменено файлов %s, всего в кэше %s.", changed, len(self._texts))
+        return changed
+
+    def get(self, file_path):
+        """Текст страницы по пути относительно root или None."""
+        return self._texts.get(os.path.normpath(file_path))
+
+    def get_messages(self, file_path):
+        """Готовые HTML-сообщения страницы или None."""
+        return self._messages.get(os.path.normpath(file_path))
+
+    def get_media(self, file_path):
+        """Медиафайлы страницы: список (путь к файлу на диске, хэш содержимого)."""
+        return self._media.get(os.path.normpath(file_path), [])
+
+    async def watch(self, interval, on_change=None):
+        """Периодическая проверка изменений файлов в фоновом потоке; on_change() - после изменений."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.to_thread(self.refresh) and on_change:
+                    await on_change()
+            except Exception as e:
+                logger.error("Ошибка при обновлении контента: %s", e)
+
+content_store = None
+
+# Расширения файлов, отправляемых как фото; остальные отправляются документами
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Максимум фото в одном альбоме Telegram
+MEDIA_GROUP_LIMIT = 10
+
+def _load_media_file_ids(conn):
+    return conn.execute("SELECT content_hash, kind, file_id FROM media_files").fetchall()
+
+def _save_media_file_ids(conn, rows):
+    conn.executemany(
+        "INSERT INTO media_files (content_hash, kind, file_id, file_name) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(content_hash, kind) DO UPDATE SET file_id = excluded.file_id, "
+        "file_name = excluded.file_name, uploaded_at = CURRENT_TIMESTAMP",
+        rows
+    )
+
+class MediaStore:
+    """Кэш file_id медиафайлов: каждый файл загружается в Telegram один раз.
+
+    file_id хранится в SQLite по хэшу содержимого, поэтому одинаковые байты не загружаются
+    повторно даже после перезапуска, а изменённый файл получает новый хэш и загружается заново.
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self._file_ids = {}
+        # Загрузки выполняются по одной, чтобы два одновременных запроса не загрузили один файл дважды
+        self._upload_lock = asyncio.Lock()
+
+    async def load(self):
+        for content_hash, kind, file_id in await self.db.read(_load_media_file_ids):
+            self._file_ids[(content_hash, kind)] = file_id
+        logger.info("Загружено file_id медиафайлов: %s", len(self._file_ids))
+
+    @staticmethod
+    def _kind(path):
+        return 'photo' if path.lower().endswith(PHOTO_EXTENSIONS) else 'document'
+
+    async def _remember(self, uploaded):
+        """Сохранение file_id только что загруженных файлов: [(путь, хэш, вид, file_id)]."""
+        if not uploaded:
+            return
+        for _, content_hash, kind, file_id in uploaded:
+            self._file_ids[(content_hash, kind)] = file_id
+        rows = [(content_hash, kind, file_id, os.path.basename(path)) for path, content_hash, kind, file_id in uploaded]
+        try:
+            await self.db.write(_save_media_file_ids, rows)
+        except Exception as e:
+            logger.error("Ошибка при сохранении file_id медиафайлов: %s", e)
+
+    def _forget(self, files, kind):
+        for _, content_hash in files:
+            self._file_ids.pop((content_hash, kind), None)
+
+    async def _send_photos(self, bot, chat_id, photos):
+        handles = []
+        try:
+            media = []
+            for path, content_hash in photos:
+                file_id = self._file_ids.get((content_hash, 'photo'))
+                if file_id is None:
+                    handles.append(open(path, 'rb'))
+                    file_id = handles[-1]
+                media.append(InputMediaPhoto(file_id))
+            if len(media) == 1:
+                messages = [await bot.send_photo(chat_id, media[0].media, write_timeout=120)]
+            else:
+                messages = await bot.send_media_group(chat_id, media, write_timeout=120)
+        finally:
+            for handle in handles:
+                handle.close()
+        await self._remember([
+            (path, content_hash, 'photo', message.photo[-1].file_id)
+            for (path, content_hash), message in zip(photos, messages)
+            if (content_hash, 'photo') not in self._file_ids
+        ])
+
+    async def _send_document(self, bot, chat_id, path, content_hash):
+        file_id = self._file_ids.get((content_hash, 'document'))
+        if file_id is not None:
+            await bot.send_document(chat_id, file_id)
+            return
+        with open(path, 'rb') as f:
+            message = await bot.send_document(chat_id, f, filename=os.path.basename(path), write_timeout=120)
+        await self._remember([(path, content_hash, 'document', message.document.file_id)])
+
+    def _cached(self, files):
+        return all((content_hash, self._kind(path)) in self._file_ids for path, content_hash in files)
+
+    async def send(self, bot, chat_id, files):
+        """Отправка медиафайлов страницы: фото альбомами, остальное документами."""
+        if self._cached(files):
+            await self._send(bot, chat_id, files)
+        else:
+            async with self._upload_lock:
+                await self._send(bot, chat_id, files)
+
+    async def _send(self, bot, chat_id, files):
+        photos = [item for item in files if self._kind(item[0]) == 'photo']
+        documents = [item for item in files if self._kind(item[0]) == 'document']
+        for start in range(0, len(photos), MEDIA_GROUP_LIMIT):
+            group = photos[start:start + MEDIA_GROUP_LIMIT]
+            try:
+                await self._send_photos(bot, chat_id, group)
+            except BadRequest as e:
+                # file_id мог стать недействительным (например, после смены токена) - загружаем заново
+                logger.warning("Не удалось отправить фото по file_id, повторная загрузка: %s", e)
+                self._forget(group, 'photo')
+                await self._send_photos(bot, chat_id, group)
+        for path, content_hash in documents:
+            try:
+                await self._send_document(bot, chat_id, path, content_hash)
+            except BadRequest as e:
+                logger.warning("Не удалось отправить документ по file_id, повторная загрузка: %s", e)
+                self._forget([(path, content_hash)], 'document')
+                await self._send_document(bot, chat_id, path, content_hash)
+
+media_store = None
+
+# Поиск по страницам меню: результатов в ответе на /search и во встроенном режиме,
+# размер кэша результатов и время кэширования ответа на inline-запрос на стороне Telegram (в секундах)
+SEARCH_RESULTS = 5
+SEARCH_INLINE_RESULTS = 10
+SEARCH_CACHE_SIZE = 256
+SEARCH_INLINE_CACHE_TIME = 300
+# Слов запроса, учитываемых при поиске, и длина фрагмента текста вокруг совпадения (в словах)
+SEARCH_MAX_TERMS = 8
+SEARCH_SNIPPET_WORDS = 16
+
+metrics.describe('bot_search_cache_total', 'counter', 'Поисковые запросы: попадания и промахи кэша результатов')
+
+def _sync_search_documents(conn, documents):
+    """Приведение индекса к documents = {путь: (заголовок, раздел, текст, хэш)}. Возвращает число изменений."""
+    existing = {
+        path: (document_id, title, section, content_hash)
+        for document_id, path, title, section, content_hash in conn.execute(
+            "SELECT id, path, title, section, content_hash FROM content_documents"
+        )
+    }
+    changed = 0
+    for path in existing.keys() - documents.keys():
+        document_id = existing[path][0]
+        conn.execute("DELETE FROM content_fts WHERE rowid = ?", (document_id,))
+        conn.execute("DELETE FROM content_documents WHERE id = ?", (document_id,))
+        changed += 1
+    for path, (title, section, body, content_hash) in documents.items():
+        current = existing.get(path)
+        if current and current[1:] == (title, section, content_hash):
+            continue
+        if current:
+            document_id = current[0]
+            conn.execute(
+                "UPDATE content_documents SET title = ?, section = ?, content_hash = ?, "
+                "indexed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (title, section, content_hash, document_id)
+            )
+            conn.execute("DELETE FROM content_fts WHERE rowid = ?", (document_id,))
+        else:
+            document_id = conn.execute(
+                "INSERT INTO content_documents (path, title, section, content_hash) VALUES (?, ?, ?, ?)",
+                (path, title, section, content_hash)
+            ).lastrowid
+        conn.execute(
+            "INSERT INTO content_fts (rowid, title, section, body) VALUES (?, ?, ?, ?)",
+            (document_id, title, section or '', body)
+        )
+        changed += 1
+    return changed
+
+def _search_documents(conn, match, limit):
+    # Совпадение в заголовке весит больше, чем в разделе и тексте
+    return conn.execute(
+        "SELECT d.id, d.path, d.title, d.section, "
+        f"snippet(content_fts, 2, char(2), char(3), '…', {SEARCH_SNIPPET_WORDS}) "
+        "FROM content_fts JOIN content_documents d ON d.id = content_fts.rowid "
+        "WHERE content_fts MATCH ? ORDER BY bm25(content_fts, 10.0, 3.0, 1.0) LIMIT ?",
+        (match, limit)
+    ).fetchall()
+
+class SearchResult:
+    def __init__(self, document_id, path, title, section, snippet):
+        self.document_id = document_id
+        self.path = path
+        self.title = title
+        self.section = section
+        # Совпадения во фрагменте отмечены символами \x02 и \x03; переносы строк не нужны
+        self.snippet = ' '.join(snippet.split())
+
+    @property
+    def snippet_html(self):
+        return html.escape(self.snippet, quote=False).replace('\x02', '<b>').replace('\x03', '</b>')
+
+    @property
+    def snippet_text(self):
+        return self.snippet.replace('\x02', '').replace('\x03', '')
+
+class SearchIndex:
+    """Полнотекстовый индекс (SQLite FTS5) по страницам меню.
+
+    Переиндексируются только страницы, у которых изменился текст (хэш) или место в меню.
+    Результаты запросов кэшируются в памяти до следующего изменения индекса.
+    """
+
+    def __init__(self, database, cache_size=SEARCH_CACHE_SIZE):
+        self.db = database
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._paths = {}
+
+    async def sync(self, store, pages):
+        """Обновление индекса по ContentStore; pages = {путь: (заголовок, раздел)}."""
+        documents = {}
+        for path, (title, section) in pages.items():
+            text = store.get(path)
+            if text is None:
+                continue
+            content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            documents[os.path.normpath(path)] = (title, section, markdown_to_text(text), content_hash)
+        changed = await self.db.write(_sync_search_documents, documents)
+        rows = await self.db.fetchall("SELECT id, path FROM content_documents")
+        self._paths = dict(rows)
+        if changed:
+            self._cache.clear()
+            logger.info("Поисковый индекс обновлен: изменено страниц %s, всего %s.", changed, len(self._paths))
+        return changed
+
+    def path(self, document_id):
+        return self._paths.get(document_id)
+
+    @staticmethod
+    def _match(query, operator):
+        terms = re.findall(r'\w+', query.lower())[:SEARCH_MAX_TERMS]
+        return f' {operator} '.join(f'"{term}"*' for term in terms)
+
+    async def search(self, query, limit=SEARCH_INLINE_RESULTS):
+        """Страницы по запросу, лучшие первыми: сначала со всеми словами, иначе с любым из них."""
+        key = (' '.join(re.findall(r'\w+', query.lower())), limit)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            metrics.inc('bot_search_cache_total', result='hit')
+            return self._cache[key]
+        metrics.inc('bot_search_cache_total', result='miss')
+        rows = []
+        if key[0]:
+            rows = await self.db.read(_search_documents, self._match(query, 'AND'), limit)
+            if not rows and ' ' in key[0]:
+                rows = await self.db.read(_search_documents, self._match(query, 'OR'), limit)
+        results = [SearchResult(*row) for row in rows]
+        self._cache[key] = results
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return results
+
+search_index = None
+
+def _load_user_ids(conn):
+    return [row[0] for row in conn.execute("SELECT user_id FROM users")]
+
+def _count_users(conn, delta):
+    conn.execute("UPDATE counters SET value = value + ? WHERE name = 'users'", (delta,))
+
+def _load_user_count(conn):
+    return conn.execute("SELECT value FROM counters WHERE name = 'users'").fetchone()[0]
+
+def _insert_user_ids(conn, user_ids):
+    inserted = conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, CURRENT_TIMESTAMP)",
+        [(user_id,) for user_id in user_ids]
+    ).rowcount
+    _count_users(conn, inserted)
+
+class UserRegistry:
+    """Множество уже известных пользователей и буфер новых ID.
+
+    Известные пользователи не требуют обращения к БД вовсе, новые копятся в буфере
+    и записываются одной транзакцией раз в interval секунд или при заполнении пачки.
+    """
+
+    def __init__(self, database, interval=2, batch_size=500):
+        self.db = database
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self._seen = set()
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
+
+    async def load(self):
+        self._seen.update(await self.db.read(_load_user_ids))
+        logger.info("Загружено известных пользователей: %s", len(self._seen))
+
+    async def add(self, user_id):
+        if user_id in self._seen:
+            return
+        self._seen.add(user_id)
+        self._pending.append(user_id)
+        logger.debug("ID пользователя %s добавлен в очередь на сохранение.", user_id)
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    def forget(self, user_ids):
+        """Пользователи удалены из БД (например, заблокировали бота) и при возвращении будут записаны снова."""
+        self._seen.difference_update(user_ids)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            try:
+                await self.db.write(_insert_user_ids, pending)
+                logger.debug("Сохранено новых пользователей: %s", len(pending))
+            except Exception as e:
+                logger.error("Ошибка при сохранении ID пользователей: %s", e)
+                self._pending[:0] = pending
+
+    async def run(self):
+        """Периодическая запись буфера в фоне."""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+user_registry = None
+
+async def save_user_id(user_id):
+    """Регистрация пользователя; запись в базу данных выполняется пачками в фоне."""
+    await user_registry.add(user_id)
+
+class PrebuiltReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    """ReplyKeyboardMarkup, который обходит свои кнопки в словарь один раз при создании.
+
+    PTB 20.0 при каждой отправке вызывает to_dict() и json.dumps для параметров запроса,
+    экономится только обход объектов кнопок. to_dict() возвращает один и тот же словарь
+    всем вызывающим, поэтому его нельзя изменять (PTB его только сериализует).
+    """
+
+    __slots__ = ('_payload',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._payload = super().to_dict()
+
+    def to_dict(self, recursive=True):
+        return self._payload
+
+class KeyboardRegistry:
+    """Реестр готовых клавиатур: каждая разметка создаётся один раз и переиспользуется."""
+
+    def __init__(self):
+        self._markups = {}
+        self._menus = {}
+
+    def get(self, keyboard, one_time_keyboard=False):
+        key = (tuple(tuple(row) for row in keyboard), one_time_keyboard)
+        markup = self._markups.get(key)
+        if markup is None:
+            markup = PrebuiltReplyKeyboardMarkup(
+                keyboard, resize_keyboard=True, one_time_keyboard=one_time_keyboard, selective=False
+            )
+            self._markups[key] = markup
+        return markup
+
+    def register_menus(self, nodes):
+        """Предварительная сборка клавиатур всех подменю в вариантах для админа и пользователя."""
+        for node in nodes:
+            if node.rows:
+                for is_admin in (False, True):
+                    self._menus[(node.node_id, is_admin)] = self.get(menu_keyboard(node, is_admin))
+
+    def menu(self, node, is_admin=False):
+        markup = self._menus.get((node.node_id, is_admin))
+        return markup or self.get(menu_keyboard(node, is_admin))
+
+keyboards = KeyboardRegistry()
+
+def create_reply_markup(keyboard):
+    """Создание клавиатуры (берётся из реестра готовых клавиатур)."""
+    return keyboards.get(keyboard)
+
+# Оптимизация клавиатур для постоянного отображения
+main_keyboard = [["ATS", "ETS 2"], ["Задать вопрос"]]
+back_keyboard = [["Назад"]]
+
+async def main_menu(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
     if not user.is_bot:
-        reply_markup = create_reply_markup(guides_keyboard)
-        await update.message.reply_text("Выберите гайд:", reply_markup=reply_markup)
-        context.user_data['previous_menu'] = context.user_data.get('current_menu', 'game_menu')
-        context.user_data['current_menu'] = 'guides'
+        await save_user_id(user.id)
+        logger.debug("Отображение главного меню для пользователя %s", user.id)
+        reply_markup = keyboards.menu(MENU_ROOT, user.id in config.admin_ids)
+        await update.message.reply_text(MENU_ROOT.prompt, reply_markup=reply_markup)
+        context.user_data['current_menu'] = MENU_ROOT.node_id
     else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+        logger.info("Бот %s пытается получить доступ к главному меню.", user.id)
+        await update.message.reply_text("Извините, боты не могут использовать этот бот.")
 
 async def show_social(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
@@ -237,140 +1599,744 @@ async def show_social(update: Update, context: CallbackContext) -> None:
             [InlineKeyboardButton("📺 Подписаться на YouTube", url="https://www.youtube.com/user/TheAlive55?sub_confirmation=1")],
             [InlineKeyboardButton("📺 Подписаться на Дзен", url="https://dzen.ru/thealive55")]
         ]
-        reply_keyboard = back_keyboard
-        reply_markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True, one_time_keyboard=True)
+        reply_markup = keyboards.get(back_keyboard, one_time_keyboard=True)
         await update.message.reply_text(social_text, reply_markup=InlineKeyboardMarkup(social_buttons))
         await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
-        context.user_data['previous_menu'] = context.user_data.get('current_menu', 'game_menu')
-        context.user_data['current_menu'] = 'social'
     else:
         await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
 
-async def show_patch(update: Update, context: CallbackContext, game: str) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        patch_file = f'data/patches/patch_{game.lower()}.md'
-        patch_text = load_text(patch_file)
-        if "Файл не найден." in patch_text or "Произошла ошибка" in patch_text:
-            patch_text = f"Обзор актуального патча для {game} не найден."
-        reply_markup = create_reply_markup(back_keyboard)
-        await update.message.reply_text(patch_text, reply_markup=reply_markup, parse_mode='Markdown')  # Используем Markdown
-        context.user_data['previous_menu'] = context.user_data.get('current_menu', 'game_menu')
-        context.user_data['current_menu'] = f'{game.lower()}_patch'
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+# Повторные попытки отправки одному пользователю при рассылке
+BROADCAST_MAX_RETRIES = 3
 
-async def game_menu(update: Update, context: CallbackContext, game: str) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        if game == "ETS 2":
-            reply_markup = create_reply_markup(ets_game_keyboard)
-        else:
-            reply_markup = create_reply_markup(game_keyboard)
-        await update.message.reply_text(f"Выберите опцию для {game}:", reply_markup=reply_markup)
-        context.user_data['previous_menu'] = 'main_menu'
-        context.user_data['current_menu'] = f'{game.lower()}_menu'
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+class TokenBucket:
+    """Ограничитель скорости: в среднем rate отправок в секунду, всплеск не больше capacity."""
 
-async def handle_guide_selection(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        topic = update.message.text
-        logger.info(f"Пользователь {user.id} выбрал гайд: {topic}")
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Остановка выдачи токенов после RetryAfter от Telegram."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+def _create_broadcast(conn, admin_id, chat_id, message_id, message_text, photo):
+    total = _load_user_count(conn)
+    cursor = conn.execute(
+        "INSERT INTO broadcasts (admin_id, chat_id, message_id, message_text, photo, total) VALUES (?, ?, ?, ?, ?, ?)",
+        (admin_id, chat_id, message_id, message_text, photo, total)
+    )
+    return cursor.lastrowid
+
+def _save_broadcast_progress(conn, broadcast_id, last_user_row, counts, blocked_user_ids):
+    conn.execute(
+        "UPDATE broadcasts SET last_user_row = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE id = ?",
+        (last_user_row, counts['sent'], counts['failed'], counts['blocked'], broadcast_id)
+    )
+    # Пользователи, заблокировавшие бота, удаляются из базы
+    deleted = conn.executemany(
+        "DELETE FROM users WHERE user_id = ?", [(user_id,) for user_id in blocked_user_ids]
+    ).rowcount
+    _count_users(conn, -deleted)
+
+class BroadcastEngine:
+    """Рассылка с ограничением скорости, сохранением прогресса в SQLite и продолжением после перезапуска."""
+
+    def __init__(self, database, rate, concurrency, batch_size, progress_interval):
+        self.db = database
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks = {}
+
+    async def start(self, bot, admin_id, chat_id, message_id, message_text, photo):
+        # Недавно зарегистрированные пользователи тоже должны попасть в рассылку
+        await user_registry.flush()
+        broadcast_id = await self.db.write(_create_broadcast, admin_id, chat_id, message_id, message_text, photo)
+        self._spawn(bot, broadcast_id)
+        return broadcast_id
+
+    async def resume(self, bot):
+        """Продолжение рассылок, прерванных остановкой бота."""
+        rows = await self.db.fetchall("SELECT id FROM broadcasts WHERE status = 'running'")
+        for (broadcast_id,) in rows:
+            logger.info("Продолжение рассылки #%s после перезапуска.", broadcast_id)
+            self._spawn(bot, broadcast_id)
+
+    async def cancel(self, broadcast_id):
+        await self.db.execute("UPDATE broadcasts SET status = 'cancelled' WHERE id = ?", (broadcast_id,))
+        task = self._tasks.pop(broadcast_id, None)
+        if task:
+            task.cancel()
+
+    async def stop(self):
+        """Остановка задач без смены статуса: рассылка продолжится при следующем запуске."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, bot, broadcast_id):
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _deliver(self, bot, user_id, message_text, photo):
+        """Отправка одному пользователю. Возвращает 'sent', 'failed' или 'blocked'."""
+        for attempt in range(BROADCAST_MAX_RETRIES):
+            await self.bucket.acquire()
+            try:
+                if photo:
+                    await bot.send_photo(chat_id=user_id, photo=photo, caption=message_text, parse_mode='Markdown')
+                else:
+                    await bot.send_message(chat_id=user_id, text=message_text, parse_mode='Markdown')
+                return 'sent'
+            except RetryAfter as e:
+                logger.warning("Превышен лимит Telegram при рассылке, пауза %s с.", e.retry_after)
+                self.bucket.pause(e.retry_after)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return 'blocked'
+                logger.warning("Не удалось отправить сообщение пользователю %s: %s", user_id, e)
+                return 'failed'
+            except NetworkError as e:
+                logger.warning("Сетевая ошибка при отправке пользователю %s: %s", user_id, e)
+                await asyncio.sleep(attempt + 1)
+            except Exception as e:
+                logger.warning("Не удалось отправить сообщение пользователю %s: %s", user_id, e)
+                return 'failed'
+        return 'failed'
+
+    async def _report(self, bot, chat_id, message_id, text, reply_markup=None):
         try:
-            # Словарь для сопоставления названий гайдов с файлами
-            guide_files = {
-                "Гайд для новичка": "guide.md",
-                "Включить консоль и свободную камеру": "console_on.md",
-                "Консольные команды": "console_commands.md",
-                "Конвой на 8+ человек": "convoy_8plus.md",
-                "Своё радио для ETS2 и ATS": "radio.md",
-                "Настройка OCULUS QUEST 2/3 для ATS и ETS2": "oculus.md"
-            }
-            guide_filename = guide_files.get(topic, "guide.md")  # По умолчанию "guide.md"
-            guide_file = f'data/guides/{guide_filename}'
-            guide_text = load_text(guide_file)
-            if "Файл не найден." in guide_text or "Произошла ошибка" in guide_text:
-                guide_text = f"Гайд '{topic}' не найден."
-            reply_markup = create_reply_markup(back_keyboard)
-            await update.message.reply_text(guide_text, reply_markup=reply_markup, parse_mode='Markdown')
-            context.user_data['previous_menu'] = 'guides'
-            context.user_data['current_menu'] = guide_filename.split('.')[0]  # Например, 'convoy_8plus'
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning("Не удалось обновить прогресс рассылки: %s", e)
         except Exception as e:
-            logger.error(f"Ошибка в handle_guide_selection: {e}")
-            await update.message.reply_text("Произошла ошибка, попробуйте позже.")
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+            logger.warning("Не удалось обновить прогресс рассылки: %s", e)
 
-async def show_map_pack(update: Update, context: CallbackContext, map_pack: str) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        # Словарь для сопоставления названий сборок с файлами
-        map_files = {
-            "Золотая сборка Русских карт": "gold_rus.md",
-            # Добавьте другие сборки здесь, если нужно
-        }
-        map_filename = map_files.get(map_pack, "unknown_map.md")
-        map_file = f'data/maps/{map_filename}'
-        map_text = load_text(map_file)
-        if "Файл не найден." in map_text or "Произошла ошибка" in map_text:
-            map_text = f"Информация о сборке карт '{map_pack}' не найдена."
-        reply_markup = create_reply_markup(back_keyboard)
-        await update.message.reply_text(map_text, reply_markup=reply_markup, parse_mode='Markdown')  # Используем Markdown
-        context.user_data['previous_menu'] = 'map_packs'
-        context.user_data['current_menu'] = f'{map_pack.lower().replace(" ", "_")}_map'
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+    async def _run(self, bot, broadcast_id):
+        row = await self.db.fetchone(
+            "SELECT chat_id, message_id, message_text, photo, total, last_user_row, sent, failed, blocked "
+            "FROM broadcasts WHERE id = ?",
+            (broadcast_id,)
+        )
+        chat_id, message_id, message_text, photo, total, last_user_row, sent, failed, blocked = row
+        stats = {'sent': sent, 'failed': failed, 'blocked': blocked}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stop_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Остановить рассылку", callback_data=f"stop_broadcast_{broadcast_id}")]]
+        )
 
-async def handle_game_selection(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        game = update.message.text
-        logger.info(f"Пользователь {user.id} выбрал: {game}")
-        if game in ["ATS", "ETS 2"]:
-            context.user_data['selected_game'] = game
-            await game_menu(update, context, game)
-        elif user.id in ADMIN_IDS and game == "Админ":
-            await admin_menu(update, context)
-        elif game == "Задать вопрос":  # Переносим логику сюда для ясности
-            await ask_question(update, context)
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+        async def deliver(user_id):
+            async with semaphore:
+                return user_id, await self._deliver(bot, user_id, message_text, photo)
 
-async def go_back(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        previous_menu = context.user_data.get('previous_menu', 'main_menu')
-        current_menu = context.user_data.get('current_menu', '')
-        logger.info(f"Переход назад: текущий={current_menu}, предыдущий={previous_menu}")
-        if current_menu == 'social':
-            game = context.user_data.get('selected_game', 'ATS')
-            await game_menu(update, context, game)
-        elif current_menu in ['guide', 'console_on', 'console_commands', 'convoy_8plus', 'radio', 'oculus']:  # Обновляем список
-            await show_guides(update, context)
-        elif previous_menu == 'start_menu':
-            await main_menu(update, context)
-        elif previous_menu == 'main_menu':
-            await main_menu(update, context)
-        elif 'menu' in previous_menu:
-            game = "ATS" if "ats" in previous_menu else "ETS 2"
-            await game_menu(update, context, game)
-        elif current_menu == 'admin_menu':
-            await main_menu(update, context)
-        elif current_menu == 'map_packs' or 'map' in current_menu:
-            await game_menu(update, context, 'ETS 2')
-        else:
-            await show_guides(update, context) if previous_menu == 'guides' else \
-            await show_mods(update, context) if previous_menu == 'mods' else \
-            await show_social(update, context) if previous_menu == 'social' else \
-            await main_menu(update, context)
-    else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+        def progress_text(prefix):
+            done = stats['sent'] + stats['failed'] + stats['blocked']
+            return (
+                f"{prefix} #{broadcast_id}: обработано {done} из {total}.\n"
+                f"Успешно отправлено: {stats['sent']}. Не удалось отправить: {stats['failed']}. "
+                f"Заблокировали бота: {stats['blocked']}."
+            )
+
+        last_report = 0.0
+        try:
+            while True:
+                batch = await self.db.fetchall(
+                    "SELECT id, user_id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_user_row, self.batch_size)
+                )
+                if not batch:
+                    break
+                results = await asyncio.gather(*(deliver(user_id) for _, user_id in batch))
+                counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+                for _, result in results:
+                    counts[result] += 1
+                    stats[result] += 1
+                blocked_user_ids = [user_id for user_id, result in results if result == 'blocked']
+                last_user_row = batch[-1][0]
+                await self.db.write(_save_broadcast_progress, broadcast_id, last_user_row, counts, blocked_user_ids)
+                user_registry.forget(blocked_user_ids)
+                if blocked_user_ids:
+                    share('forget_users', blocked_user_ids)
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(bot, chat_id, message_id, progress_text("Рассылка"), stop_markup)
+            await self.db.execute("UPDATE broadcasts SET status = 'done' WHERE id = ?", (broadcast_id,))
+            logger.info("Рассылка #%s завершена: %s", broadcast_id, stats)
+            await self._report(bot, chat_id, message_id, progress_text("Рассылка завершена"))
+        except asyncio.CancelledError:
+            logger.info("Рассылка #%s остановлена на записи %s.", broadcast_id, last_user_row)
+            raise
+        except Exception as e:
+            logger.error("Ошибка при рассылке: %s", e)
+            critical_logger.critical("Критическая ошибка при рассылке: %s", e, exc_info=True)
+            await self.db.execute("UPDATE broadcasts SET status = 'failed' WHERE id = ?", (broadcast_id,))
+            await self._report(bot, chat_id, message_id, "Произошла ошибка при рассылке.")
+
+broadcast_engine = None
+
+# Доставка из outbox: попыток при временных ошибках, предельная пауза между попытками,
+# сколько хранить доставленные сообщения (в секундах) и сколько ждать отправок при остановке
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_KEEP_SENT = 7 * 24 * 3600
+OUTBOX_STOP_TIMEOUT = 10
+OUTBOX_BATCH_SIZE = 500
+
+metrics.describe('bot_outbox_messages_total', 'counter', 'Сообщения outbox по результату доставки')
+metrics.describe('bot_outbox_delay_seconds', 'histogram', 'Время от постановки сообщения в outbox до доставки')
+metrics.describe('bot_outbox_pending', 'gauge', 'Недоставленные сообщения outbox')
+
+def _insert_outbox(conn, messages):
+    now = time.time()
+    conn.executemany(
+        "INSERT INTO outbox (chat_id, text, reply_markup, enqueued_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+        [(chat_id, text, reply_markup.to_json() if reply_markup else None, now, now)
+         for chat_id, text, reply_markup in messages]
+    )
+
+def _write_with_outbox(conn, func, args):
+    """func(conn, *args) -> (результат, сообщения); сообщения ставятся в outbox в той же транзакции.
+
+    Возвращает (результат, чаты поставленных сообщений).
+    """
+    result, messages = func(conn, *args)
+    _insert_outbox(conn, messages)
+    return result, [chat_id for chat_id, _, _ in messages]
+
+def outbox_partition(chat_id, count):
+    """Номер обработчика, отправляющего сообщения чата (то же условие, что в _fetch_outbox)."""
+    return abs(chat_id) % count
+
+def _fetch_outbox(conn, limit, partition):
+    """Первые недоставленные сообщения чатов (не больше limit) и общее число недоставленных.
+
+    Остальные сообщения чата всё равно ждут доставки первого, поэтому читается только голова
+    очереди каждого чата: длинная очередь одного чата не вытесняет из выборки другие чаты.
+    """
+    where = "status = 'pending'"
+    params = []
+    if partition:
+        where += " AND abs(chat_id) % ? = ?"
+        params += [partition[1], partition[0]]
+    heads = conn.execute(
+        "SELECT id, chat_id, text, reply_markup, attempts, enqueued_at, next_attempt_at FROM outbox "
+        f"WHERE id IN (SELECT MIN(id) FROM outbox WHERE {where} GROUP BY chat_id) ORDER BY id LIMIT ?",
+        (*params, limit)
+    ).fetchall()
+    pending = conn.execute(f"SELECT COUNT(*) FROM outbox WHERE {where}", params).fetchone()[0]
+    return heads, pending
+
+def _finish_outbox(conn, message_id, status, attempts, next_attempt_at, error):
+    conn.execute(
+        "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+        "sent_at = CASE WHEN ? = 'sent' THEN ? END WHERE id = ?",
+        (status, attempts, next_attempt_at, error, status, time.time(), message_id)
+    )
+
+def _purge_outbox(conn, before):
+    return conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (before,)).rowcount
+
+class Outbox:
+    """Надёжная доставка сообщений пересылки между пользователями и админами.
+
+    Обработчики только записывают сообщения в таблицу outbox (вместе со своим изменением в БД)
+    и сразу отвечают. Фоновый цикл отправляет их параллельно, но в каждый чат - строго по порядку:
+    пока сообщение чата не доставлено или ждёт повтора, следующие сообщения этого чата ждут.
+    Временные ошибки повторяются с экспоненциальной паузой, RetryAfter приостанавливает все
+    отправки. Доставка «хотя бы один раз»: при обрыве после отправки сообщение может прийти дважды.
+    В режиме WORKERS каждый обработчик отправляет сообщения своей части чатов (partition).
+    """
+
+    def __init__(self, database, rate, concurrency):
+        self.db = database
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.partition = None
+        self._wakeup = asyncio.Event()
+        self._in_flight = {}
+        self._stopping = False
+        self._task = None
+
+    async def write(self, func, *args):
+        """Изменение в БД и постановка вызванных им сообщений в очередь одной транзакцией."""
+        result, chat_ids = await self.db.write(_write_with_outbox, func, args)
+        if self.partition is None:
+            self.wake()
+            return result
+        # В режиме WORKERS будим только обработчиков, которым принадлежат чаты сообщений
+        index, count = self.partition
+        for owner in {outbox_partition(chat_id, count) for chat_id in chat_ids}:
+            if owner == index:
+                self.wake()
+            else:
+                share('outbox', owner)
+        return result
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        """Остановка цикла; начатые отправки получают OUTBOX_STOP_TIMEOUT на завершение."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        await self._task
+        self._task = None
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight.values()), timeout=OUTBOX_STOP_TIMEOUT)
+
+    async def _run(self, bot):
+        last_purge = 0.0
+        while not self._stopping:
+            self._wakeup.clear()
+            delay = OUTBOX_MAX_BACKOFF
+            try:
+                delay = await self._dispatch(bot)
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    await self.db.write(_purge_outbox, last_purge - OUTBOX_KEEP_SENT)
+            except Exception as e:
+                logger.error("Ошибка при обработке очереди исходящих сообщений: %s", e)
+                delay = 5
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, bot):
+        """Запуск отправки готовых сообщений. Возвращает время до следующего повтора."""
+        # Чаты с начатой отправкой запоминаются до чтения: результат может записаться во время чтения
+        blocked_chats = set(self._in_flight)
+        rows, pending = await self.db.read(_fetch_outbox, OUTBOX_BATCH_SIZE, self.partition)
+        metrics.set('bot_outbox_pending', pending)
+        now = time.time()
+        delay = OUTBOX_MAX_BACKOFF
+        # По одной строке на чат: первое недоставленное сообщение задерживает остальные сообщения чата
+        for row in rows:
+            message_id, chat_id, next_attempt_at = row[0], row[1], row[6]
+            if chat_id in blocked_chats:
+                continue
+            if next_attempt_at > now:
+                delay = min(delay, next_attempt_at - now)
+                continue
+            if len(self._in_flight) >= self.concurrency:
+                # Освободившийся отправитель разбудит цикл (_done)
+                break
+            task = asyncio.create_task(self._deliver(bot, row))
+            self._in_flight[chat_id] = task
+            task.add_done_callback(lambda _, chat_id=chat_id: self._done(chat_id))
+        return delay
+
+    def _done(self, chat_id):
+        self._in_flight.pop(chat_id, None)
+        self.wake()
+
+    async def _deliver(self, bot, row):
+        message_id, chat_id, text, reply_markup, attempts, enqueued_at, _ = row
+        if reply_markup:
+            data = json.loads(reply_markup)
+            markup_class = InlineKeyboardMarkup if 'inline_keyboard' in data else ReplyKeyboardMarkup
+            reply_markup = markup_class.de_json(data, bot)
+        status, next_attempt_at, error = 'sent', 0, None
+        await self.bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, reply_markup=reply_markup)
+            metrics.observe('bot_outbox_delay_seconds', time.time() - enqueued_at)
+        except RetryAfter as e:
+            # Не ошибка доставки: попытка не засчитывается, пауза общая для всех отправок
+            logger.warning("Превышен лимит Telegram при пересылке, пауза %s с.", e.retry_after)
+            self.bucket.pause(e.retry_after)
+            status, next_attempt_at, error = 'pending', time.time() + e.retry_after, str(e)
+        except (Forbidden, BadRequest) as e:
+            logger.warning("Сообщение #%s для %s не может быть доставлено: %s", message_id, chat_id, e)
+            status, error = 'failed', str(e)
+        except Exception as e:
+            attempts += 1
+            error = str(e)
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error("Сообщение #%s для %s не доставлено за %s попыток: %s", message_id, chat_id, attempts, e)
+                status = 'failed'
+            else:
+                logger.warning("Ошибка при отправке сообщения #%s для %s, повтор: %s", message_id, chat_id, e)
+                status = 'pending'
+                next_attempt_at = time.time() + min(OUTBOX_MAX_BACKOFF, 2 ** attempts)
+        metrics.inc('bot_outbox_messages_total', result=status if status != 'pending' else 'retry')
+        try:
+            await self.db.write(_finish_outbox, message_id, status, attempts, next_attempt_at, error)
+        except Exception as e:
+            logger.error("Не удалось сохранить результат доставки сообщения #%s: %s", message_id, e)
+
+outbox = None
+
+metrics.describe('bot_analytics_events_total', 'counter', 'События аналитики, записанные в events')
+metrics.describe('bot_analytics_dropped_total', 'counter', 'События, вытесненные из переполненного буфера')
+
+def _insert_events(conn, rows):
+    conn.executemany(
+        "INSERT INTO events (created_at, user_id, kind, name, game, value) VALUES (?, ?, ?, ?, ?, ?)", rows
+    )
+
+# Ключ дня по местному времени события
+_EVENT_DAY = "date(created_at, 'unixepoch', 'localtime')"
+
+def _rollup_events(conn, batch_size):
+    """Добавление событий после последнего учтённого в агрегаты. Возвращает число событий."""
+    row = conn.execute("SELECT value FROM stats_state WHERE name = 'last_event_id'").fetchone()
+    first = row[0] if row else 0
+    last = conn.execute(
+        "SELECT MAX(id) FROM (SELECT id FROM events WHERE id > ? ORDER BY id LIMIT ?)", (first, batch_size)
+    ).fetchone()[0]
+    if last is None:
+        return 0
+    conn.execute(
+        f"INSERT INTO stats_daily (day, kind, name, game, count, value_sum) "
+        f"SELECT {_EVENT_DAY}, kind, name, game, COUNT(*), TOTAL(value) FROM events "
+        f"WHERE id > ? AND id <= ? GROUP BY 1, 2, 3, 4 "
+        f"ON CONFLICT(day, kind, name, game) DO UPDATE SET count = count + excluded.count, value_sum = value_sum + excluded.value_sum",
+        (first, last)
+    )
+    days = [day for (day,) in conn.execute(
+        f"SELECT DISTINCT {_EVENT_DAY} FROM events WHERE id > ? AND id <= ?", (first, last)
+    )]
+    conn.execute(
+        f"INSERT OR IGNORE INTO stats_daily_users (day, user_id) SELECT DISTINCT {_EVENT_DAY}, user_id "
+        f"FROM events WHERE id > ? AND id <= ? AND user_id IS NOT NULL",
+        (first, last)
+    )
+    conn.executemany(
+        "INSERT INTO stats_days (day, active_users) "
+        "SELECT ?, COUNT(*) FROM stats_daily_users WHERE day = ? "
+        "ON CONFLICT(day) DO UPDATE SET active_users = excluded.active_users",
+        [(day, day) for day in days]
+    )
+    conn.execute(
+        "INSERT INTO stats_state (name, value) VALUES ('last_event_id', ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (last,)
+    )
+    return last - first
+
+def _prune_events(conn, keep_days):
+    """Удаление учтённых в агрегатах событий и списков пользователей дня старше keep_days дней."""
+    row = conn.execute("SELECT value FROM stats_state WHERE name = 'last_event_id'").fetchone()
+    if not row:
+        return 0
+    deleted = conn.execute(
+        "DELETE FROM events WHERE id <= ? AND created_at < ?", (row[0], time.time() - keep_days * 86400)
+    ).rowcount
+    conn.execute("DELETE FROM stats_daily_users WHERE day < date('now', 'localtime', ?)", (f'-{keep_days} days',))
+    return deleted
+
+def _load_stats(conn, days):
+    """Агрегаты за последние days дней для экрана «Статистика»."""
+    since = conn.execute("SELECT date('now', 'localtime', ?)", (f'-{days - 1} days',)).fetchone()[0]
+    return {
+        'users': _load_user_count(conn),
+        'days': conn.execute(
+            "SELECT day, active_users FROM stats_days WHERE day >= ? ORDER BY day DESC", (since,)
+        ).fetchall(),
+        'daily': conn.execute(
+            "SELECT day, kind, name, game, count, value_sum FROM stats_daily WHERE day >= ?", (since,)
+        ).fetchall(),
+        'today': conn.execute("SELECT date('now', 'localtime')").fetchone()[0],
+    }
+
+class Analytics:
+    """Учёт использования: навигация, просмотры страниц, поиск, вопросы.
+
+    record() только добавляет кортеж в кольцевой буфер в памяти (при переполнении вытесняются
+    самые старые события). Буфер пачками записывается в журнал events, фоновая задача
+    добавляет новые события в агрегаты stats_daily/stats_days раз в rollup_interval секунд,
+    и экран «Статистика» читает только агрегаты (отстают от событий не больше чем на этот интервал).
+    """
+
+    def __init__(self, database, buffer_size, flush_interval, rollup_interval, keep_days):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self.keep_days = keep_days
+        self._buffer = deque(maxlen=buffer_size)
+        self._flush_lock = asyncio.Lock()
+        self._rollup_lock = asyncio.Lock()
+
+    def record(self, kind, user_id=None, name=None, game=None, value=None):
+        if len(self._buffer) == self._buffer.maxlen:
+            metrics.inc('bot_analytics_dropped_total')
+        self._buffer.append((time.time(), user_id, kind, name or '', game or '', value))
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            rows = list(self._buffer)
+            self._buffer.clear()
+            try:
+                await self.db.write(_insert_events, rows)
+                metrics.inc('bot_analytics_events_total', len(rows))
+            except Exception as e:
+                logger.error("Ошибка при записи событий аналитики: %s", e)
+                # Возвращаем события в буфер перед новыми, лишнее вытеснится по maxlen
+                self._buffer.extendleft(reversed(rows))
+
+    async def rollup(self, batch_size=50000):
+        async with self._rollup_lock:
+            total = 0
+            while True:
+                added = await self.db.write(_rollup_events, batch_size)
+                total += added
+                if added < batch_size:
+                    return total
+
+    async def run(self, rollups=True):
+        """Фоновая запись буфера; при rollups=True - и пересчёт агрегатов с очисткой старых событий."""
+        last_rollup = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if rollups and time.monotonic() - last_rollup >= self.rollup_interval:
+                last_rollup = time.monotonic()
+                try:
+                    await self.rollup()
+                    await self.db.write(_prune_events, self.keep_days)
+                except Exception as e:
+                    logger.error("Ошибка при пересчёте агрегатов аналитики: %s", e)
+
+analytics = None
+
+metrics.describe('bot_retention_archived_total', 'counter', 'Закрытые диалоги, перенесённые в архив')
+metrics.describe('bot_db_vacuumed_pages_total', 'counter', 'Страницы, возвращённые файловой системе incremental_vacuum')
+
+# Пауза между шагами incremental_vacuum, чтобы между ними проходили остальные записи
+VACUUM_STEP_PAUSE = 0.05
+
+def _with_messages(conn, questions):
+    """Вопросы (id, user_id, admin_id, question_text, status, created_at) с перепиской в виде словарей для архива."""
+    if not questions:
+        return []
+    ids = [question[0] for question in questions]
+    messages = {}
+    for question_id, sender_id, message_text, sent_at in conn.execute(
+        f"SELECT question_id, sender_id, message_text, sent_at FROM question_messages "
+        f"WHERE question_id IN ({','.join('?' * len(ids))}) ORDER BY question_id, sent_at, id",
+        ids
+    ):
+        messages.setdefault(question_id, []).append(
+            {'sender_id': sender_id, 'text': message_text, 'sent_at': sent_at}
+        )
+    return [
+        {'id': question_id, 'user_id': user_id, 'admin_id': admin_id, 'question': question_text,
+         'status': status, 'created_at': created_at, 'messages': messages.get(question_id, [])}
+        for question_id, user_id, admin_id, question_text, status, created_at in questions
+    ]
+
+def _load_archivable_dialogs(conn, keep_days, after, limit):
+    """Закрытые вопросы с id > after, по которым не было сообщений keep_days дней, вместе с перепиской."""
+    age = f'-{keep_days} days'
+    questions = conn.execute(
+        "SELECT id, user_id, admin_id, question_text, status, created_at FROM questions q "
+        "WHERE status = 'closed' AND id > ? AND created_at < datetime('now', ?) AND NOT EXISTS "
+        "(SELECT 1 FROM question_messages WHERE question_id = q.id AND sent_at >= datetime('now', ?)) "
+        "ORDER BY id LIMIT ?",
+        (after, age, age, limit)
+    ).fetchall()
+    return _with_messages(conn, questions)
+
+def _load_dialog(conn, question_id):
+    questions = conn.execute(
+        "SELECT id, user_id, admin_id, question_text, status, created_at FROM questions WHERE id = ?",
+        (question_id,)
+    ).fetchall()
+    dialogs = _with_messages(conn, questions)
+    return dialogs[0] if dialogs else None
+
+def _delete_archived_dialogs(conn, entries):
+    """Удаление записанных в архив диалогов [(question_id, user_id, файл архива)]. Возвращает число удалённых."""
+    archived = 0
+    for question_id, user_id, archive in entries:
+        # Закрытый вопрос могли снова взять в работу после чтения - тогда он остаётся в базе
+        if conn.execute("DELETE FROM questions WHERE id = ? AND status = 'closed'", (question_id,)).rowcount:
+            conn.execute("DELETE FROM question_messages WHERE question_id = ?", (question_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO question_archive (question_id, user_id, archive) VALUES (?, ?, ?)",
+                (question_id, user_id, archive)
+            )
+            archived += 1
+    return archived
+
+def _incremental_vacuum(conn, pages):
+    """Возврат до pages свободных страниц файловой системе. Возвращает (освобождено, осталось свободных)."""
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free:
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return free - left, left
+
+def _archive_name(created_at):
+    return f"questions_{created_at[:7]}.jsonl.gz"
+
+def _append_archive(archive_dir, dialogs):
+    """Дописывает диалоги в архивы по месяцу вопроса и сбрасывает их на диск.
+
+    Каждая дозапись - отдельный член gzip, gzip.open читает такой файл целиком.
+    Возвращает [(question_id, user_id, файл архива)].
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    groups = {}
+    for dialog in dialogs:
+        groups.setdefault(_archive_name(dialog['created_at']), []).append(dialog)
+    for name, group in groups.items():
+        with open(os.path.join(archive_dir, name), 'ab') as raw:
+            with gzip.open(raw, 'wt', encoding='utf-8') as f:
+                for dialog in group:
+                    f.write(json.dumps(dialog, ensure_ascii=False) + '\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+    return [(dialog['id'], dialog['user_id'], _archive_name(dialog['created_at'])) for dialog in dialogs]
+
+def _read_archived_dialog(path, question_id):
+    """Поиск диалога в файле архива. При повторной архивации действует последняя запись."""
+    prefix = f'{{"id": {question_id},'
+    found = None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            # Ключ id всегда первый - без разбора JSON остальных строк
+            if line.startswith(prefix):
+                found = json.loads(line)
+    return found
+
+class Retention:
+    """Перенос старых закрытых диалогов в архив и сжатие файла базы.
+
+    Закрытые вопросы без сообщений за последние keep_days дней пачками дописываются в сжатые
+    файлы по месяцу вопроса (archive_dir/questions_ГГГГ-ММ.jsonl.gz, строка JSON на диалог)
+    и только после сброса файла на диск удаляются из questions и question_messages;
+    question_archive хранит, в каком файле искать диалог. Освободившиеся страницы возвращаются
+    файловой системе через incremental_vacuum небольшими шагами в потоке-писателе.
+    """
+
+    def __init__(self, database, archive_dir, keep_days, interval, batch_size, vacuum_pages):
+        self.db = database
+        self.archive_dir = archive_dir
+        self.keep_days = keep_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._incremental = None
+
+    async def archive(self):
+        """Перенос всех подходящих диалогов. Возвращает их число."""
+        total = 0
+        after = 0
+        while True:
+            batch = await self.db.read(_load_archivable_dialogs, self.keep_days, after, self.batch_size)
+            if not batch:
+                return total
+            entries = await asyncio.to_thread(_append_archive, self.archive_dir, batch)
+            archived = await self.db.write(_delete_archived_dialogs, entries)
+            metrics.inc('bot_retention_archived_total', archived)
+            total += archived
+            after = batch[-1]['id']
+            if len(batch) < self.batch_size:
+                return total
+
+    async def _auto_vacuum_mode(self):
+        # Режим читается через писателя: соединения-читатели видят прежнее значение до переоткрытия
+        return (await self.db.write(_fetchone, "PRAGMA auto_vacuum", ()))[0]
+
+    async def enable_incremental(self):
+        """Однократный перевод существующей базы в режим auto_vacuum=INCREMENTAL (команда /vacuum).
+
+        Полный VACUUM на всё время перестройки файла блокирует любую запись, поэтому
+        фоновая задача его не запускает. Возвращает длительность в секундах или None,
+        если база уже в нужном режиме.
+        """
+        if await self._auto_vacuum_mode() == 2:
+            self._incremental = True
+            return None
+        logger.info("Перевод базы в режим auto_vacuum=INCREMENTAL (полный VACUUM)...")
+        started = time.perf_counter()
+        await self.db.enable_incremental_vacuum()
+        elapsed = time.perf_counter() - started
+        self._incremental = await self._auto_vacuum_mode() == 2
+        logger.info("VACUUM завершен за %.2f с, режим INCREMENTAL: %s", elapsed, self._incremental)
+        return elapsed
+
+    async def vacuum(self):
+        """Возврат свободных страниц файловой системе по vacuum_pages за шаг. Возвращает число страниц."""
+        if self._incremental is None:
+            self._incremental = await self._auto_vacuum_mode() == 2
+            if not self._incremental:
+                logger.warning(
+                    "База не в режиме auto_vacuum=INCREMENTAL, место после архивации не освобождается. "
+                    "Для перевода выполните /vacuum (полный VACUUM блокирует запись на время перестройки)"
+                )
+        if not self._incremental:
+            return 0
+        freed = 0
+        while True:
+            step, left = await self.db.write(_incremental_vacuum, self.vacuum_pages)
+            freed += step
+            metrics.inc('bot_db_vacuumed_pages_total', step)
+            if not step or not left:
+                return freed
+            await asyncio.sleep(VACUUM_STEP_PAUSE)
+
+    async def transcript(self, question_id):
+        """Диалог по вопросу из базы, а если он уже перенесён - из архива. None, если не найден."""
+        dialog = await self.db.read(_load_dialog, question_id)
+        if dialog:
+            return dialog
+        row = await self.db.fetchone("SELECT archive FROM question_archive WHERE question_id = ?", (question_id,))
+        if not row:
+            return None
+        return await asyncio.to_thread(_read_archived_dialog, os.path.join(self.archive_dir, row[0]), question_id)
+
+    async def run(self):
+        while True:
+            try:
+                archived = await self.archive()
+                freed = await self.vacuum()
+                if archived or freed:
+                    logger.info("Перенесено в архив диалогов: %s, освобождено страниц базы: %s", archived, freed)
+            except Exception as e:
+                logger.error("Ошибка при переносе вопросов в архив: %s", e)
+            await asyncio.sleep(self.interval)
+
+retention = None
 
 async def broadcast(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
-    if user.id in ADMIN_IDS:
+    if user.id in config.admin_ids:
         # Инструкция для администратора
         instruction = (
             "📝 **Инструкция по созданию рассылки:**\n\n"
@@ -398,31 +2364,31 @@ async def handle_broadcast_input(update: Update, context: CallbackContext) -> No
     user = update.message.from_user
 
     # Проверяем, что это админ и находится в режиме ожидания рассылки
-    if user.id in ADMIN_IDS and context.user_data.get('waiting_for_broadcast'):
+    if user.id in config.admin_ids and context.user_data.get('waiting_for_broadcast'):
         # Проверяем, есть ли фото в сообщении
         if update.message.photo:
             photo_file = await update.message.photo[-1].get_file()
             context.user_data['broadcast_photo'] = photo_file.file_id
-            logger.info(f"Фото сохранено: {photo_file.file_id}")
+            logger.debug("Фото сохранено: %s", photo_file.file_id)
 
             # Сохраняем текст под фото (caption), если он есть
             if update.message.caption:
                 context.user_data['broadcast_message'] = update.message.caption
-                logger.info(f"Текст под фото (caption) сохранен: {update.message.caption}")
+                logger.debug("Текст под фото (caption) сохранен: %s", update.message.caption)
             else:
                 context.user_data['broadcast_message'] = ""
-                logger.info("Текст под фото отсутствует.")
+                logger.debug("Текст под фото отсутствует.")
         else:
             context.user_data['broadcast_photo'] = None
-            logger.info("Фото не прикреплено.")
+            logger.debug("Фото не прикреплено.")
 
             # Сохраняем обычный текст, если фото нет
             if update.message.text:
                 context.user_data['broadcast_message'] = update.message.text
-                logger.info(f"Текст сообщения сохранен: {update.message.text}")
+                logger.debug("Текст сообщения сохранен: %s", update.message.text)
             else:
                 context.user_data['broadcast_message'] = ""
-                logger.info("Текст сообщения отсутствует.")
+                logger.debug("Текст сообщения отсутствует.")
 
         # Предлагаем подтвердить отправку
         keyboard = [
@@ -444,50 +2410,24 @@ async def handle_broadcast_action(update: Update, context: CallbackContext) -> N
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    if user.id in ADMIN_IDS:
+    if user.id in config.admin_ids:
         message = context.user_data.get('broadcast_message')
         photo = context.user_data.get('broadcast_photo')
-        logger.info(f"Сообщение для рассылки: {message}")
-        logger.info(f"Фото для рассылки: {photo}")
+        logger.debug("Сообщение для рассылки: %s", message)
+        logger.debug("Фото для рассылки: %s", photo)
 
         if message or photo:
             if query.data == 'send_broadcast':
-                conn, cursor = get_db_connection()
                 try:
-                    cursor.execute("SELECT user_id FROM users")
-                    user_ids = [row[0] for row in cursor.fetchall()]
-                    successful = 0
-                    failed = 0
-                    for user_id in user_ids:
-                        try:
-                            if photo:
-                                # Отправляем фото с подписью (caption)
-                                await context.bot.send_photo(
-                                    chat_id=user_id,
-                                    photo=photo,
-                                    caption=message,
-                                    parse_mode='Markdown'  # Указываем, что текст содержит Markdown
-                                )
-                                logger.info(f"Фото отправлено пользователю {user_id}")
-                            else:
-                                # Отправляем только текст
-                                await context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=message,
-                                    parse_mode='Markdown'  # Указываем, что текст содержит Markdown
-                                )
-                                logger.info(f"Текст отправлен пользователю {user_id}")
-                            successful += 1
-                        except Exception as e:
-                            logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-                            failed += 1
-                    await query.edit_message_text(f"Рассылка завершена. Успешно отправлено: {successful}. Не удалось отправить: {failed}")
+                    # Рассылка идет в фоне, прогресс обновляется в этом же сообщении
+                    broadcast_id = await broadcast_engine.start(
+                        context.bot, user.id, query.message.chat_id, query.message.message_id, message, photo
+                    )
+                    await query.edit_message_text(f"Рассылка #{broadcast_id} запущена.")
                 except Exception as e:
-                    logger.error(f"Ошибка при рассылке: {e}")
-                    critical_logger.critical(f"Критическая ошибка при рассылке: {e}", exc_info=True)
+                    logger.error("Ошибка при рассылке: %s", e)
+                    critical_logger.critical("Критическая ошибка при рассылке: %s", e, exc_info=True)
                     await query.edit_message_text("Произошла ошибка при рассылке.")
-                finally:
-                    conn.close()
             elif query.data == 'cancel_broadcast':
                 await query.edit_message_text("Рассылка отменена.")
             elif query.data == 'back_from_broadcast':
@@ -500,48 +2440,16 @@ async def handle_broadcast_action(update: Update, context: CallbackContext) -> N
     context.user_data['broadcast_photo'] = None
     context.user_data['waiting_for_broadcast'] = False
 
-async def handle_mods_selection(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    if not user.is_bot:
-        logger.info(f"handle_mods_selection вызвана с текстом: {update.message.text}")
-        current_menu = context.user_data.get('current_menu', '')
-        selected_game = context.user_data.get('selected_game', 'ATS')
-        if update.message.text in ["Гайды", "Моды", "Социальные сети", "Обзор актуального патча"]:
-            if update.message.text == "Гайды":
-                await show_guides(update, context)
-            elif update.message.text == "Моды":
-                await show_mods(update, context)
-            elif update.message.text == "Социальные сети":
-                await show_social(update, context)
-            elif update.message.text == "Обзор актуального патча":
-                await show_patch(update, context, selected_game)
-        elif update.message.text == "Сборки карт" and selected_game == "ETS 2":
-            reply_markup = create_reply_markup(map_packs_keyboard)
-            await update.message.reply_text("Выберите сборку карт:", reply_markup=reply_markup)
-            context.user_data['previous_menu'] = 'ets_menu'
-            context.user_data['current_menu'] = 'map_packs'
-        elif update.message.text == "Золотая сборка Русских карт" and current_menu == 'map_packs':
-            await show_map_pack(update, context, "Золотая сборка Русских карт")
-        elif update.message.text == "Назад":
-            await go_back(update, context)
-        elif update.message.text == "Главное меню":
-            await main_menu(update, context)
-        elif update.message.text in ["Гайд для новичка", "Включить консоль и свободную камеру", "Консольные команды", "Конвой на 8+ человек", "Своё радио для ETS2 и ATS", "Настройка OCULUS QUEST 2/3 для ATS и ETS2"]:
-            await handle_guide_selection(update, context)
-        elif update.message.text == "Таблица модов":
-            await show_mods_table(update, context)
-        elif update.message.text == "Талисман 'Шмилфа' в кабину":
-            await show_schmilfa_in_cabin(update, context)
-        elif user.id in ADMIN_IDS and update.message.text == "Статистика":
-            await admin_stats(update, context)
-        elif user.id in ADMIN_IDS and update.message.text == "Выгрузить ID пользователей":
-            await export_user_ids(update, context)
-        elif user.id in ADMIN_IDS and update.message.text == "Рассылка":
-            await broadcast(update, context)
-        elif update.message.text == "Иммерсивные моды":
-            await show_immersive_mods(update, context)
+async def handle_broadcast_stop(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id in config.admin_ids:
+        broadcast_id = int(query.data.rsplit('_', 1)[-1])
+        await broadcast_engine.cancel(broadcast_id)
+        logger.info("Администратор %s остановил рассылку #%s", query.from_user.id, broadcast_id)
+        await query.edit_message_text(f"Рассылка #{broadcast_id} остановлена.")
     else:
-        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+        await query.edit_message_text("У вас нет доступа к этой функции.")
 
 # Убедимся, что ignore_text_input возвращает управление в меню
 async def ignore_text_input(update: Update, context: CallbackContext) -> None:
@@ -558,46 +2466,318 @@ async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     if not user.is_bot:
         user_id = user.id
-        logger.info(f"Пользователь {user_id} запустил бота.")
+        logger.info("Пользователь %s запустил бота.", user_id)
+        analytics.record('start', user_id)
+        # Ссылка t.me/<бот>?start=page_<id> из результата встроенного поиска
+        if context.args and re.fullmatch(r'page_\d+', context.args[0]):
+            path = search_index.path(int(context.args[0][5:]))
+            if path:
+                analytics.record('page', user_id, path)
+                await send_content_page(context.bot, update.effective_chat.id, path)
         await main_menu(update, context)
     else:
-        logger.warning(f"Бот {user.id} пытается запустить бота.")
+        logger.warning("Бот %s пытается запустить бота.", user.id)
         await update.message.reply_text("Извините, боты не могут использовать этого бота.")
 
+def _format_latency(histograms, labels_key):
+    """Строки вида «имя: вызовов, p50/p99» по гистограммам, самые нагруженные сверху."""
+    lines = []
+    for labels, (buckets, total, count) in sorted(histograms.items(), key=lambda item: -item[1][2]):
+        name = dict(labels).get(labels_key, '?')
+        p50 = metrics.quantile(buckets, 0.5) * 1000
+        p99 = metrics.quantile(buckets, 0.99) * 1000
+        lines.append(f"{name}: {count}, среднее {total / count * 1000:.0f} мс, p50 ≤{p50:g} мс, p99 ≤{p99:g} мс")
+    return lines
+
+async def show_metrics(update: Update, context: CallbackContext) -> None:
+    """Краткая сводка метрик для админов (/stats); полные данные - на config.metrics_port."""
+    user = update.message.from_user
+    if user.id not in config.admin_ids:
+        await update.message.reply_text("У вас нет доступа к этой функции.")
+        return
+    handler_errors = {}
+    for labels, value in metrics.counters('bot_handler_errors_total').items():
+        name = dict(labels)['handler']
+        handler_errors[name] = handler_errors.get(name, 0) + value
+    api_errors = sum(metrics.counters('bot_api_errors_total').values())
+    retry_after = sum(metrics.counters('bot_api_retry_after_total').values())
+    retry_seconds = sum(metrics.counters('bot_api_retry_after_seconds_total').values())
+
+    handlers = _format_latency(metrics.histograms('bot_handler_seconds'), 'handler')[:10]
+    handlers = [
+        line + (f", ошибок {handler_errors[line.split(':')[0]]}" if line.split(':')[0] in handler_errors else "")
+        for line in handlers
+    ]
+    database = _format_latency(metrics.histograms('bot_db_query_seconds'), 'operation')[:8]
+    waits = _format_latency(metrics.histograms('bot_db_wait_seconds'), 'mode')
+    api = _format_latency(metrics.histograms('bot_api_request_seconds'), 'method')[:8]
+    text = "\n".join([
+        "📊 Метрики с момента запуска",
+        "",
+        "Обработчики:", *(handlers or ["нет данных"]),
+        "",
+        "База данных:", *(database or ["нет данных"]),
+        "Ожидание потока БД:", *(waits or ["нет данных"]),
+        "",
+        f"Telegram API (ошибок {api_errors}, RetryAfter {retry_after}, пауза {retry_seconds:g} с):",
+        *(api or ["нет данных"]),
+    ])
+    await update.message.reply_text(text[:TELEGRAM_MESSAGE_LIMIT])
+
+# Экран «Статистика»: период в днях и страниц в топе каждой игры
+STATS_DAYS = 7
+STATS_TOP_PAGES = 3
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    return f"{minutes} мин" if minutes else f"{seconds} с"
+
+def render_stats(stats, update_stats):
+    """Текст экрана «Статистика» по агрегатам из _load_stats."""
+    today = stats['today']
+    active = dict(stats['days'])
+    totals = {}
+    value_sums = {}
+    today_counts = {}
+    pages = {}
+    for day, kind, name, game, count, value_sum in stats['daily']:
+        totals[kind] = totals.get(kind, 0) + count
+        value_sums[kind] = value_sums.get(kind, 0) + value_sum
+        if day == today:
+            today_counts[kind] = today_counts.get(kind, 0) + count
+        if kind == 'page':
+            game_pages = pages.setdefault(game, {})
+            game_pages[name] = game_pages.get(name, 0) + count
+
+    average_active = round(sum(active.values()) / len(active)) if active else 0
+    lines = [
+        f"Количество пользователей в базе данных: {stats['users']}",
+        f"Активных пользователей: сегодня {active.get(today, 0)}, в среднем за день {average_active} "
+        f"(за {STATS_DAYS} дн.)",
+        f"Вопросов: сегодня {today_counts.get('question', 0)}, за {STATS_DAYS} дн. {totals.get('question', 0)}, "
+        f"закрыто {totals.get('question_closed', 0)}",
+    ]
+    if totals.get('question_taken'):
+        lines.append(
+            "Среднее время до ответа: " + _format_duration(value_sums['question_taken'] / totals['question_taken'])
+        )
+    lines.append(
+        f"Поисковых запросов: {totals.get('search', 0)} в боте, {totals.get('inline_search', 0)} во встроенном режиме"
+    )
+    # Сначала игры по алфавиту, затем страницы, открытые из поиска (без игры)
+    for game in sorted(pages, key=lambda game: (game == '', game)):
+        top = sorted(pages[game].items(), key=lambda item: -item[1])[:STATS_TOP_PAGES]
+        lines.append(f"\nПопулярные страницы - {game or 'из поиска'}:")
+        lines.extend(
+            f"{number}. {SEARCH_PAGES.get(path, (path,))[0]} - {count}" for number, (path, count) in enumerate(top, 1)
+        )
+    lines.append(
+        f"\nОбновления: в обработке {update_stats['running']}, ожидают {update_stats['waiting']} "
+        f"(максимум {update_stats['max_waiting']}), в очереди {update_stats['update_queue']}"
+    )
+    return "\n".join(lines)
+
 async def admin_stats(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
-    if user.id in ADMIN_IDS:
-        conn, cursor = get_db_connection()
+    if user.id in config.admin_ids:
         try:
-            cursor.execute("SELECT COUNT(*) FROM users")
-            count = cursor.fetchone()[0]
-            logger.info(f"Администратор {user.id} запросил статистику. Количество пользователей: {count}")
-            await update.message.reply_text(f"Количество пользователей в базе данных: {count}")
+            await user_registry.flush()
+            # Агрегаты пересчитывает только фоновая задача аналитики, экран читает готовые
+            stats = await db.read(_load_stats, STATS_DAYS)
+            logger.info("Администратор %s запросил статистику. Количество пользователей: %s", user.id, stats['users'])
+            await update.message.reply_text(render_stats(stats, context.application.queue_stats()))
         except Exception as e:
-            logger.error(f"Ошибка при запросе статистики: {e}")
-            critical_logger.critical(f"Критическая ошибка при запросе статистики: {e}", exc_info=True)
+            logger.error("Ошибка при запросе статистики: %s", e)
+            critical_logger.critical("Критическая ошибка при запросе статистики: %s", e, exc_info=True)
             await update.message.reply_text("Произошла ошибка при запросе статистики.")
-        finally:
-            conn.close()
     else:
-        logger.warning(f"Пользователь {user.id} без прав администратора попытался запросить статистику.")
+        logger.warning("Пользователь %s без прав администратора попытался запросить статистику.", user.id)
         await update.message.reply_text("У вас нет доступа к этой функции.")
 
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_USAGE = (
+    "Использование: /export [csv|jsonl] [gz] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [active=ДНЕЙ]\n"
+    "from/to - дата регистрации, active - были активны за последние N дней."
+)
+
+def parse_export_args(args):
+    """Разбор аргументов /export. Бросает ValueError при некорректном аргументе."""
+    options = {'fmt': 'csv', 'compress': False, 'created_from': None, 'created_to': None, 'active_days': None}
+    for arg in args:
+        key, _, value = arg.lower().partition('=')
+        if key in EXPORT_FORMATS and not value:
+            options['fmt'] = key
+        elif key in ('gz', 'gzip') and not value:
+            options['compress'] = True
+        elif key in ('from', 'to') and value:
+            options['created_' + key] = date.fromisoformat(value).isoformat()
+        elif key == 'active' and value.isdigit() and int(value) > 0:
+            options['active_days'] = int(value)
+        else:
+            raise ValueError(f"неизвестный аргумент {arg}")
+    return options
+
+def _export_users(conn, path, fmt='csv', compress=False, created_from=None, created_to=None,
+                  active_days=None, chunk_size=5000):
+    """Потоковая выгрузка пользователей в файл пачками по users.id. Возвращает число строк."""
+    sql = (
+        "SELECT u.id, u.user_id, u.created_at, s.updated_at FROM users u "
+        "LEFT JOIN user_state s ON s.user_id = u.user_id WHERE u.id > ?"
+    )
+    params = []
+    if created_from:
+        sql += " AND u.created_at >= ?"
+        params.append(created_from)
+    if created_to:
+        sql += " AND u.created_at < date(?, '+1 day')"
+        params.append(created_to)
+    if active_days:
+        sql += " AND s.updated_at >= datetime('now', ?)"
+        params.append(f"-{active_days} days")
+    sql += " ORDER BY u.id LIMIT ?"
+
+    opener = gzip.open if compress else open
+    count = 0
+    last_row = 0
+    with opener(path, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(('user_id', 'created_at', 'last_active'))
+        while True:
+            rows = conn.execute(sql, (last_row, *params, chunk_size)).fetchall()
+            if not rows:
+                break
+            for _, user_id, created_at, last_active in rows:
+                if writer:
+                    writer.writerow((user_id, created_at or '', last_active or ''))
+                else:
+                    f.write(json.dumps(
+                        {'user_id': user_id, 'created_at': created_at, 'last_active': last_active}
+                    ) + '\n')
+            count += len(rows)
+            last_row = rows[-1][0]
+    return count
+
 async def export_user_ids(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
-    if user.id in ADMIN_IDS:
-        conn, cursor = get_db_connection()
+    if user.id in config.admin_ids:
+        try:
+            options = parse_export_args(context.args or [])
+        except ValueError as e:
+            await update.message.reply_text(f"Ошибка: {e}.\n{EXPORT_USAGE}")
+            return
+        filename = f"users_{datetime.now():%Y%m%d_%H%M%S}.{options['fmt']}" + ('.gz' if options['compress'] else '')
+        fd, path = tempfile.mkstemp(suffix='_' + filename)
+        os.close(fd)
         try:
-            cursor.execute("SELECT user_id FROM users")
-            user_ids = [row[0] for row in cursor.fetchall()]
-            with open('user_ids.json', 'w') as json_file:
-                json.dump(user_ids, json_file)
-            await update.message.reply_text("ID пользователей выгружены в user_ids.json.")
+            await update.message.reply_text("Выгрузка пользователей началась, файл будет отправлен по готовности.")
+            await user_registry.flush()
+            count = await db.read(functools.partial(
+                _export_users, path=path, chunk_size=config.export_chunk_size, **options
+            ))
+            logger.info("Администратор %s выгрузил пользователей: %s (%s)", user.id, count, filename)
+            with open(path, 'rb') as document:
+                await update.message.reply_document(
+                    document,
+                    filename=filename,
+                    caption=f"Пользователей в выгрузке: {count}",
+                    write_timeout=120
+                )
         except Exception as e:
-            logger.error(f"Ошибка при выгрузке ID пользователей: {e}")
+            logger.error("Ошибка при выгрузке ID пользователей: %s", e)
             await update.message.reply_text("Произошла ошибка при выгрузке ID пользователей.")
         finally:
-            conn.close()
+            os.remove(path)
+    else:
+        await update.message.reply_text("У вас нет доступа к этой функции.")
+
+TRANSCRIPT_USAGE = "Использование: /transcript <номер вопроса>, например /transcript 42."
+
+def render_transcript(dialog):
+    """Текст переписки по вопросу для админа. Время - UTC, как в базе."""
+    lines = [
+        f"Вопрос #{dialog['id']} от пользователя {dialog['user_id']} ({dialog['created_at']})",
+        f"Статус: {dialog['status']}, администратор: {dialog['admin_id'] or '-'}",
+        "",
+        dialog['question'],
+    ]
+    if dialog['messages']:
+        lines.append("")
+    for message in dialog['messages']:
+        sender = "Пользователь" if message['sender_id'] == dialog['user_id'] else f"Админ {message['sender_id']}"
+        lines.append(f"[{message['sent_at']}] {sender}: {message['text']}")
+    return "\n".join(lines)
+
+async def show_transcript(update: Update, context: CallbackContext) -> None:
+    user = update.message.from_user
+    if user.id in config.admin_ids:
+        args = context.args or []
+        if len(args) != 1 or not args[0].lstrip('#').isdigit():
+            await update.message.reply_text(TRANSCRIPT_USAGE)
+            return
+        question_id = int(args[0].lstrip('#'))
+        try:
+            dialog = await retention.transcript(question_id)
+            if dialog is None:
+                await update.message.reply_text(f"Вопрос #{question_id} не найден ни в базе, ни в архиве.")
+                return
+            logger.info("Администратор %s запросил переписку по вопросу #%s", user.id, question_id)
+            text = render_transcript(dialog)
+            if _utf16_length(text) <= TELEGRAM_MESSAGE_LIMIT:
+                await update.message.reply_text(text)
+            else:
+                await update.message.reply_document(
+                    text.encode('utf-8'), filename=f"question_{question_id}.txt", write_timeout=120
+                )
+        except Exception as e:
+            logger.error("Ошибка при загрузке переписки по вопросу #%s: %s", question_id, e)
+            await update.message.reply_text("Произошла ошибка при загрузке переписки.")
+    else:
+        await update.message.reply_text("У вас нет доступа к этой функции.")
+
+async def vacuum_database(update: Update, context: CallbackContext) -> None:
+    user = update.message.from_user
+    if user.id in config.admin_ids:
+        try:
+            await update.message.reply_text(
+                "Перевод базы в режим постепенного сжатия. Запись в базу приостановлена до завершения."
+            )
+            size = os.path.getsize(db.path)
+            elapsed = await retention.enable_incremental()
+            if elapsed is None:
+                await update.message.reply_text("База уже в режиме постепенного сжатия.")
+                return
+            logger.info("Администратор %s выполнил VACUUM базы за %.2f с", user.id, elapsed)
+            await update.message.reply_text(
+                f"Готово за {elapsed:.1f} с. Размер базы: {size / 2 ** 20:.1f} -> "
+                f"{os.path.getsize(db.path) / 2 ** 20:.1f} МБ."
+            )
+        except Exception as e:
+            logger.error("Ошибка при VACUUM базы: %s", e)
+            critical_logger.critical("Критическая ошибка при VACUUM базы: %s", e, exc_info=True)
+            await update.message.reply_text("Произошла ошибка при сжатии базы.")
+    else:
+        await update.message.reply_text("У вас нет доступа к этой функции.")
+
+async def reload_content(update: Update, context: CallbackContext) -> None:
+    user = update.message.from_user
+    if user.id in config.admin_ids:
+        try:
+            changed = await asyncio.to_thread(content_store.refresh)
+            await sync_search_index()
+            logger.info("Администратор %s обновил контент. Изменено файлов: %s", user.id, changed)
+            text = f"Контент обновлен. Изменено файлов: {changed}"
+            if content_store.errors:
+                text += "\n\nОшибки разметки (файлы отправляются без форматирования):\n" + "\n".join(
+                    f"{path}: {error}" for path, error in sorted(content_store.errors.items())
+                )
+            await update.message.reply_text(text)
+        except Exception as e:
+            logger.error("Ошибка при обновлении контента: %s", e)
+            await update.message.reply_text("Произошла ошибка при обновлении контента.")
     else:
         await update.message.reply_text("У вас нет доступа к этой функции.")
 
@@ -606,25 +2786,17 @@ def archive_logs(source, destination):
     if os.path.exists(source):
         os.rename(source, os.path.join(destination, os.path.basename(source)))
 
-def bot_namer(default_name):
-    archive_logs(default_name, archive_bot_dir)
-    return default_name
-
-def critical_namer(default_name):
-    archive_logs(default_name, archive_critical_dir)
-    return default_name
-
-bot_handler.namer = bot_namer
-critical_handler.namer = critical_namer
+DIALOG_CLOSED_BY_ADMIN = (
+    "ℹ️ Администратор завершил диалог по вашему вопросу.\n"
+    "Если у вас остались вопросы, вы можете задать новый."
+)
 
 async def ask_question(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
-    logger.info(f"Пользователь {user.id} начал процесс задавания вопроса")
+    logger.info("Пользователь %s начал процесс задавания вопроса", user.id)
     context.user_data['awaiting_question'] = True
     await update.message.reply_text("Введите ваш вопрос:")
-    context.user_data['previous_menu'] = 'main_menu'
-    context.user_data['current_menu'] = 'ask_question'
-    logger.debug(f"Для пользователя {user.id} установлен флаг awaiting_question")
+    logger.debug("Для пользователя %s установлен флаг awaiting_question", user.id)
 
 async def handle_question_input(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
@@ -632,19 +2804,17 @@ async def handle_question_input(update: Update, context: CallbackContext) -> Non
         # Если пользователь в режиме ожидания вопроса
         if context.user_data.get('awaiting_question'):
             question_text = update.message.text
-            logger.info(f"Получен вопрос от пользователя {user.id}: {question_text}")
+            logger.info("Получен вопрос от пользователя %s: %s", user.id, question_text)
 
             try:
-                conn, cursor = get_db_connection()
-                logger.debug("Установлено соединение с БД для сохранения вопроса")
-
-                cursor.execute(
-                    "INSERT INTO questions (user_id, question_text, status) VALUES (?, ?, 'open')",
-                    (user.id, question_text)
+                # Вопрос и уведомления админам записываются вместе, доставляет их outbox
+                question_id = await outbox.write(
+                    _insert_question_for_admins, user.id, user.username or user.id, question_text, config.admin_ids
                 )
-                question_id = cursor.lastrowid
-                conn.commit()
-                logger.info(f"Вопрос сохранен в БД с ID {question_id}")
+                dialogs.open(user.id, question_id)
+                analytics.record('question', user.id)
+                logger.info("Вопрос сохранен в БД с ID %s, уведомлений админам в очереди: %s",
+                            question_id, len(config.admin_ids))
 
                 await update.message.reply_text(
                     "✅ Ваш вопрос отправлен администратору. С вами свяжутся в ближайшее время."
@@ -654,92 +2824,45 @@ async def handle_question_input(update: Update, context: CallbackContext) -> Non
                 await main_menu(update, context)
                 logger.debug("Пользователь возвращен в главное меню")
 
-                admin_count = 0
-                for admin_id in ADMIN_IDS:
-                    try:
-                        keyboard = [
-                            [InlineKeyboardButton("Ответить", callback_data=f"answer_{question_id}")],
-                            [InlineKeyboardButton("Закрыть", callback_data=f"close_{question_id}")]
-                        ]
-                        await context.bot.send_message(
-                            admin_id,
-                            f"📩 Новый вопрос #{question_id} от @{user.username or user.id}:\n\n{question_text}",
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
-                        admin_count += 1
-                        logger.debug(f"Уведомление отправлено администратору {admin_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при уведомлении админа {admin_id}: {str(e)}")
-
-                logger.info(f"Всего уведомлено {admin_count} администраторов из {len(ADMIN_IDS)}")
-
             except Exception as e:
-                logger.error(f"Ошибка при обработке вопроса: {str(e)}")
+                logger.error("Ошибка при обработке вопроса: %s", e)
                 await update.message.reply_text("⚠️ Произошла ошибка при обработке вопроса. Пожалуйста, попробуйте позже.")
             finally:
-                if 'conn' in locals():
-                    conn.close()
                 context.user_data.pop('awaiting_question', None)
                 logger.debug("Флаг awaiting_question сброшен")
 
         # Если админ в диалоге
         elif 'active_question' in context.user_data:
             question_id = context.user_data['active_question']
-            conn, cursor = get_db_connection()
             try:
-                cursor.execute("SELECT user_id, status FROM questions WHERE id = ?", (question_id,))
-                result = cursor.fetchone()
-                if result:
-                    user_id, status = result
-                    logger.debug(f"Статус вопроса ID {question_id}: {status}")
-                    if status == 'in_progress':
-                        cursor.execute(
-                            "INSERT INTO question_messages (question_id, sender_id, message_text) VALUES (?, ?, ?)",
-                            (question_id, user.id, update.message.text)
-                        )
-                        conn.commit()
-
-                        await context.bot.send_message(
-                            user_id,
-                            f"Администратор: {update.message.text}"
-                        )
-                    else:
-                        await update.message.reply_text("Диалог завершен. Вы не можете отправлять сообщения.")
+                user_id = dialogs.user_for(question_id)
+                if user_id is not None:
+                    await outbox.write(
+                        _relay_question_message, question_id, user.id, update.message.text,
+                        user_id, f"Администратор: {update.message.text}"
+                    )
                 else:
-                    await update.message.reply_text("Вопрос не найден.")
+                    await update.message.reply_text("Диалог завершен. Вы не можете отправлять сообщения.")
             except Exception as e:
-                logger.error(f"Ошибка в диалоге админа: {e}")
+                logger.error("Ошибка в диалоге админа: %s", e)
                 await update.message.reply_text("Произошла ошибка.")
-            finally:
-                conn.close()
 
         # Если пользователь отправляет сообщение
         else:
-            conn, cursor = get_db_connection()
             try:
-                cursor.execute(
-                    "SELECT id, admin_id, status FROM questions WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
-                    (user.id,)
-                )
-                question = cursor.fetchone()
+                question = dialogs.for_user(user.id)
                 if question:
-                    question_id, admin_id, status = question
-                    logger.debug(f"Последний вопрос пользователя {user.id}: ID {question_id}, статус {status}")
-                    if status == 'in_progress':
-                        cursor.execute(
-                            "INSERT INTO question_messages (question_id, sender_id, message_text) VALUES (?, ?, ?)",
-                            (question_id, user.id, update.message.text)
-                        )
-                        conn.commit()
-
-                        await context.bot.send_message(
-                            admin_id,
-                            f"Пользователь {user.id}: {update.message.text}"
+                    question_id, admin_id = question
+                    logger.debug("Незакрытый вопрос пользователя %s: ID %s, админ %s", user.id, question_id, admin_id)
+                    if admin_id is not None:
+                        await outbox.write(
+                            _relay_question_message, question_id, user.id, update.message.text,
+                            admin_id, f"Пользователь {user.id}: {update.message.text}"
                         )
                     else:
                         await update.message.reply_text(
-                            "Диалог по вашему вопросу завершен или еще не начат. "
-                            "Если у вас есть новый вопрос, выберите 'Задать вопрос' в меню.",
+                            "Диалог по вашему вопросу еще не начат. "
+                            "Администратор свяжется с вами в ближайшее время.",
                             reply_markup=create_reply_markup(main_keyboard)
                         )
                 else:
@@ -748,10 +2871,8 @@ async def handle_question_input(update: Update, context: CallbackContext) -> Non
                         reply_markup=create_reply_markup(main_keyboard)
                     )
             except Exception as e:
-                logger.error(f"Ошибка при обработке сообщения пользователя: {e}")
+                logger.error("Ошибка при обработке сообщения пользователя: %s", e)
                 await update.message.reply_text("Произошла ошибка.")
-            finally:
-                conn.close()
     else:
         await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
 
@@ -762,43 +2883,21 @@ async def handle_dialog_message(update: Update, context: CallbackContext) -> Non
     # Если сообщение от админа в диалоге
     if 'active_question' in context.user_data:
         question_id = context.user_data['active_question']
-        conn, cursor = get_db_connection()
-        cursor.execute("SELECT user_id FROM questions WHERE id = ?", (question_id,))
-        user_id = cursor.fetchone()[0]
-
-        # Сохраняем сообщение в БД
-        cursor.execute(
-            "INSERT INTO question_messages (question_id, sender_id, message_text) VALUES (?, ?, ?)",
-            (question_id, user.id, message_text)
-        )
-        conn.commit()
-
-        # Пересылаем пользователю
-        await context.bot.send_message(
-            user_id,
-            f"Администратор: {message_text}"
-        )
+        user_id = dialogs.user_for(question_id)
+        if user_id is not None:
+            # Сохраняем сообщение в БД и ставим пересылку пользователю в очередь
+            await outbox.write(
+                _relay_question_message, question_id, user.id, message_text, user_id, f"Администратор: {message_text}"
+            )
 
     # Если сообщение от пользователя в открытом вопросе
     else:
-        conn, cursor = get_db_connection()
-        cursor.execute(
-            "SELECT id, admin_id FROM questions WHERE user_id = ? AND status = 'in_progress'",
-            (user.id,)
-        )
-        question = cursor.fetchone()
-        if question:
+        question = dialogs.for_user(user.id)
+        if question and question[1] is not None:
             question_id, admin_id = question
-            # Сохраняем сообщение
-            cursor.execute(
-                "INSERT INTO question_messages (question_id, sender_id, message_text) VALUES (?, ?, ?)",
-                (question_id, user.id, message_text)
-            )
-            conn.commit()
-
-            # Пересылаем админу
-            await context.bot.send_message(
-                admin_id,
+            # Пересылка админу через очередь
+            await outbox.write(
+                _relay_question_message, question_id, user.id, message_text, admin_id,
                 f"Пользователь {user.id}: {message_text}"
             )
 
@@ -807,67 +2906,46 @@ async def end_dialog(update: Update, context: CallbackContext) -> None:
 
     if 'active_question' in context.user_data:  # Если это админ
         question_id = context.user_data.pop('active_question')
-        conn, cursor = get_db_connection()
         try:
-            # Обновляем статус вопроса на "closed"
-            cursor.execute("UPDATE questions SET status = 'closed' WHERE id = ?", (question_id,))
-            cursor.execute("SELECT user_id FROM questions WHERE id = ?", (question_id,))
-            result = cursor.fetchone()
-            if result:
-                user_id = result[0]
-                conn.commit()
-
+            # Обновляем статус вопроса на "closed" и ставим уведомление пользователю в очередь
+            user_id = await outbox.write(
+                _close_question_with_notice, question_id, DIALOG_CLOSED_BY_ADMIN, create_reply_markup(main_keyboard)
+            )
+            dialogs.close(question_id)
+            analytics.record('question_closed', user.id)
+            if user_id:
                 await update.message.reply_text("Диалог завершен. Вы вернулись в обычный режим.")
-                # Уведомляем пользователя
-                await context.bot.send_message(
-                    user_id,
-                    "ℹ️ Администратор завершил диалог по вашему вопросу.\n"
-                    "Если у вас остались вопросы, вы можете задать новый.",
-                    reply_markup=create_reply_markup(main_keyboard)
-                )
             else:
                 await update.message.reply_text("Вопрос не найден.")
         except Exception as e:
-            logger.error(f"Ошибка при завершении диалога: {e}")
+            logger.error("Ошибка при завершении диалога: %s", e)
             await update.message.reply_text("Произошла ошибка при завершении диалога.")
-        finally:
-            conn.close()
 
     else:  # Если это пользователь
-        conn, cursor = get_db_connection()
         try:
-            cursor.execute(
-                "SELECT id, admin_id, status FROM questions WHERE user_id = ? AND status = 'in_progress'",
-                (user.id,)
-            )
-            question = cursor.fetchone()
-            if question:
-                question_id, admin_id, status = question
-                cursor.execute(
-                    "UPDATE questions SET status = 'closed' WHERE id = ?",
-                    (question_id,)
+            question = dialogs.for_user(user.id)
+            if question and question[1] is not None:
+                question_id, admin_id = question
+                # Уведомление администратору уходит через очередь
+                await outbox.write(
+                    _close_question_with_notice, question_id,
+                    f"Пользователь {user.id} завершил диалог по вопросу ID {question_id}.", None, admin_id
                 )
-                conn.commit()
+                dialogs.close(question_id)
+                analytics.record('question_closed', user.id)
                 await update.message.reply_text(
                     "Диалог с администратором завершен.\n"
                     "Вы можете продолжать пользоваться ботом или задать новый вопрос.",
                     reply_markup=create_reply_markup(main_keyboard)
                 )
-                # Уведомляем администратора
-                await context.bot.send_message(
-                    admin_id,
-                    f"Пользователь {user.id} завершил диалог по вопросу ID {question_id}."
-                )
             else:
                 await update.message.reply_text(
                     "У вас нет активного диалога.",
                     reply_markup=create_reply_markup(main_keyboard)
                 )
         except Exception as e:
-            logger.error(f"Ошибка при завершении диалога пользователем: {e}")
+            logger.error("Ошибка при завершении диалога пользователем: %s", e)
             await update.message.reply_text("Произошла ошибка при завершении диалога.")
-        finally:
-            conn.close()
 
 async def handle_admin_action(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
@@ -875,7 +2953,7 @@ async def handle_admin_action(update: Update, context: CallbackContext) -> None:
     data = query.data
     admin_id = query.from_user.id
 
-    logger.info(f"Получен callback_data: {data}")
+    logger.debug("Получен callback_data: %s", data)
 
     # Разделяем callback_data и проверяем формат
     try:
@@ -887,29 +2965,16 @@ async def handle_admin_action(update: Update, context: CallbackContext) -> None:
         question_id = int(parts[-1])
     except (ValueError, IndexError) as e:
         await query.edit_message_text("Ошибка: некорректный запрос. Попробуйте снова.")
-        logger.error(f"Некорректный callback_data: {data}, ошибка: {str(e)}")
+        logger.error("Некорректный callback_data: %s, ошибка: %s", data, e)
         return
 
     if action == "answer":
-        conn, cursor = get_db_connection()
         try:
-            cursor.execute("SELECT user_id, question_text FROM questions WHERE id = ?", (question_id,))
-            question = cursor.fetchone()
-
+            question = await outbox.write(_take_question_for_user, question_id, admin_id)
             if question:
-                user_id, question_text = question
-                cursor.execute(
-                    "UPDATE questions SET status = 'in_progress', admin_id = ? WHERE id = ?",
-                    (admin_id, question_id)
-                )
-                conn.commit()
-
-                await context.bot.send_message(
-                    user_id,
-                    "🛎 Администратор начал работу по вашему вопросу!\n\n"
-                    f"Ваш вопрос: {question_text}\n\n"
-                    "Теперь вы можете общаться напрямую. Чтобы завершить диалог, отправьте /end_dialog"
-                )
+                user_id, question_text, waited = question
+                analytics.record('question_taken', admin_id, value=waited)
+                dialogs.take(user_id, question_id, admin_id)
 
                 context.user_data['active_question'] = question_id
                 keyboard = [
@@ -924,143 +2989,1195 @@ async def handle_admin_action(update: Update, context: CallbackContext) -> None:
             else:
                 await query.edit_message_text("Вопрос не найден.")
         except Exception as e:
-            logger.error(f"Ошибка при начале диалога: {e}")
+            logger.error("Ошибка при начале диалога: %s", e)
             await query.edit_message_text("Произошла ошибка.")
-        finally:
-            conn.close()
 
     elif action == "close":
-        conn, cursor = get_db_connection()
         try:
-            cursor.execute(
-                "UPDATE questions SET status = 'closed' WHERE id = ?",
-                (question_id,)
+            user_id = await outbox.write(
+                _close_question_with_notice, question_id, "Ваш вопрос был закрыт администратором."
             )
-            cursor.execute("SELECT user_id FROM questions WHERE id = ?", (question_id,))
-            result = cursor.fetchone()
-            if result:
-                user_id = result[0]
-                conn.commit()
+            dialogs.close(question_id)
+            analytics.record('question_closed', admin_id)
+            if user_id:
                 await query.edit_message_text(f"❌ Вопрос ID {question_id} закрыт.")
-                await context.bot.send_message(
-                    user_id,
-                    "Ваш вопрос был закрыт администратором."
-                )
             else:
                 await query.edit_message_text("Вопрос не найден.")
         except Exception as e:
-            logger.error(f"Ошибка при закрытии вопроса: {e}")
+            logger.error("Ошибка при закрытии вопроса: %s", e)
             await query.edit_message_text("Произошла ошибка.")
-        finally:
-            conn.close()
 
     elif action == "end":
         if 'active_question' in context.user_data and context.user_data['active_question'] == question_id:
-            conn, cursor = get_db_connection()
             try:
-                cursor.execute("UPDATE questions SET status = 'closed' WHERE id = ?", (question_id,))
-                cursor.execute("SELECT user_id FROM questions WHERE id = ?", (question_id,))
-                result = cursor.fetchone()
-                if result:
-                    user_id = result[0]
-                    conn.commit()
-
+                user_id = await outbox.write(
+                    _close_question_with_notice, question_id, DIALOG_CLOSED_BY_ADMIN, create_reply_markup(main_keyboard)
+                )
+                dialogs.close(question_id)
+                analytics.record('question_closed', admin_id)
+                if user_id:
                     await query.edit_message_text("Диалог завершен. Вы вернулись в обычный режим.")
-                    await context.bot.send_message(
-                        user_id,
-                        "ℹ️ Администратор завершил диалог по вашему вопросу.\n"
-                        "Если у вас остались вопросы, вы можете задать новый.",
-                        reply_markup=create_reply_markup(main_keyboard)
-                    )
                     context.user_data.pop('active_question', None)
                 else:
                     await query.edit_message_text("Вопрос не найден.")
             except Exception as e:
-                logger.error(f"Ошибка при завершении диалога: {e}")
+                logger.error("Ошибка при завершении диалога: %s", e)
                 await query.edit_message_text("Произошла ошибка при завершении диалога.")
-            finally:
-                conn.close()
         else:
             await query.edit_message_text("Вы не в активном диалоге с этим вопросом.")
 
+# Входящие вопросы для админов: одно сообщение со страницами по config.inbox_page_size вопросов
+INBOX_PREVIEW_LENGTH = 300
+# Фильтр по статусу: ключ в callback_data -> (подпись, статусы)
+INBOX_STATUSES = {
+    'all': ("все незакрытые", ('open', 'in_progress')),
+    'open': ("новые", ('open',)),
+    'work': ("в работе", ('in_progress',)),
+}
+# Фильтр по возрасту: минимальный возраст вопроса в днях (0 - любые)
+INBOX_AGES = (0, 1, 7)
+
+def _fetch_inbox_page(conn, statuses, min_age_days, direction, anchor, page_size):
+    """Страница вопросов с ключевой пагинацией по id.
+
+    direction 'n' - вопросы с id > anchor по возрастанию, 'p' - предыдущая страница перед anchor.
+    Возвращает (rows, has_prev, has_next, total).
+    """
+    where = f"status IN ({', '.join('?' for _ in statuses)})"
+    params = list(statuses)
+    if min_age_days:
+        where += " AND created_at <= datetime('now', ?)"
+        params.append(f"-{min_age_days} days")
+    total = conn.execute(f"SELECT COUNT(*) FROM questions WHERE {where}", params).fetchone()[0]
+    select = f"SELECT id, user_id, question_text, status, created_at FROM questions WHERE {where}"
+    if direction == 'n' and anchor and conn.execute(
+        f"SELECT 1 FROM questions WHERE {where} AND id > ? LIMIT 1", (*params, anchor)
+    ).fetchone() is None:
+        # Вопросы дальше закрыты - показываем последнюю страницу вместо пустой
+        direction, anchor = 'p', anchor + 1
+    if direction == 'p':
+        rows = conn.execute(
+            f"{select} AND id < ? ORDER BY id DESC LIMIT ?", (*params, anchor, page_size + 1)
+        ).fetchall()
+        has_prev = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_next = bool(rows) and conn.execute(
+            f"SELECT 1 FROM questions WHERE {where} AND id > ? LIMIT 1", (*params, rows[-1][0])
+        ).fetchone() is not None
+    else:
+        rows = conn.execute(
+            f"{select} AND id > ? ORDER BY id LIMIT ?", (*params, anchor, page_size + 1)
+        ).fetchall()
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_prev = bool(rows) and conn.execute(
+            f"SELECT 1 FROM questions WHERE {where} AND id < ? LIMIT 1", (*params, rows[0][0])
+        ).fetchone() is not None
+    return rows, has_prev, has_next, total
+
+def _inbox_callback(status, age, direction, anchor):
+    return f"inbox:{status}:{age}:{direction}:{anchor}"
+
+async def render_inbox(status='all', age=0, direction='n', anchor=0):
+    """Текст и клавиатура страницы входящих вопросов."""
+    label, statuses = INBOX_STATUSES[status]
+    rows, has_prev, has_next, total = await db.read(
+        _fetch_inbox_page, statuses, age, direction, anchor, config.inbox_page_size
+    )
+    header = f"📥 Вопросы ({label}"
+    header += f", старше {age} дн." if age else ""
+    header += f"): {total}"
+    if not rows:
+        lines = [header, "", "Нет активных вопросов."]
+    else:
+        lines = [header]
+        for q_id, u_id, q_text, q_status, created_at in rows:
+            preview = q_text if len(q_text) <= INBOX_PREVIEW_LENGTH else q_text[:INBOX_PREVIEW_LENGTH] + "…"
+            mark = "🟢" if q_status == 'open' else "💬"
+            lines.append(f"\n{mark} #{q_id} от {u_id}, {created_at}\n{preview}")
+
+    keyboard = [
+        [InlineKeyboardButton(f"Ответить #{q_id}", callback_data=f"answer_{q_id}"),
+         InlineKeyboardButton(f"Закрыть #{q_id}", callback_data=f"close_{q_id}")]
+        for q_id, *_ in rows
+    ]
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=_inbox_callback(status, age, 'p', rows[0][0])))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data=_inbox_callback(status, age, 'n', rows[-1][0])))
+    if navigation:
+        keyboard.append(navigation)
+    statuses_cycle = list(INBOX_STATUSES)
+    next_status = statuses_cycle[(statuses_cycle.index(status) + 1) % len(statuses_cycle)]
+    next_age = INBOX_AGES[(INBOX_AGES.index(age) + 1) % len(INBOX_AGES)] if age in INBOX_AGES else 0
+    current = rows[0][0] - 1 if rows else 0
+    keyboard.append([
+        InlineKeyboardButton(f"Статус: {label}", callback_data=_inbox_callback(next_status, age, 'n', 0)),
+        InlineKeyboardButton(f"Возраст: {f'{age}+ дн.' if age else 'любой'}",
+                             callback_data=_inbox_callback(status, next_age, 'n', 0)),
+        InlineKeyboardButton("🔄", callback_data=_inbox_callback(status, age, 'n', current)),
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
 async def show_questions(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
-    if user.id in ADMIN_IDS:
-        conn, cursor = get_db_connection()
+    if user.id in config.admin_ids:
         try:
-            cursor.execute("SELECT id, user_id, question_text FROM questions WHERE status != 'closed'")
-            questions = cursor.fetchall()
-
-            if not questions:
-                await update.message.reply_text("Нет активных вопросов.")
-                return
-
-            # Отправляем отдельное сообщение для каждого вопроса с кнопками
-            for q_id, u_id, q_text in questions:
-                keyboard = [
-                    [InlineKeyboardButton("Ответить", callback_data=f"answer_{q_id}")],
-                    [InlineKeyboardButton("Закрыть", callback_data=f"close_{q_id}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text(
-                    f"Вопрос ID: {q_id}\n"
-                    f"Пользователь: {u_id}\n"
-                    f"Текст: {q_text}",
-                    reply_markup=reply_markup
-                )
+            text, reply_markup = await render_inbox()
+            await update.message.reply_text(text, reply_markup=reply_markup)
             await update.message.reply_text(
                 "Выберите вопрос для обработки или вернитесь в меню.",
                 reply_markup=create_reply_markup([["Главное меню"]])
             )
 
         except Exception as e:
-            logger.error(f"Ошибка при отображении вопросов: {e}")
+            logger.error("Ошибка при отображении вопросов: %s", e)
             await update.message.reply_text("Произошла ошибка при загрузке вопросов.")
-        finally:
-            conn.close()
     else:
         await update.message.reply_text("У вас нет доступа к этой функции.")
 
-# Обновленная секция обработчиков
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("end_dialog", end_dialog))
+async def handle_inbox_page(update: Update, context: CallbackContext) -> None:
+    """Листание и фильтры входящих вопросов: сообщение редактируется на месте."""
+    query = update.callback_query
+    if query.from_user.id not in config.admin_ids:
+        await query.answer("У вас нет доступа к этой функции.")
+        return
+    await query.answer()
+    try:
+        _, status, age, direction, anchor = query.data.split(':')
+        text, reply_markup = await render_inbox(status, int(age), direction, int(anchor))
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            logger.warning("Не удалось обновить список вопросов: %s", e)
+    except Exception as e:
+        logger.error("Ошибка при листании вопросов: %s", e)
 
-# Обработчики меню
-application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^(ATS|ETS 2|Админ)$'), handle_game_selection))
-application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^Задать вопрос$'), ask_question))
-application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^Вопросы$'), show_questions))
-application.add_handler(MessageHandler(
-    filters.TEXT & filters.Regex(r'^(Гайды|Моды|Иммерсивные моды|Обзор актуального патча|Социальные сети|Главное меню|Назад|Гайд для новичка|Включить консоль и свободную камеру|Консольные команды|Конвой на 8\+ человек|Своё радио для ETS2 и ATS|Настройка OCULUS QUEST 2/3 для ATS и ETS2|Статистика|Сборки карт|Золотая сборка Русских карт|Выгрузить ID пользователей|Рассылка|Таблица модов|Талисман \'Шмилфа\' в кабину)$'),
-    handle_mods_selection
-))
+class MenuNode:
+    """Узел дерева меню: подменю (rows), страница контента (content) или действие (action).
 
-# Обработчики рассылки (перемещаем выше handle_question_input)
-application.add_handler(MessageHandler(filters.PHOTO | (filters.TEXT & ~filters.COMMAND), handle_broadcast_input))
+    keep_keyboard - узел не меняет клавиатуру, текущим остаётся родительское меню.
+    """
 
-# Обработчик вопросов и диалогов (после рассылки)
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_question_input))
+    def __init__(self, label, prompt=None, rows=(), footer=(("Назад",),), content=None, missing=None,
+                 action=None, admin_only=False, keep_keyboard=False, game=None):
+        self.label = label
+        self.prompt = prompt
+        self.rows = [list(row) for row in rows]
+        self.footer = [list(row) for row in footer]
+        self.content = content
+        self.missing = missing
+        self.action = action
+        self.admin_only = admin_only
+        self.keep_keyboard = keep_keyboard
+        self.game = game
+        self.node_id = None
+        self.parent = None
 
-# Обработчики callback-запросов
-application.add_handler(CallbackQueryHandler(handle_admin_action, pattern=r'^(answer|close|end_dialog)_\d+$'))
-application.add_handler(CallbackQueryHandler(handle_broadcast_action, pattern=r'^(send_broadcast|cancel_broadcast|back_from_broadcast)$'))
+    @property
+    def children(self):
+        return [child for row in self.rows for child in row]
 
-# Запуск
-if __name__ == '__main__':
-    conn = None
+def guide_node(label, filename):
+    return MenuNode(label, content=f'guides/{filename}', missing=f"Гайд '{label}' не найден.")
+
+def game_menu_node(game):
+    """Меню игры; для ETS 2 добавляются сборки карт."""
+    rows = [
+        [MenuNode("Гайды", prompt="Выберите гайд:", rows=[
+            [guide_node("Гайд для новичка", "guide.md")],
+            [guide_node("Включить консоль и свободную камеру", "console_on.md")],
+            [guide_node("Консольные команды", "console_commands.md")],
+            [guide_node("Конвой на 8+ человек", "convoy_8plus.md")],
+            [guide_node("Своё радио для ETS2 и ATS", "radio.md")],
+            [guide_node("Настройка OCULUS QUEST 2/3 для ATS и ETS2", "oculus.md")],
+        ]),
+         MenuNode("Моды", prompt="Выберите опцию:", rows=[
+            [MenuNode("Таблица модов", content='mods/mods_table.md', keep_keyboard=True),
+             MenuNode("Талисман 'Шмилфа' в кабину", content=f'mods/schmilfa_in_cabin_{game.lower()}.md')],
+            [MenuNode("Иммерсивные моды", content=f'mods/immersive_mods_{game.lower()}.md')],
+        ])],
+        [MenuNode("Обзор актуального патча", content=f'patches/patch_{game.lower()}.md',
+                  missing=f"Обзор актуального патча для {game} не найден."),
+         MenuNode("Социальные сети", action=show_social)],
+    ]
+    if game == "ETS 2":
+        rows.append([MenuNode("Сборки карт", prompt="Выберите сборку карт:", rows=[
+            [MenuNode("Золотая сборка Русских карт", content='maps/gold_rus.md',
+                      missing="Информация о сборке карт 'Золотая сборка Русских карт' не найдена.")],
+        ])])
+    return MenuNode(game, prompt=f"Выберите опцию для {game}:", rows=rows, game=game)
+
+MENU_ROOT = MenuNode(None, prompt="Выберите игру :", footer=(), action=main_menu, rows=[
+    [game_menu_node("ATS"), game_menu_node("ETS 2")],
+    [MenuNode("Задать вопрос", action=ask_question)],
+    [MenuNode("Админ", prompt="Административное меню:", admin_only=True, footer=(("Главное меню",),), rows=[
+        [MenuNode("Статистика", action=admin_stats, keep_keyboard=True),
+         MenuNode("Выгрузить ID пользователей", action=export_user_ids, keep_keyboard=True)],
+        [MenuNode("Рассылка", action=broadcast, keep_keyboard=True),
+         MenuNode("Вопросы", action=show_questions)],
+        [MenuNode("Обновить контент", action=reload_content, keep_keyboard=True)],
+    ])],
+])
+
+# Индексы для маршрутизации: узел по id и переход по (текущий узел, текст кнопки)
+MENU_NODES = {}
+MENU_ROUTES = {}
+
+def build_menu_index(node, parent=None, path='main_menu', game=None):
+    node.parent = parent
+    node.node_id = path
+    node.game = node.game or game
+    if node.action:
+        # Действия меню вызываются из route_text, но получают метрики под собственным именем
+        node.action = instrument_handler(node.action)
+    MENU_NODES[path] = node
+    for child in node.children:
+        MENU_ROUTES[(path, child.label)] = child
+        build_menu_index(child, node, f'{path}/{child.label}', node.game)
+
+build_menu_index(MENU_ROOT)
+
+# Кнопки корневого и административного меню работают из любого места
+MENU_GLOBAL_ROUTES = {child.label: child for child in MENU_ROOT.children}
+MENU_GLOBAL_ROUTES.update({child.label: child for child in MENU_GLOBAL_ROUTES["Админ"].children})
+MENU_GLOBAL_ROUTES["Главное меню"] = MENU_ROOT
+
+def build_search_pages():
+    """Страницы меню для поиска: {путь к файлу: (заголовок, раздел)}.
+
+    Страница, доступная только из одной игры, получает игру в заголовке; раздел - подменю
+    внутри игры (Гайды, Моды, ...), у страниц прямо в меню игры раздела нет.
+    """
+    games = {}
+    nodes = {}
+    for node in MENU_NODES.values():
+        if node.content:
+            path = os.path.normpath(node.content)
+            nodes.setdefault(path, node)
+            games.setdefault(path, []).append(node.game)
+    pages = {}
+    for path, node in nodes.items():
+        title = node.label if len(games[path]) > 1 else f"{node.label} ({node.game})"
+        section = node.parent.label if node.parent.label != node.game else None
+        pages[path] = (title, section)
+    return pages
+
+SEARCH_PAGES = build_search_pages()
+
+def menu_keyboard(node, is_admin=False):
+    """Клавиатура подменю: кнопки дочерних узлов и нижний ряд."""
+    rows = []
+    for row in node.rows:
+        labels = [child.label for child in row if is_admin or not child.admin_only]
+        if labels:
+            rows.append(labels)
+    return rows + node.footer
+
+def resolve_menu(current_menu, text):
+    """Поиск узла по тексту кнопки с учётом текущего меню пользователя."""
+    node = MENU_NODES.get(current_menu, MENU_ROOT)
+    if text == "Назад":
+        return node.parent or MENU_ROOT
+    return MENU_ROUTES.get((node.node_id, text)) or MENU_GLOBAL_ROUTES.get(text)
+
+async def open_menu_node(update: Update, context: CallbackContext, node: MenuNode) -> None:
+    user = update.message.from_user
+    if node.admin_only and user.id not in config.admin_ids:
+        await update.message.reply_text("У вас нет доступа к этой функции.")
+        return
+    if node.game:
+        context.user_data['selected_game'] = node.game
+    if node.action:
+        analytics.record('action', user.id, node.label, node.game)
+        await node.action(update, context)
+    elif node.content:
+        analytics.record('page', user.id, os.path.normpath(node.content), node.game)
+        reply_markup = None if node.keep_keyboard else create_reply_markup(back_keyboard)
+        await send_content_page(context.bot, update.effective_chat.id, node.content, node.missing, reply_markup)
+    else:
+        analytics.record('menu', user.id, node.node_id, node.game)
+        reply_markup = keyboards.menu(node, user.id in config.admin_ids)
+        await update.message.reply_text(node.prompt, reply_markup=reply_markup)
+    context.user_data['current_menu'] = node.parent.node_id if node.keep_keyboard else node.node_id
+
+async def send_content_page(bot, chat_id, path, missing=None, reply_markup=None):
+    """Отправка страницы контента: медиафайлы, затем HTML-сообщения; клавиатура - у последнего."""
+    messages = content_store.get_messages(path)
+    if messages is None:
+        logger.warning("Файл %s не найден.", path)
+        messages = [html.escape(missing or "Файл не найден.", quote=False)]
+    media = content_store.get_media(path)
+    if media:
+        try:
+            await media_store.send(bot, chat_id, media)
+        except Exception as e:
+            logger.error("Ошибка при отправке медиафайлов %s: %s", path, e)
+    for index, message in enumerate(messages):
+        last = index == len(messages) - 1
+        await bot.send_message(chat_id, message, reply_markup=reply_markup if last else None, parse_mode='HTML')
+
+def render_search_results(query, results):
+    """Текст и кнопки ответа на /search."""
+    if not results:
+        return f"По запросу «{html.escape(query, quote=False)}» ничего не найдено.", None
+    lines = [f"Результаты по запросу «{html.escape(query, quote=False)}»:"]
+    buttons = []
+    for number, result in enumerate(results, 1):
+        title = html.escape(result.title, quote=False)
+        if result.section:
+            title += f" · {html.escape(result.section, quote=False)}"
+        lines.append(f"\n{number}. <b>{title}</b>\n{result.snippet_html}")
+        buttons.append([InlineKeyboardButton(f"{number}. {result.title}", callback_data=f"search_open_{result.document_id}")])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+async def search_content(update: Update, context: CallbackContext) -> None:
+    query = ' '.join(context.args)
+    if not query:
+        await update.message.reply_text(
+            f"Использование: /search <запрос>, например /search консоль.\n"
+            f"Искать можно и в любом чате: @{context.bot.username} <запрос>"
+        )
+        return
+    results = await search_index.search(query)
+    analytics.record('search', update.effective_user.id, value=len(results))
+    text, reply_markup = render_search_results(query, results[:SEARCH_RESULTS])
+    logger.info("Пользователь %s искал «%s», найдено %s", update.effective_user.id, query, len(results))
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
+async def handle_search_open(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    path = search_index.path(int(query.data.rsplit('_', 1)[1]))
+    if path is None:
+        await query.message.reply_text("Страница больше не доступна, повторите поиск.")
+        return
+    analytics.record('page', query.from_user.id, path)
+    await send_content_page(context.bot, query.message.chat_id, path)
+
+async def handle_inline_search(update: Update, context: CallbackContext) -> None:
+    """Встроенный режим: @бот <запрос> в любом чате. Выбранный результат отправляет первое
+    сообщение страницы; длинные страницы получают кнопку для чтения полностью в боте.
+    """
+    inline_query = update.inline_query
+    results = await search_index.search(inline_query.query) if inline_query.query.strip() else []
+    articles = []
+    for result in results:
+        messages = content_store.get_messages(result.path)
+        if not messages:
+            continue
+        reply_markup = None
+        if len(messages) > 1:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+                "Читать полностью", url=f"https://t.me/{context.bot.username}?start=page_{result.document_id}"
+            )]])
+        articles.append(InlineQueryResultArticle(
+            id=str(result.document_id),
+            title=result.title,
+            description=' · '.join(filter(None, (result.section, result.snippet_text))),
+            input_message_content=InputTextMessageContent(messages[0], parse_mode='HTML'),
+            reply_markup=reply_markup,
+        ))
+    analytics.record('inline_search', inline_query.from_user.id, value=len(articles))
+    await inline_query.answer(articles, cache_time=SEARCH_INLINE_CACHE_TIME)
+
+# Обработчики, в которые route_text передаёт сообщение, с собственными метриками
+routed_broadcast_input = instrument_handler(handle_broadcast_input)
+routed_question_input = instrument_handler(handle_question_input)
+
+async def route_text(update: Update, context: CallbackContext) -> None:
+    """Единая точка входа для текстовых сообщений: кнопки меню, рассылка, вопросы и диалоги."""
+    user = update.message.from_user
+    if user.is_bot:
+        await update.message.reply_text("Извините, боты не могут использовать эту функцию.")
+        return
+    node = resolve_menu(context.user_data.get('current_menu'), update.message.text)
+    if node:
+        logger.debug("Пользователь %s открыл %s", user.id, node.node_id)
+        await open_menu_node(update, context, node)
+    elif user.id in config.admin_ids and context.user_data.get('waiting_for_broadcast'):
+        await routed_broadcast_input(update, context)
+    else:
+        analytics.record('message', user.id)
+        await routed_question_input(update, context)
+
+
+def _save_user_states(conn, rows):
+    conn.executemany(
+        "INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
+        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+        rows
+    )
+
+class SQLitePersistence(BasePersistence):
+    """Хранение user_data в SQLite.
+
+    Данные пользователя подгружаются лениво при первом его обновлении после запуска,
+    изменения копятся в памяти и записываются одной транзакцией раз в update_interval.
+    """
+
+    def __init__(self, database, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = database
+        self._loaded = set()
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+
+    async def get_user_data(self):
+        # Ничего не читаем при запуске: данные подгружаются в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        row = await self.db.fetchone("SELECT data FROM user_state WHERE user_id = ?", (user_id,))
+        if row:
+            for key, value in json.loads(row[0]).items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        self._dirty[user_id] = data
+        # Даём остальным update_user_data этого цикла отметиться, затем пишем всё разом
+        await asyncio.sleep(0)
+        await self._flush_dirty()
+
+    async def drop_user_data(self, user_id):
+        self._dirty.pop(user_id, None)
+        await self.db.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    async def _flush_dirty(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            rows = [(user_id, json.dumps(data, ensure_ascii=False)) for user_id, data in dirty.items()]
+            try:
+                await self.db.write(_save_user_states, rows)
+            except Exception as e:
+                logger.error("Ошибка при сохранении состояния пользователей: %s", e)
+                for user_id, data in dirty.items():
+                    self._dirty.setdefault(user_id, data)
+
+    async def flush(self):
+        await self._flush_dirty()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+persistence = None
+
+# Фоновые задачи, запускаемые вместе с приложением
+background_tasks = []
+http_servers = []
+
+async def sync_search_index() -> None:
+    await search_index.sync(content_store, SEARCH_PAGES)
+
+async def warm_up(application: Application) -> None:
+    """Прогрев до начала приёма обновлений: база данных, контент, клавиатуры и индексы в памяти."""
+    started = time.perf_counter()
+    # Открытие соединений и миграции, загрузка и компиляция контента - в потоках
+    await asyncio.to_thread(db.open)
+    os.makedirs(os.path.join(config.content_dir, 'guides'), exist_ok=True)  # Гарантируем наличие директории для файлов
+    await asyncio.to_thread(content_store.refresh)
+    await sync_search_index()
+    keyboards.register_menus(MENU_NODES.values())
+    await dialogs.load(db)
+    await user_registry.load()
+    await media_store.load()
+    logger.info("Прогрев завершен за %.2f с", time.perf_counter() - started)
+
+async def on_startup(application: Application) -> None:
+    await warm_up(application)
+    background_tasks.append(asyncio.create_task(user_registry.run()))
+    background_tasks.append(asyncio.create_task(content_store.watch(config.content_refresh_interval, sync_search_index)))
+    if cluster is not None:
+        outbox.partition = (cluster.index, cluster.count)
+    outbox.start(application.bot)
+    # В режиме WORKERS рассылки, агрегаты аналитики и архивацию ведёт только первый обработчик
+    # (к нему же попадают админы)
+    primary = cluster is None or cluster.is_primary
+    background_tasks.append(asyncio.create_task(analytics.run(rollups=primary)))
+    if primary and config.retention_days:
+        background_tasks.append(asyncio.create_task(retention.run()))
+    if primary:
+        await broadcast_engine.resume(application.bot)
+    if config.metrics_port:
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/metrics", MetricsHandler)]))
+        server.listen(config.metrics_port, config.metrics_listen)
+        http_servers.append(server)
+        logger.info("Метрики доступны на http://%s:%s/metrics", config.metrics_listen, config.metrics_port)
+
+async def on_shutdown(application: Application) -> None:
+    for server in http_servers:
+        server.stop()
+    http_servers.clear()
+    await broadcast_engine.stop()
+    await outbox.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if db.is_open:
+        await user_registry.flush()
+        await analytics.flush()
+        # user_data уже записаны в Application.shutdown(), соединения больше не нужны
+        try:
+            db.close()
+        except Exception as e:
+            logger.error("Ошибка при закрытии соединения с базой данных: %s", e)
+            critical_logger.critical("Критическая ошибка при закрытии соединения с базой данных: %s", e, exc_info=True)
+
+class OrderedApplication(Application):
+    """Application, который обрабатывает обновления разных пользователей параллельно,
+    а обновления одного пользователя - строго по очереди, чтобы не было гонок в user_data.
+
+    Ограничение PTB (concurrent_updates) задаётся заведомо большим, и PTB сразу запускает задачу
+    на каждое обновление, а все ограничения - здесь. Порядок держится только на asyncio.Lock,
+    который пропускает ожидающих строго по очереди: приём в обработку (не больше
+    update_queue_depth обновлений) проходит через общий замок, а замок пользователя берётся
+    раньше семафора одновременной обработки. asyncio.Semaphore в Python 3.10 может пропустить
+    нового вызывающего вперёд ожидающих, поэтому порядок обновлений одного пользователя
+    от него не зависит.
+    """
+
+    # Значение для Application.builder().concurrent_updates(): фактически без ограничения
+    UNBOUNDED_UPDATES = 2 ** 31
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._admission_order = asyncio.Lock()
+        self._admitted = asyncio.Semaphore(max(1, config.update_queue_depth))
+        self._running_limit = asyncio.Semaphore(max(1, config.concurrent_updates))
+        self._ordering_locks = {}
+        self._pending_updates = 0
+        self._waiting_updates = 0
+        self._running_updates = 0
+        self._max_waiting_updates = 0
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object) -> None:
+        # Семафор ждёт только тот, кто держит замок приёма, поэтому обогнать его некому
+        self._pending_updates += 1
+        try:
+            async with self._admission_order:
+                await self._admitted.acquire()
+        finally:
+            self._pending_updates -= 1
+        try:
+            await self._process_ordered(update)
+        finally:
+            self._admitted.release()
+
+    async def _process_ordered(self, update):
+        key = self._ordering_key(update)
+        if key is None:
+            return await self._process_limited(update)
+        # Замок на пользователя: asyncio.Lock пропускает ожидающих в порядке поступления
+        entry = self._ordering_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self._waiting_updates += 1
+        self._max_waiting_updates = max(self._max_waiting_updates, self._waiting_updates)
+        try:
+            async with entry[0]:
+                await self._process_limited(update, waiting=True)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._ordering_locks.pop(key, None)
+
+    async def _process_limited(self, update, waiting=False):
+        async with self._running_limit:
+            if waiting:
+                self._waiting_updates -= 1
+            self._running_updates += 1
+            try:
+                await super().process_update(update)
+            finally:
+                self._running_updates -= 1
+
+    def report_queue(self):
+        """Глубина очереди обновлений в gauge bot_update_queue_depth (вызывается при выдаче /metrics)."""
+        metrics.set('bot_update_queue_depth', self.update_queue.qsize() + self._pending_updates, state='pending')
+        metrics.set('bot_update_queue_depth', self._waiting_updates, state='waiting')
+        metrics.set('bot_update_queue_depth', self._running_updates, state='running')
+        metrics.set('bot_update_ordered_keys', len(self._ordering_locks))
+
+    def queue_stats(self):
+        """Метрики очереди обновлений."""
+        return {
+            'update_queue': self.update_queue.qsize() + self._pending_updates,
+            'waiting': self._waiting_updates,
+            'running': self._running_updates,
+            'max_waiting': self._max_waiting_updates,
+            'ordered_keys': len(self._ordering_locks),
+        }
+
+class HealthHandler(tornado.web.RequestHandler):
+    """GET /healthz: процесс жив и отвечает."""
+
+    def get(self):
+        self.write({'status': 'ok'})
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """GET /metrics: метрики в текстовом формате Prometheus."""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
+class ReadinessHandler(tornado.web.RequestHandler):
+    """GET /readyz: приложение запущено и база данных открыта."""
+
+    def initialize(self, bot_application):
+        self.bot_application = bot_application
+
+    def get(self):
+        ready = self.bot_application.running and db.is_open
+        self.set_status(200 if ready else 503)
+        self.write({'status': 'ready' if ready else 'starting', 'updates': self.bot_application.queue_stats()})
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """POST от Telegram на путь webhook: проверка секрета и передача Update в очередь обновлений.
+
+    Сервер webhook PTB живёт в закрытом модуле telegram.ext._utils и может измениться в любом
+    выпуске, поэтому обработчик свой и использует только публичный Update.de_json.
+    """
+
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, bot, update_queue, secret_token):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token:
+            token = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                logger.warning("Запрос к webhook с неверным секретом от %s", self.request.remote_ip)
+                raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot)
+        except Exception as e:
+            logger.error("Некорректное обновление в запросе к webhook: %s", e)
+            raise tornado.web.HTTPError(400)
+        if update:
+            await self.update_queue.put(update)
+
+def start_webhook_server(app_config, bot, update_queue, routes=()):
+    """HTTP-сервер webhook на app_config.webhook_listen:webhook_port: путь webhook и служебные маршруты."""
+    url_path = '/' + app_config.webhook_path.strip('/')
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (re.escape(url_path) + '/?', WebhookHandler,
+         {'bot': bot, 'update_queue': update_queue, 'secret_token': app_config.webhook_secret or None}),
+        *routes,
+    ]))
+    server.listen(app_config.webhook_port, app_config.webhook_listen)
+    return server
+
+async def stop_webhook_server(server):
+    server.stop()
+    await server.close_all_connections()
+
+async def run_webhook(application: Application) -> None:
+    """Запуск в режиме webhook: HTTP-сервер с проверкой секрета плюс /healthz и /readyz.
+
+    Для локальной проверки оставьте WEBHOOK_URL пустым и отправьте записанный Update:
+    curl -X POST -H 'Content-Type: application/json' -H 'X-Telegram-Bot-Api-Secret-Token: <секрет>' \\
+         -d @update.json http://127.0.0.1:8443/telegram
+    """
+    url_path = '/' + config.webhook_path.strip('/')
+    server = None
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
     try:
-        logger.info("Запуск бота...")
-        conn, _ = get_db_connection()
-        application.run_polling()
-    except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
-        critical_logger.critical(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
+        if application.post_init:
+            await application.post_init(application)
+        # Сервер слушает до setWebhook, чтобы первые обновления не получили отказ; до start() они ждут в очереди
+        server = start_webhook_server(config, application.bot, application.update_queue, [
+            (r'/healthz', HealthHandler),
+            (r'/readyz', ReadinessHandler, {'bot_application': application}),
+        ])
+        if config.webhook_url:
+            await application.bot.set_webhook(
+                url=config.webhook_url.rstrip('/') + url_path,
+                secret_token=config.webhook_secret or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=config.webhook_max_connections
+            )
+        await application.start()
+        logger.info("Webhook-сервер слушает %s:%s%s", config.webhook_listen, config.webhook_port, url_path)
+        await stop_event.wait()
     finally:
+        if server:
+            await stop_webhook_server(server)
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Режим нескольких процессов (WORKERS > 0): диспетчер получает обновления (polling или webhook)
+# и раздаёт их обработчикам по user_id. Все обновления пользователя попадают в один процесс,
+# поэтому порядок и user_data сохраняются; SQLite в режиме WAL общая для всех процессов.
+# Админы закреплены за первым обработчиком, он же ведёт рассылки.
+# Период отправки состояния обработчиком и время без состояния, после которого он считается зависшим (в секундах)
+WORKER_HEALTH_INTERVAL = 5
+WORKER_STALE_AFTER = 30
+# Время на завершение обработчика при остановке (в секундах)
+WORKER_STOP_TIMEOUT = 30
+
+metrics.describe('bot_worker_updates_total', 'counter', 'Обновления, переданные процессу-обработчику')
+metrics.describe('bot_worker_restarts_total', 'counter', 'Перезапуски упавших процессов-обработчиков')
+metrics.describe('bot_worker_up', 'gauge', 'Обработчик жив и присылает состояние')
+metrics.describe('bot_worker_waiting_updates', 'gauge', 'Обновления, ожидающие обработки в процессе-обработчике')
+
+# Связь с диспетчером в процессе-обработчике; None - обычный режим одного процесса
+cluster = None
+
+def share(kind, *args):
+    """Передача изменения общего состояния в памяти остальным процессам-обработчикам."""
+    if cluster is not None:
+        cluster.publish(kind, *args)
+
+def worker_config(app_config, index):
+    """Настройки обработчика: свой каталог логов и свой порт метрик (METRICS_PORT + 1 + номер)."""
+    return replace(
+        app_config,
+        log_dir=os.path.join(app_config.log_dir, f'worker-{index}') if app_config.log_dir else '',
+        metrics_port=app_config.metrics_port + 1 + index if app_config.metrics_port else 0,
+    )
+
+def _queue_size(mp_queue):
+    try:
+        return mp_queue.qsize()
+    except NotImplementedError:  # macOS
+        return None
+
+class WorkerLink:
+    """Связь процесса-обработчика с диспетчером.
+
+    Из inbox приходят обновления и изменения от других обработчиков, в events уходят
+    собственные изменения общего состояния и периодическое состояние процесса.
+    """
+
+    def __init__(self, index, count, inbox, events):
+        self.index = index
+        self.count = count
+        self.inbox = inbox
+        self.events = events
+        self.processed = 0
+
+    @property
+    def is_primary(self):
+        return self.index == 0
+
+    def publish(self, kind, *args):
+        self.events.put((self.index, kind, args))
+
+    def apply(self, kind, args):
+        if kind == 'dialog':
+            dialogs.apply(*args)
+        elif kind == 'outbox':
+            outbox.wake()
+        elif kind == 'forget_users':
+            user_registry.forget(*args)
+        else:
+            logger.warning("Неизвестное событие от диспетчера: %s", kind)
+
+    async def _report_health(self, application):
+        while True:
+            self.publish('health', {
+                'pid': os.getpid(),
+                'processed': self.processed,
+                'dialogs': len(dialogs),
+                **application.queue_stats(),
+            })
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+
+    async def serve(self, application):
+        loop = asyncio.get_running_loop()
         try:
-            if conn:
-                conn.close()
-                logger.info("Соединение с базой данных закрыто.")
-        except Exception as e:
-            logger.error(f"Ошибка при закрытии соединения с базой данных: {e}")
-            critical_logger.critical(f"Критическая ошибка при закрытии соединения с базой данных: {e}", exc_info=True)
+            loop.add_signal_handler(signal.SIGTERM, self.inbox.put, None)
+        except NotImplementedError:
+            pass
+
+        await application.initialize()
+        health_task = None
+        try:
+            await application.post_init(application)
+            await application.start()
+            health_task = asyncio.create_task(self._report_health(application))
+            logger.info("Обработчик #%s готов (pid %s)", self.index, os.getpid())
+            while True:
+                item = await loop.run_in_executor(None, self.inbox.get)
+                if item is None:
+                    break
+                kind, payload = item
+                if kind == 'update':
+                    self.processed += 1
+                    await application.update_queue.put(Update.de_json(payload, application.bot))
+                else:
+                    self.apply(kind, payload)
+        finally:
+            if health_task:
+                health_task.cancel()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            await application.post_shutdown(application)
+            logger.info("Обработчик #%s остановлен, обработано обновлений: %s", self.index, self.processed)
+
+def run_worker(app_config, index, inbox, events):
+    """Точка входа процесса-обработчика."""
+    global cluster
+    # Ctrl+C получает вся группа процессов; останавливает обработчики диспетчер
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cluster = WorkerLink(index, app_config.workers, inbox, events)
+    try:
+        asyncio.run(cluster.serve(create_app(worker_config(app_config, index))))
+    except Exception as e:
+        logger.error("Ошибка в обработчике #%s: %s", index, e)
+        critical_logger.critical("Критическая ошибка в обработчике #%s: %s", index, e, exc_info=True)
+        raise
+
+class WorkersHandler(tornado.web.RequestHandler):
+    """GET /readyz в режиме WORKERS: состояние каждого обработчика, 503 пока не готовы все."""
+
+    def initialize(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def get(self):
+        ready, workers = self.dispatcher.status()
+        self.set_status(200 if ready else 503)
+        self.write({'status': 'ready' if ready else 'degraded', 'workers': workers})
+
+class Dispatcher:
+    """Процесс-диспетчер: получает обновления и раздаёт их процессам-обработчикам.
+
+    Номер обработчика - user_id по модулю числа обработчиков, админы и обновления без
+    пользователя идут в первый. События об изменении общего состояния пересылаются всем
+    остальным обработчикам. Упавший обработчик перезапускается с той же очередью.
+    """
+
+    def __init__(self, app_config):
+        self.config = app_config
+        self.count = app_config.workers
+        # spawn: обработчик собирает приложение с нуля, без копии цикла событий диспетчера
+        self.context = multiprocessing.get_context('spawn')
+        self.inboxes = [self.context.Queue() for _ in range(self.count)]
+        self.events = self.context.Queue()
+        self.processes = [None] * self.count
+        self.health = [{} for _ in range(self.count)]
+        self.restarts = [0] * self.count
+        self.update_queue = asyncio.Queue()
+
+    def shard(self, update):
+        key = OrderedApplication._ordering_key(update)
+        if key is None or key in self.config.admin_ids:
+            return 0
+        return key % self.count
+
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=run_worker, args=(self.config, index, self.inboxes[index], self.events),
+            name=f'bot-worker-{index}'
+        )
+        process.start()
+        self.processes[index] = process
+        self.health[index] = {'started': time.time()}
+        logger.info("Запущен обработчик #%s (pid %s)", index, process.pid)
+
+    def dispatch(self, update):
+        index = self.shard(update)
+        self.inboxes[index].put(('update', update.to_dict()))
+        metrics.inc('bot_worker_updates_total', worker=index)
+
+    async def _route_updates(self):
+        while True:
+            self.dispatch(await self.update_queue.get())
+
+    async def _route_events(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self.events.get)
+            if item is None:
+                return
+            index, kind, args = item
+            if kind == 'health':
+                self.health[index].update(args[0], seen=time.time())
+                metrics.set('bot_worker_waiting_updates', args[0]['waiting'], worker=index)
+                continue
+            if kind == 'outbox':
+                # Пробуждение outbox нужно только обработчику, отправляющему сообщения чата
+                self.inboxes[args[0]].put((kind, args))
+                continue
+            for other, inbox in enumerate(self.inboxes):
+                if other != index:
+                    inbox.put((kind, args))
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+            now = time.time()
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("Обработчик #%s завершился с кодом %s, перезапуск", index, process.exitcode)
+                    critical_logger.critical("Обработчик #%s завершился с кодом %s", index, process.exitcode)
+                    self.restarts[index] += 1
+                    metrics.inc('bot_worker_restarts_total', worker=index)
+                    self._spawn(index)
+                    continue
+                seen = self.health[index].get('seen', self.health[index]['started'])
+                if now - seen > WORKER_STALE_AFTER:
+                    logger.warning("Обработчик #%s не присылает состояние %.0f с", index, now - seen)
+            for index, (ready, _) in enumerate(self._workers_status(now)):
+                metrics.set('bot_worker_up', int(ready), worker=index)
+
+    def _workers_status(self, now):
+        for index, process in enumerate(self.processes):
+            state = self.health[index]
+            alive = process is not None and process.is_alive()
+            seen = state.get('seen')
+            ready = alive and seen is not None and now - seen <= WORKER_STALE_AFTER
+            yield ready, {
+                'worker': index,
+                'pid': process.pid if process else None,
+                'alive': alive,
+                'ready': ready,
+                'restarts': self.restarts[index],
+                'last_seen_seconds': round(now - seen, 1) if seen else None,
+                'queued': _queue_size(self.inboxes[index]),
+                **{key: state[key] for key in ('processed', 'waiting', 'running', 'dialogs') if key in state},
+            }
+
+    def status(self):
+        """(все обработчики готовы, состояние каждого) для /readyz."""
+        workers = list(self._workers_status(time.time()))
+        return all(ready for ready, _ in workers), [worker for _, worker in workers]
+
+    async def run(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
+
+        # Миграции выполняются один раз, до запуска обработчиков
+        database = Database(self.config.db_path, 1, self.config.db_pragmas)
+        await asyncio.to_thread(database.open)
+        database.close()
+        for index in range(self.count):
+            self._spawn(index)
+
+        bot = Bot(self.config.token, request=InstrumentedRequest(), get_updates_request=HTTPXRequest())
+        updater = Updater(bot, self.update_queue)
+        routes = [(r'/readyz', WorkersHandler, {'dispatcher': self})]
+        webhook_server = None
+        if self.config.metrics_port:
+            server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/metrics", MetricsHandler), *routes]))
+            server.listen(self.config.metrics_port, self.config.metrics_listen)
+            http_servers.append(server)
+            logger.info(
+                "Метрики диспетчера: http://%s:%s/metrics", self.config.metrics_listen, self.config.metrics_port
+            )
+        tasks = [asyncio.create_task(self._route_updates()), asyncio.create_task(self._watch())]
+        events_task = asyncio.create_task(self._route_events())
+
+        await updater.initialize()
+        try:
+            if self.config.bot_mode == 'webhook':
+                url_path = '/' + self.config.webhook_path.strip('/')
+                webhook_server = start_webhook_server(
+                    self.config, bot, self.update_queue, [(r'/healthz', HealthHandler), *routes]
+                )
+                if self.config.webhook_url:
+                    await bot.set_webhook(
+                        url=self.config.webhook_url.rstrip('/') + url_path,
+                        secret_token=self.config.webhook_secret or None,
+                        allowed_updates=Update.ALL_TYPES,
+                        max_connections=self.config.webhook_max_connections
+                    )
+            else:
+                await updater.start_polling()
+            logger.info("Диспетчер принимает обновления (%s), обработчиков: %s", self.config.bot_mode, self.count)
+            await stop_event.wait()
         finally:
-            logger.info("Остановка бота...")
\ No newline at end of file
+            if updater.running:
+                await updater.stop()
+            if webhook_server:
+                await stop_webhook_server(webhook_server)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Полученные обновления ещё обработаются: обработчики дочитывают очередь до None
+            while not self.update_queue.empty():
+                self.dispatch(self.update_queue.get_nowait())
+            for inbox in self.inboxes:
+                inbox.put(None)
+            for index, process in enumerate(self.processes):
+                await asyncio.to_thread(process.join, WORKER_STOP_TIMEOUT)
+                if process.is_alive():
+                    logger.warning("Обработчик #%s не остановился за %s с, завершаем", index, WORKER_STOP_TIMEOUT)
+                    process.terminate()
+            self.events.put(None)
+            await events_task
+            await updater.shutdown()
+            for server in http_servers:
+                server.stop()
+            http_servers.clear()
+
+def register_handlers(application: Application) -> None:
+    # Обновленная секция обработчиков
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("end_dialog", end_dialog))
+    application.add_handler(CommandHandler("export", export_user_ids))
+    application.add_handler(CommandHandler("stats", show_metrics))
+    application.add_handler(CommandHandler("search", search_content))
+    application.add_handler(CommandHandler("transcript", show_transcript))
+    application.add_handler(CommandHandler("vacuum", vacuum_database))
+    application.add_handler(InlineQueryHandler(handle_inline_search))
+
+    # Меню, рассылка, вопросы и диалоги: маршрутизация по дереву меню
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, route_text))
+
+    # Фото с подписью для рассылки
+    application.add_handler(MessageHandler(filters.PHOTO, handle_broadcast_input))
+
+    # Обработчики callback-запросов
+    application.add_handler(CallbackQueryHandler(handle_admin_action, pattern=r'^(answer|close|end_dialog)_\d+$'))
+    application.add_handler(CallbackQueryHandler(handle_broadcast_action, pattern=r'^(send_broadcast|cancel_broadcast|back_from_broadcast)$'))
+    application.add_handler(CallbackQueryHandler(handle_broadcast_stop, pattern=r'^stop_broadcast_\d+$'))
+    application.add_handler(CallbackQueryHandler(handle_search_open, pattern=r'^search_open_\d+$'))
+    application.add_handler(CallbackQueryHandler(handle_inbox_page, pattern=r'^inbox:(all|open|work):\d+:[np]:\d+$'))
+
+    # Метрики по каждому зарегистрированному обработчику
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+def create_app(app_config=None, request=None) -> Application:
+    """Создание приложения по настройкам (по умолчанию - из окружения и .env).
+
+    Импорт модуля ничего не создаёт и не открывает. Здесь настраивается логирование и создаются
+    подсистемы, а база данных, контент и клавиатуры загружаются при прогреве (warm_up) перед
+    приёмом обновлений. request позволяет подменить HTTP-транспорт Bot API (тесты, бенчмарки).
+    """
+    global config, db, content_store, media_store, search_index, user_registry, broadcast_engine, outbox, analytics
+    global retention, persistence
+    config = app_config or Config.from_env()
+    setup_logging(config)
+
+    db = Database(config.db_path, config.db_pool_size, config.db_pragmas, config.db_statement_cache)
+    content_store = ContentStore(config.content_dir)
+    media_store = MediaStore(db)
+    search_index = SearchIndex(db)
+    user_registry = UserRegistry(db, config.user_flush_interval, config.user_flush_batch)
+    broadcast_engine = BroadcastEngine(
+        db, config.broadcast_rate, config.broadcast_concurrency, config.broadcast_batch_size,
+        config.broadcast_progress_interval
+    )
+    outbox = Outbox(db, config.outbox_rate, config.outbox_concurrency)
+    analytics = Analytics(
+        db, config.analytics_buffer_size, config.analytics_flush_interval, config.analytics_rollup_interval,
+        config.analytics_keep_days
+    )
+    retention = Retention(
+        db, config.archive_dir, config.retention_days, config.retention_interval, config.retention_batch_size,
+        config.vacuum_step_pages
+    )
+    persistence = SQLitePersistence(db, update_interval=config.persistence_flush_interval)
+
+    application = (
+        Application.builder()
+        .application_class(OrderedApplication)
+        .token(config.token)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .persistence(persistence)
+        .concurrent_updates(OrderedApplication.UNBOUNDED_UPDATES if config.concurrent_updates else 0)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    register_handlers(application)
+    metrics.collector('update_queue', application.report_queue)
+    return application
+
+def main() -> None:
+    global config
+    config = Config.from_env()
+    setup_logging(config)
+    try:
+        if config.workers:
+            logger.info("Запуск бота: диспетчер и %s обработчиков...", config.workers)
+            asyncio.run(Dispatcher(config).run())
+            return
+        application = create_app(config)
+        logger.info("Запуск бота...")
+        if config.bot_mode == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling()
+    except Exception as e:
+        logger.error("Ошибка при запуске бота: %s", e)
+        critical_logger.critical("Критическая ошибка при запуске бота: %s", e, exc_info=True)
+    finally:
+        logger.info("Остановка бота...")
+
+# Запуск
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+import main
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def menu_pages():
+    return {node.content for node in main.MENU_NODES.values() if node.content}
+
+
+def test_menu_pages_resolve_in_non_default_content_dir(tmp_path):
+    content_dir = tmp_path / 'site-content'
+    shutil.copytree(DATA_DIR, content_dir)
+    store = main.ContentStore(str(content_dir))
+    store.refresh()
+
+    missing = [path for path in menu_pages() if store.get_messages(path) is None]
+    assert missing == []
+
+
+def test_create_app_uses_content_dir(tmp_path, monkeypatch):
+    config = main.Config(token='1:TEST', log_dir='', metrics_port=0, content_dir=str(tmp_path))
+    monkeypatch.setattr(main, 'config', config)
+    main.create_app(config)
+    assert main.content_store.root == str(tmp_path)
+
+
+def test_media_keyed_by_relative_page_path(tmp_path):
+    (tmp_path / 'mods').mkdir()
+    (tmp_path / 'mods' / 'page.md').write_text('*страница*', encoding='utf-8')
+    (tmp_path / 'mods' / 'page').mkdir()
+    (tmp_path / 'mods' / 'page' / 'shot.png').write_bytes(b'png')
+    store = main.ContentStore(str(tmp_path))
+    store.refresh()
+
+    assert store.get_messages('mods/page.md') == ['<b>страница</b>']
+    [(path, content_hash)] = store.get_media('mods/page.md')
+    assert path == str(tmp_path / 'mods' / 'page' / 'shot.png')
+    assert len(content_hash) == 64
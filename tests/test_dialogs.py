@@ -0,0 +1,77 @@
+import asyncio
+
+import main
+
+
+def test_new_question_keeps_running_dialog():
+    dialogs = main.DialogIndex()
+    dialogs.open(1, 10)
+    dialogs.take(1, 10, 500)
+    # Пользователь задал новый вопрос, пока идёт диалог по первому
+    dialogs.open(1, 11)
+
+    assert dialogs.user_for(10) == 1
+    assert dialogs.user_for(11) is None
+    assert dialogs.for_user(1) == (10, 500)
+
+    dialogs.close(10)
+    assert dialogs.user_for(10) is None
+    assert dialogs.for_user(1) == (11, None)
+
+
+def test_take_older_question():
+    dialogs = main.DialogIndex()
+    dialogs.open(1, 10)
+    dialogs.open(1, 11)
+    dialogs.take(1, 10, 500)
+
+    assert dialogs.user_for(10) == 1
+    assert dialogs.for_user(1) == (10, 500)
+
+    dialogs.take(1, 11, 501)
+    assert dialogs.user_for(10) == 1
+    assert dialogs.for_user(1) == (11, 501)
+
+
+def test_take_applied_before_open():
+    dialogs = main.DialogIndex()
+    dialogs.apply('take', 1, 10, 500)
+    dialogs.apply('open', 1, 10)
+
+    assert dialogs.for_user(1) == (10, 500)
+
+
+def test_close_last_question():
+    dialogs = main.DialogIndex()
+    dialogs.open(1, 10)
+    dialogs.close(10)
+    dialogs.close(10)
+
+    assert dialogs.for_user(1) is None
+    assert len(dialogs) == 0
+
+
+def test_load_all_unclosed_questions(tmp_path):
+    database = main.Database(str(tmp_path / 'bot.db'), pool_size=1)
+    database.open()
+    try:
+        async def scenario():
+            first = await database.write(main._insert_question, 1, 'первый')
+            await database.write(main._take_question, first, 500)
+            second = await database.write(main._insert_question, 1, 'второй')
+            closed = await database.write(main._insert_question, 2, 'закрытый')
+            await database.write(main._close_question, closed)
+
+            dialogs = main.DialogIndex()
+            await dialogs.load(database)
+            return first, second, closed, dialogs
+
+        first, second, closed, dialogs = asyncio.run(scenario())
+    finally:
+        database.close()
+
+    assert dialogs.user_for(first) == 1
+    assert dialogs.user_for(second) is None
+    assert dialogs.for_user(1) == (first, 500)
+    assert dialogs.for_user(2) is None
+    assert len(dialogs) == 2
@@ -0,0 +1,57 @@
+import asyncio
+import copy
+import json
+
+from telegram import Bot, ReplyKeyboardMarkup
+from telegram.request import BaseRequest
+
+import main
+
+KEYBOARD = [['ETS 2', 'ATS'], ['Задать вопрос']]
+
+
+def test_registry_reuses_markup():
+    registry = main.KeyboardRegistry()
+    assert registry.get(KEYBOARD) is registry.get([list(row) for row in KEYBOARD])
+    assert registry.get(KEYBOARD) is not registry.get(KEYBOARD, one_time_keyboard=True)
+
+
+def test_payload_matches_regular_markup():
+    markup = main.PrebuiltReplyKeyboardMarkup(KEYBOARD, resize_keyboard=True, selective=False)
+    expected = ReplyKeyboardMarkup(KEYBOARD, resize_keyboard=True, selective=False).to_dict()
+    assert markup.to_dict() == expected
+
+
+class RecordingRequest(BaseRequest):
+    """Транспорт Bot API без сети: запоминает параметры запросов."""
+
+    def __init__(self):
+        self.parameters = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        self.parameters.append(request_data.json_parameters)
+        message = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'меню'}
+        return 200, json.dumps({'ok': True, 'result': message}).encode()
+
+
+def test_send_path_does_not_mutate_shared_payload():
+    markup = main.KeyboardRegistry().get(KEYBOARD)
+    before = copy.deepcopy(markup.to_dict())
+    request = RecordingRequest()
+    bot = Bot('1:TEST', request=request)
+
+    async def send_twice():
+        for _ in range(2):
+            await bot.send_message(1, 'меню', reply_markup=markup)
+
+    asyncio.run(send_twice())
+    first, second = request.parameters
+    assert first == second
+    assert json.loads(first['reply_markup']) == before
+    assert markup.to_dict() == before
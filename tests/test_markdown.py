@@ -0,0 +1,93 @@
+import pytest
+
+import main
+
+
+def test_entities():
+    assert main.parse_markdown('*жирный* _курсив_ `код` текст') == [
+        ('b', None, 'жирный'),
+        (None, None, ' '),
+        ('i', None, 'курсив'),
+        (None, None, ' '),
+        ('code', None, 'код'),
+        (None, None, ' текст'),
+    ]
+
+
+def test_escaped_markers_are_plain_text():
+    assert main.parse_markdown(r'2 \* 3 \_ \[x]') == [(None, None, '2 * 3 _ [x]')]
+
+
+def test_pre_block_drops_language_line():
+    assert main.parse_markdown('```python\nprint(1)\n```') == [('pre', None, 'print(1)\n')]
+    assert main.parse_markdown('```два слова\n```') == [('pre', None, 'два слова\n')]
+
+
+@pytest.mark.parametrize('text', ['*не закрыт', 'до _конца', '```код', '[a]()', '[a](b c)', '[a] (b)', '[a](b'])
+def test_invalid_markup(text):
+    with pytest.raises(main.MarkdownError):
+        main.parse_markdown(text)
+
+
+def test_link():
+    assert main.parse_markdown('[сайт](https://example.com) и (скобки)') == [
+        ('a', 'https://example.com', 'сайт'),
+        (None, None, ' и (скобки)'),
+    ]
+
+
+@pytest.mark.parametrize('url', [
+    'https://ru.wikipedia.org/wiki/Лада_(автомобиль)',
+    'https://example.com/a(b(c)d)e',
+])
+def test_link_with_balanced_parentheses(url):
+    assert main.parse_markdown(f'[ссылка]({url}).') == [('a', url, 'ссылка'), (None, None, '.')]
+
+
+def test_link_with_unbalanced_parenthesis_ends_at_first_close():
+    assert main.parse_markdown('[a](x(y) z') == [('a', 'x(y', 'a'), (None, None, ' z')]
+
+
+def test_compile_escapes_html():
+    assert main.compile_markdown('*a<b* [c&d](https://e.com/?x=1&y="2")') == [
+        '<b>a&lt;b</b> <a href="https://e.com/?x=1&amp;y=&quot;2&quot;">c&amp;d</a>'
+    ]
+
+
+def test_short_text_is_one_message():
+    assert main.compile_markdown('строка\n\nещё строка') == ['строка\n\nещё строка']
+
+
+def test_split_prefers_paragraph_boundary():
+    first = 'а' * 30 + '\n'
+    second = 'б' * 30 + '\n'
+    messages = main.compile_markdown(first + '\n' + second + second, limit=80)
+    assert messages == ['а' * 30, 'б' * 30 + '\n' + 'б' * 30]
+
+
+def test_split_counts_utf16_units():
+    # Эмодзи вне BMP занимает две единицы UTF-16
+    text = '😀' * 6
+    messages = main.compile_markdown(text, limit=4)
+    assert messages == ['😀😀', '😀😀', '😀😀']
+    assert all(main._utf16_length(message) <= 4 for message in messages)
+
+
+def test_split_long_line_at_space():
+    messages = main.compile_markdown('слово ' * 10, limit=20)
+    assert all(len(message) <= 20 for message in messages)
+    assert ' '.join(messages).split() == ['слово'] * 10
+
+
+def test_entity_split_across_messages_keeps_tags():
+    text = '*' + 'строка жирного текста\n' * 4 + '*'
+    messages = main.compile_markdown(text, limit=50)
+    assert len(messages) > 1
+    for message in messages:
+        assert message.startswith('<b>') and message.endswith('</b>')
+
+
+def test_default_limit_is_telegram_limit():
+    messages = main.compile_markdown(('x' * 99 + '\n') * 100)
+    assert len(messages) == 3
+    assert all(main._utf16_length(message) <= main.TELEGRAM_MESSAGE_LIMIT for message in messages)
@@ -0,0 +1,52 @@
+import asyncio
+import random
+
+from telegram import Update
+
+import main
+
+
+def make_update(update_id, user_id):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': str(update_id),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+        },
+    }, None)
+
+
+def test_updates_of_one_chat_are_processed_in_order(monkeypatch):
+    processed = []
+
+    async def record(self, update):
+        # Случайная длительность, чтобы обновления разных чатов обгоняли друг друга
+        await asyncio.sleep(random.random() / 500)
+        processed.append((update.effective_user.id, update.update_id))
+
+    monkeypatch.setattr(main.Application, 'process_update', record)
+    config = main.Config(token='1:TEST', log_dir='', metrics_port=0, concurrent_updates=4, update_queue_depth=6)
+    monkeypatch.setattr(main, 'config', config)
+    application = main.create_app(config)
+    updates = [make_update(update_id, 100 + update_id % 2) for update_id in range(200)]
+
+    async def run():
+        # Как в Application._update_fetcher: задача на каждое обновление в порядке поступления
+        await asyncio.gather(*(asyncio.create_task(application.process_update(update)) for update in updates))
+
+    asyncio.run(run())
+    assert len(processed) == len(updates)
+    for user_id in (100, 101):
+        order = [update_id for chat, update_id in processed if chat == user_id]
+        assert order == sorted(order)
+    assert application.queue_stats()['max_waiting'] <= 6
+
+
+def test_queue_depth_is_exported(monkeypatch):
+    config = main.Config(token='1:TEST', log_dir='', metrics_port=0)
+    monkeypatch.setattr(main, 'config', config)
+    main.create_app(config)
+    rendered = main.metrics.render()
+    assert 'bot_update_queue_depth{state="running"} 0' in rendered
+    assert 'bot_update_queue_depth{state="pending"} 0' in rendered
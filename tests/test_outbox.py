@@ -0,0 +1,50 @@
+import asyncio
+
+import main
+
+
+class Bot:
+    """Отправки в чат 1 ждут release, остальные доставляются сразу."""
+
+    def __init__(self):
+        self.sent = []
+        self.release = asyncio.Event()
+        self.delivered = asyncio.Event()
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if chat_id == 1:
+            await self.release.wait()
+        self.sent.append((chat_id, text))
+        if chat_id == 2:
+            self.delivered.set()
+
+
+def _queue(conn, messages):
+    return None, messages
+
+
+def test_long_chat_queue_does_not_block_other_chats(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'OUTBOX_BATCH_SIZE', 5)
+    database = main.Database(str(tmp_path / 'bot.db'), pool_size=1)
+    database.open()
+    try:
+        async def scenario():
+            outbox = main.Outbox(database, rate=1000, concurrency=4)
+            # Очередь чата 1 длиннее пачки чтения, сообщение чата 2 поставлено после неё
+            await outbox.write(_queue, [(1, f'первый {n}', None) for n in range(12)])
+            await outbox.write(_queue, [(2, 'второй', None)])
+            bot = Bot()
+            outbox.start(bot)
+            await asyncio.wait_for(bot.delivered.wait(), 5)
+            bot.release.set()
+            while len(bot.sent) < 13:
+                await asyncio.sleep(0.01)
+            await outbox.stop()
+            return bot.sent
+
+        sent = asyncio.run(scenario())
+    finally:
+        database.close()
+
+    assert sent[0] == (2, 'второй')
+    assert [text for chat_id, text in sent if chat_id == 1] == [f'первый {n}' for n in range(12)]
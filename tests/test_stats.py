@@ -0,0 +1,34 @@
+import sqlite3
+
+import main
+
+
+def make_connection(target=None):
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    main.apply_migrations(conn, target)
+    return conn
+
+
+def test_user_counter_seeded_from_existing_users():
+    conn = make_connection(11)
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(1,), (2,), (3,)])
+    main.apply_migrations(conn)
+
+    assert main._load_user_count(conn) == 3
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'stats_hourly'").fetchone() is None
+
+
+def test_user_counter_follows_inserts_and_blocked_users():
+    conn = make_connection()
+    main._insert_user_ids(conn, [1, 2, 3])
+    # Уже известные пользователи не считаются повторно
+    main._insert_user_ids(conn, [2, 3, 4])
+    assert main._load_user_count(conn) == 4
+
+    broadcast_id = main._create_broadcast(conn, 1, 1, 1, 'текст', None)
+    assert conn.execute("SELECT total FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()[0] == 4
+    main._save_broadcast_progress(conn, broadcast_id, 4, {'sent': 2, 'failed': 0, 'blocked': 2}, [3, 4, 5])
+
+    assert main._load_user_count(conn) == 2
+    assert main._load_stats(conn, main.STATS_DAYS)['users'] == 2
+    assert main._load_user_count(conn) == conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]